@@ -50,10 +50,18 @@ _device_id = _device_type + '-' + _observatory_name # Long Device lame
 _device_locationname = 'Villalbilla/Spain - Observatorio GURUGU'         # Device location in the world
 _data_supplier = 'Mireia Nievas / Universidad Complutense de Madrid'  # Data supplier (contact)
 _device_addr = '/dev/ttyUSB0'  # Default IP address of the ethernet device (if not automatically found)
+#_device_addrs = ['192.168.1.10','192.168.1.11']  # SQM-LE addresses for pysqm.asyncread (multiple devices, or 'auto')
+#_devices = [{'type':'SQM-LU','addr':'/dev/ttyUSB0','name':'north'},{'type':'SQM-LE','addr':'192.168.1.10','name':'south'}]  # Devices for pysqm.supervisor
 _measures_to_promediate = 5       # Take the mean of N measures
 _delay_between_measures = 20    # Delay between two measures. In seconds.
 _cache_measures = 5             # Get X measures before writing on screen/file
+_cache_seconds = 300            # ... or write them at least every X seconds
+_fsync_policy = 'flush'         # Sync the data files to disk: 'never', 'flush' (each write) or 'night'
+_use_nightstore = False         # Also save the measures as binary columns (pysqm.nightstore)
 _plot_each = 60                 # Call the plot function each X measures.
+_high_cadence = False           # Pipeline the rx requests (no pauses between the N measures)
+_pipeline_depth = 2             # Number of rx requests queued in the device (high cadence mode)
+_checkpoint_max_age = 600       # Resume the device from the state file if restarted within X seconds
 
 _use_mysql = False        # Set to True if you want to store data on a MySQL db.
 _mysql_host = None        # Host (ip:port / localhost) of the MySQL engine.
@@ -62,6 +70,10 @@ _mysql_pass = None        # Password for that user.
 _mysql_database = None    # Name of the database.
 _mysql_dbtable = None     # Name of the table
 _mysql_port = None        # Port of the MySQL server.
+_mysql_spool = None       # Spool of measures not yet sent (default: monthly_data_directory/mysql.spool)
+
+_use_sqlite = False       # Set to True to also store data on a local SQLite db.
+_sqlite_database = None   # Database file (default: monthly_data_directory/pysqm.sqlite)
 
 _local_timezone     = +1     # UTC+1
 _computer_timezone  = +0     # UTC
@@ -80,6 +92,8 @@ current_data_directory = monthly_data_directory
 current_graph_directory = monthly_data_directory
 # Summary with statistics for the night
 summary_data_directory = monthly_data_directory
+# Binary copy of the data, one directory per night (if _use_nightstore)
+nightstore_directory = monthly_data_directory+"/nightstore/"
 
 
 '''
@@ -90,12 +104,22 @@ PySQM data center (OPTIONAL)
 
 # Send the data to the data center
 _send_to_datacenter = False
+# Queue of records not yet sent (default: monthly_data_directory/datacenter.spool)
+_datacenter_spool = None
+# 'record' (one record per connection, the data center format) or 'batch'
+# (batches with acknowledge, only for receivers that support it)
+_datacenter_protocol = 'record'
+# Receiver host / port (default: the data center, only for 'record')
+_datacenter_host = None
+_datacenter_port = None
 
 
 '''
 Ploting options
 '''
 full_plot = False
+# Sun and Moon events, one file per year (default: monthly_data_directory/almanac)
+_almanac_directory = None
 limits_nsb = [16.5,20.0] # Limits in Y-axis
 limits_time   = [17,9] # Hours
 limits_sunalt = [-80,5] # Degrees
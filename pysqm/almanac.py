@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+'''
+PySQM almanac
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Sun and Moon events of every night of a year, computed at once (with
+pysqm.astro) and kept in a table, one row per night:
+
+ sun_set, sun_rise                 upper limb on the horizon
+ civil_set, civil_rise             Sun center at -6 deg
+ nautical_set, nautical_rise       Sun center at -12 deg
+ astronomical_set, astronomical_rise  Sun center at -18 deg
+ moon_prev_rise, moon_prev_set     last Moon rise/set before midnight
+ moon_next_rise, moon_next_set     first Moon rise/set after midnight
+ moon_phase                        illuminated fraction (%) at midnight
+ moon_transit_alt                  Moon altitude at transit (rad)
+
+Times are UTC. The sets are the last ones before the local midnight
+that ends the night and the rises the first ones after it (NaT if there
+is none within a day, e.g. no astronomical night in summer at high
+latitudes), as Ephemerids computed them with PyEphem. The transit is
+the one in the UTC day of that midnight (or of the day before, if the
+Moon does not transit that day), as PyEphem's Moon.transit_alt.
+
+The tables are saved (numpy .npy, ~40 kB per year) in the almanac
+directory, one file per site, UTC offset and year, so they are only
+computed once. Looking up a night is an index in the table.
+
+Event times agree with PyEphem within ~3 s at mid latitudes. At high
+latitudes, where the Sun and the Moon cross the horizon at grazing
+angles, the differences grow (up to ~20 s for the Sun and ~1 min for
+the Moon at 70 deg). Check with:
+> python -m pysqm.almanac --validate 2024
+____________________________
+'''
+
+import os,sys
+import datetime
+import numpy as np
+
+from pysqm import astro
+
+# Changes with the format or the computation of the tables
+ALMANAC_VERSION = 1
+
+ALMANAC_COLUMNS = [('night','datetime64[D]')]+\
+ [(name,'datetime64[s]') for name in [\
+  'sun_set','sun_rise','civil_set','civil_rise',\
+  'nautical_set','nautical_rise','astronomical_set','astronomical_rise',\
+  'moon_prev_rise','moon_prev_set','moon_next_rise','moon_next_set']]+\
+ [('moon_phase','f4'),('moon_transit_alt','f4')]
+
+# Altitude (deg) of the Sun center for each twilight
+TWILIGHTS = {'civil':-6,'nautical':-12,'astronomical':-18}
+
+# Radius of the Sun (arcsec at 1 AU) and of the Moon (km)
+SUN_RADIUS = 959.63
+MOON_RADIUS = 1737.4
+
+# Sampling of the altitudes to find the events (s)
+GRID_STEP = 600
+
+EPOCH = np.datetime64(0,'s')
+
+# Almanacs already loaded by this process
+_almanacs = {}
+
+
+def _utc(seconds):
+    ''' Seconds since 1970 to datetime64 '''
+    return(EPOCH+np.round(np.asarray(seconds)*1000).astype('timedelta64[ms]'))
+
+
+def sun_limb(seconds,site):
+    ''' Altitude (rad) of the upper limb of the Sun '''
+    utc = _utc(seconds)
+    jd = astro.julian_day(utc)
+    distance = astro.interpolated(astro.sun_ecliptic,jd)[1]
+    return(astro.sun_altitude(utc,site)+SUN_RADIUS*astro.ARCSEC*astro.AU/distance)
+
+
+def moon_limb(seconds,site):
+    ''' Altitude (rad) of the upper limb of the Moon '''
+    utc = _utc(seconds)
+    jd = astro.julian_day(utc)
+    distance = astro.interpolated(astro.moon_ecliptic,jd)[2]
+    return(astro.moon_altitude(utc,site)+np.arcsin(MOON_RADIUS/distance))
+
+
+def crossings(function,seconds,values,iterations=5):
+    '''
+    Times where function (sampled as values at the times seconds)
+    crosses zero, refined with regula falsi. Return (rises,sets).
+    '''
+    sign = values>=0
+    first = np.flatnonzero(sign[1:]!=sign[:-1])
+    a,b = seconds[first],seconds[first+1]
+    fa,fb = values[first],values[first+1]
+    for iteration in range(iterations):
+        if len(a)==0:
+            break
+        t = a-fa*(b-a)/(fb-fa)
+        ft = function(t)
+        same = (ft>=0)==(fa>=0)
+        a,fa = np.where(same,t,a),np.where(same,ft,fa)
+        b,fb = np.where(same,b,t),np.where(same,fb,ft)
+    t = a-fa*(b-a)/(fb-fa)
+    rising = ~sign[first]
+    return(t[rising],t[~rising])
+
+
+def maxima(function,seconds,values):
+    ''' Times and values of the local maxima of function '''
+    k = 1+np.flatnonzero((values[1:-1]>values[:-2])*(values[1:-1]>=values[2:]))
+    # Vertex of the parabola through the three samples
+    curvature = values[k-1]-2*values[k]+values[k+1]
+    t = seconds[k]+0.5*(values[k-1]-values[k+1])/curvature*(seconds[k+1]-seconds[k])
+    return(t,function(t))
+
+
+def previous_event(events,references,window=86400.):
+    ''' Last event before each reference (NaN if none within window) '''
+    k = np.searchsorted(events,references,side='right')-1
+    found = np.take(events,np.clip(k,0,None),mode='clip') if len(events) else \
+     np.full(np.shape(references),np.nan)
+    return(np.where((k>=0)*(references-found<=window),found,np.nan))
+
+
+def next_event(events,references,window=86400.):
+    ''' First event after each reference (NaN if none within window) '''
+    k = np.searchsorted(events,references,side='right')
+    found = np.take(events,k,mode='clip') if len(events) else \
+     np.full(np.shape(references),np.nan)
+    return(np.where((k<len(events))*(found-references<=window),found,np.nan))
+
+
+def twilight_events(site,references,altitude):
+    '''
+    Last time before and first time after each reference (seconds
+    since 1970) with the Sun center at altitude (deg), NaN if none.
+    '''
+    references = np.atleast_1d(np.asarray(references,dtype=float))
+    seconds = np.arange(references.min()-2*86400,references.max()+2*86400+GRID_STEP,GRID_STEP)
+    twilight = lambda t: astro.sun_altitude(_utc(t),site)-altitude*astro.DEG
+    rises,sets = crossings(twilight,seconds,twilight(seconds))
+    return(previous_event(sets,references),next_event(rises,references))
+
+
+def compute_almanac(site,year,utc_offset=0):
+    '''
+    Table of the nights of year for the site. The night of a date
+    ends at the local midnight (UTC+utc_offset hours) after it.
+    '''
+    nights = np.arange(np.datetime64('%04d-01-01' %year),\
+     np.datetime64('%04d-01-01' %(year+1)))
+    references = ((nights+1)-EPOCH).astype('timedelta64[s]').astype(float)-utc_offset*3600.
+
+    # Two days of margin to find the events around the first and last nights
+    seconds = np.arange(references[0]-2*86400,references[-1]+2*86400+GRID_STEP,GRID_STEP)
+
+    table = np.zeros(len(nights),dtype=ALMANAC_COLUMNS)
+    table['night'] = nights
+    to_utc = lambda values: np.where(np.isnan(values),np.datetime64('NaT'),\
+     _utc(np.nan_to_num(values))).astype('datetime64[s]')
+
+    sun = lambda t: sun_limb(t,site)
+    rises,sets = crossings(sun,seconds,sun(seconds))
+    table['sun_set'] = to_utc(previous_event(sets,references))
+    table['sun_rise'] = to_utc(next_event(rises,references))
+
+    for name,altitude in TWILIGHTS.items():
+        sets,rises = twilight_events(site,references,altitude)
+        table[name+'_set'] = to_utc(sets)
+        table[name+'_rise'] = to_utc(rises)
+
+    moon = lambda t: moon_limb(t,site)
+    rises,sets = crossings(moon,seconds,moon(seconds))
+    table['moon_prev_rise'] = to_utc(previous_event(rises,references,2*86400.))
+    table['moon_prev_set'] = to_utc(previous_event(sets,references,2*86400.))
+    table['moon_next_rise'] = to_utc(next_event(rises,references,2*86400.))
+    table['moon_next_set'] = to_utc(next_event(sets,references,2*86400.))
+
+    table['moon_phase'] = astro.moon_phase(_utc(references))
+
+    # Transit in the UTC day of the reference, or in the day before
+    moon_center = lambda t: astro.moon_altitude(_utc(t),site)
+    transits,altitudes = maxima(moon_center,seconds,moon_center(seconds))
+    days = np.floor(references/86400.)*86400.
+    transit = next_event(transits,days-1e-3,86400.)
+    transit = np.where(np.isnan(transit),next_event(transits,days-86400-1e-3,86400.),transit)
+    k = np.searchsorted(transits,np.nan_to_num(transit))
+    table['moon_transit_alt'] = np.where(np.isnan(transit),np.nan,\
+     np.take(altitudes,k,mode='clip'))
+    return(table)
+
+
+def almanac_filename(directory,site,year,utc_offset=0):
+    latitude,longitude,elevation = site.key()
+    return(os.path.join(directory,'almanac_v%d_%+.5f_%+.5f_%.0f_%+g_%04d.npy' \
+     %(ALMANAC_VERSION,latitude,longitude,elevation,utc_offset,year)))
+
+
+def save_almanac(filename,table):
+    ''' Save the table atomically (other processes may be reading it) '''
+    temporary = filename+'.tmp'
+    with open(temporary,'wb') as falmanac:
+        np.save(falmanac,table)
+    os.replace(temporary,filename)
+
+
+class Almanac(object):
+    '''
+    Events of the nights of one year at one site.
+    '''
+    def __init__(self,site,year,utc_offset=0,directory=None):
+        self.site = site
+        self.year = year
+        self.utc_offset = utc_offset
+        self.first_night = np.datetime64('%04d-01-01' %year)
+        self.table = None
+        filename = None
+        if directory is not None:
+            filename = almanac_filename(directory,site,year,utc_offset)
+            try:
+                self.table = np.load(filename)
+            except (OSError,ValueError):
+                pass
+        if self.table is None:
+            self.table = compute_almanac(site,year,utc_offset)
+            if filename is not None:
+                try:
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    save_almanac(filename,self.table)
+                except OSError as ex:
+                    print('Warning, cannot save the almanac: %s' %str(ex))
+
+    def row(self,thedate):
+        ''' Row of the night of thedate (date or datetime64[D]) '''
+        return(self.table[int((np.datetime64(thedate,'D')-self.first_night)/np.timedelta64(1,'D'))])
+
+    def night(self,thedate):
+        '''
+        Events of the night of thedate, as a dict. Times
+        are datetime objects (UTC), None if there is no event.
+        '''
+        row = self.row(thedate)
+        events = {}
+        for name,kind in ALMANAC_COLUMNS[1:]:
+            value = row[name]
+            if kind=='f4':
+                events[name] = None if np.isnan(value) else float(value)
+            else:
+                events[name] = None if np.isnat(value) else value.astype(object)
+        return(events)
+
+
+def get_almanac(site,year,utc_offset=0,directory=None):
+    ''' Almanac of the year, loaded once per process '''
+    key = (site.key(),year,utc_offset,directory)
+    if key not in _almanacs:
+        _almanacs[key] = Almanac(site,year,utc_offset,directory)
+    return(_almanacs[key])
+
+
+def almanac_directory(config):
+    try: directory = config._almanac_directory
+    except AttributeError: directory = None
+    if directory is None:
+        directory = os.path.join(config.monthly_data_directory,'almanac')
+    return(directory)
+
+
+def night_events(config,thedate):
+    ''' Events of the night of thedate at the site in config '''
+    return(get_almanac(astro.config_site(config),thedate.year,\
+     config._local_timezone,almanac_directory(config)).night(thedate))
+
+
+def validate(site,year,utc_offset=0,step=7):
+    '''
+    Maximum differences (s) with PyEphem of the event times
+    (one night every step days).
+    '''
+    import ephem
+    table = compute_almanac(site,year,utc_offset)
+    Observer = ephem.Observer()
+    Observer.lat,Observer.lon = site.latitude*astro.DEG,site.longitude*astro.DEG
+    Observer.elev = site.elevation
+
+    def seconds(ephem_date):
+        return((ephem_date.datetime()-datetime.datetime(1970,1,1)).total_seconds())
+
+    def difference(expected,value):
+        if np.isnat(value):
+            return(None)
+        return(abs(seconds(expected)-(value-EPOCH)/np.timedelta64(1,'s')))
+
+    errors = {}
+    for row in table[::step]:
+        midnight = (row['night']+1).astype(object)
+        Observer.date = ephem.Date(datetime.datetime.combine(midnight,datetime.time())\
+         -datetime.timedelta(hours=utc_offset))
+        checks = []
+        def check(name,event,horizon,use_center=False):
+            Observer.horizon = horizon
+            try: checks.append((name,event(Body(),use_center=use_center)))
+            except ephem.CircumpolarError: pass
+        Body = ephem.Sun
+        for name,horizon in [('sun','0'),('civil','-6'),('nautical','-12'),('astronomical','-18')]:
+            check(name+'_set',Observer.previous_setting,horizon,name!='sun')
+            check(name+'_rise',Observer.next_rising,horizon,name!='sun')
+        Body = ephem.Moon
+        check('moon_prev_rise',Observer.previous_rising,'0')
+        check('moon_prev_set',Observer.previous_setting,'0')
+        check('moon_next_rise',Observer.next_rising,'0')
+        check('moon_next_set',Observer.next_setting,'0')
+        for name,expected in checks:
+            error = difference(expected,row[name])
+            if error is not None:
+                errors[name] = max(errors.get(name,0),error)
+
+        Observer.horizon = '0'
+        Moon = ephem.Moon(Observer)
+        errors['moon_phase'] = max(errors.get('moon_phase',0),abs(Moon.phase-row['moon_phase']))
+        if Moon.transit_alt is not None and not np.isnan(row['moon_transit_alt']):
+            errors['moon_transit_alt'] = max(errors.get('moon_transit_alt',0),\
+             abs(Moon.transit_alt-row['moon_transit_alt'])/astro.DEG)
+    return(errors)
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    import pysqm.settings as settings
+    parser = argparse.ArgumentParser(description='PySQM almanac')
+    parser.add_argument('-c','--config',default='config.py')
+    parser.add_argument('--validate',action='store_true',help='Compare with PyEphem')
+    parser.add_argument('year',type=int)
+    args = parser.parse_args()
+    settings.GlobalConfig.read_config_file(args.config)
+    config = settings.GlobalConfig.config
+    site = astro.config_site(config)
+
+    if args.validate:
+        print('Max. differences with PyEphem (s, % and deg):')
+        for name,error in sorted(validate(site,args.year,config._local_timezone).items()):
+            print('  %-18s %.3f' %(name,error))
+    else:
+        start = time.perf_counter()
+        almanac = get_almanac(site,args.year,config._local_timezone,almanac_directory(config))
+        print('Almanac of %d loaded in %.3f s' %(args.year,time.perf_counter()-start))
+        for name,value in almanac.night(datetime.date(args.year,1,1)).items():
+            print('  %-18s %s' %(name,value))
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+'''
+PySQM sun and moon positions
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Altitude of the Sun and the Moon for whole arrays of UTC times, with
+numpy (no loop over the measures).
+
+ Sun:  low precision solar coordinates (Meeus, Astronomical
+       Algorithms, ch. 25).
+ Moon: main periodic terms of the ELP-2000/82 theory (Meeus, ch. 47).
+
+Positions are topocentric (parallax from the site latitude and
+elevation) and refracted with the same atmospheric model as PyEphem
+(pressure in mbar, temperature in C; pressure=0 disables refraction).
+The site is given as in config.py (degrees, meters), altitudes are
+returned in radians, as PyEphem's alt.
+
+Differences with PyEphem 4.x (Observer with the default pressure and
+temperature, any site, years 1990-2050):
+ Sun altitude    < 0.01 deg (0.02 deg with the Sun 3-8 deg below the
+                 horizon, where PyEphem's refraction changes steeply)
+ Moon altitude   < 0.01 deg
+ Moon phase      < 0.03 % of illuminated fraction
+Check them (and the speed) with:
+> python -m pysqm.astro
+____________________________
+'''
+
+import numpy as np
+
+DEG = np.pi/180.
+ARCSEC = DEG/3600.
+# Equatorial radius of the Earth (km), flattening and astronomical unit
+EARTH_RADIUS = 6378.14
+EARTH_FLATTENING = 1./298.257
+AU = 149597870.7
+J2000 = 2451545.0
+
+# Periodic terms of the Moon (Meeus, tables 47.A and 47.B):
+# multiples of D, M, M', F and the coefficients of the sine of the
+# longitude (1e-6 deg) and the cosine of the distance (1e-3 km).
+MOON_LR = np.array([\
+ [0, 0, 1, 0, 6288774,-20905355],[2, 0,-1, 0, 1274027, -3699111],\
+ [2, 0, 0, 0,  658314, -2955968],[0, 0, 2, 0,  213618,  -569925],\
+ [0, 1, 0, 0, -185116,    48888],[0, 0, 0, 2, -114332,    -3149],\
+ [2, 0,-2, 0,   58793,   246158],[2,-1,-1, 0,   57066,  -152138],\
+ [2, 0, 1, 0,   53322,  -170733],[2,-1, 0, 0,   45758,  -204586],\
+ [0, 1,-1, 0,  -40923,  -129620],[1, 0, 0, 0,  -34720,   108743],\
+ [0, 1, 1, 0,  -30383,   104755],[2, 0, 0,-2,   15327,    10321],\
+ [0, 0, 1, 2,  -12528,        0],[0, 0, 1,-2,   10980,    79661],\
+ [4, 0,-1, 0,   10675,   -34782],[0, 0, 3, 0,   10034,   -23210],\
+ [4, 0,-2, 0,    8548,   -21636],[2, 1,-1, 0,   -7888,    24208],\
+ [2, 1, 0, 0,   -6766,    30824],[1, 0,-1, 0,   -5163,    -8379],\
+ [1, 1, 0, 0,    4987,   -16675],[2,-1, 1, 0,    4036,   -12831],\
+ [2, 0, 2, 0,    3994,   -10445],[4, 0, 0, 0,    3861,   -11650],\
+ [2, 0,-3, 0,    3665,    14403],[0, 1,-2, 0,   -2689,    -7003],\
+ [2, 0,-1, 2,   -2602,        0],[2,-1,-2, 0,    2390,    10056],\
+ [1, 0, 1, 0,   -2348,     6322],[2,-2, 0, 0,    2236,    -9884],\
+ [0, 1, 2, 0,   -2120,     5751],[0, 2, 0, 0,   -2069,        0],\
+ [2,-2,-1, 0,    2048,    -4950],[2, 0, 1,-2,   -1773,     4130],\
+ [2, 0, 0, 2,   -1595,        0],[4,-1,-1, 0,    1215,    -3958],\
+ [0, 0, 2, 2,   -1110,        0],[3, 0,-1, 0,    -892,     3258],\
+ [2, 1, 1, 0,    -810,     2616],[4,-1,-2, 0,     759,    -1897],\
+ [0, 2,-1, 0,    -713,    -2117],[2, 2,-1, 0,    -700,     2354],\
+ [2, 1,-2, 0,     691,        0],[2,-1, 0,-2,     596,        0],\
+ [4, 0, 1, 0,     549,    -1423],[0, 0, 4, 0,     537,    -1117],\
+ [4,-1, 0, 0,     520,    -1571],[1, 0,-2, 0,    -487,    -1739],\
+ [2, 1, 0,-2,    -399,        0],[0, 0, 2,-2,    -381,    -4421],\
+ [1, 1, 1, 0,     351,        0],[3, 0,-2, 0,    -340,        0],\
+ [4, 0,-3, 0,     330,        0],[2,-1, 2, 0,     327,        0],\
+ [0, 2, 1, 0,    -323,     1165],[1, 1,-1, 0,     299,        0],\
+ [2, 0, 3, 0,     294,        0],[2, 0,-1,-2,       0,     8752]])
+
+MOON_B = np.array([\
+ [0, 0, 0, 1, 5128122],[0, 0, 1, 1,  280602],[0, 0, 1,-1,  277693],\
+ [2, 0, 0,-1,  173237],[2, 0,-1, 1,   55413],[2, 0,-1,-1,   46271],\
+ [2, 0, 0, 1,   32573],[0, 0, 2, 1,   17198],[2, 0, 1,-1,    9266],\
+ [0, 0, 2,-1,    8822],[2,-1, 0,-1,    8216],[2, 0,-2,-1,    4324],\
+ [2, 0, 1, 1,    4200],[2, 1, 0,-1,   -3359],[2,-1,-1, 1,    2463],\
+ [2,-1, 0, 1,    2211],[2,-1,-1,-1,    2065],[0, 1,-1,-1,   -1870],\
+ [4, 0,-1,-1,    1828],[0, 1, 0, 1,   -1794],[0, 0, 0, 3,   -1749],\
+ [0, 1,-1, 1,   -1565],[1, 0, 0, 1,   -1491],[0, 1, 1, 1,   -1475],\
+ [0, 1, 1,-1,   -1410],[0, 1, 0,-1,   -1344],[1, 0, 0,-1,   -1335],\
+ [0, 0, 3, 1,    1107],[4, 0, 0,-1,    1021],[4, 0,-1, 1,     833],\
+ [0, 0, 1,-3,     777],[4, 0,-2, 1,     671],[2, 0, 0,-3,     607],\
+ [2, 0, 2,-1,     596],[2,-1, 1,-1,     491],[2, 0,-2, 1,    -451],\
+ [0, 0, 3,-1,     439],[2, 0, 2, 1,     422],[2, 0,-3,-1,     421],\
+ [2, 1,-1, 1,    -366],[2, 1, 0, 1,    -351],[4, 0, 0, 1,     331],\
+ [2,-1, 1, 1,     315],[2,-2, 0,-1,     302],[0, 0, 1, 3,    -283],\
+ [2, 1, 1,-1,    -229],[1, 1, 0,-1,     223],[1, 1, 0, 1,     223],\
+ [0, 1,-2,-1,    -220],[2, 1,-1,-1,    -220],[1, 0, 1, 1,    -185],\
+ [2,-1,-2,-1,     181],[0, 1, 2, 1,    -177],[4, 0,-2,-1,     176],\
+ [4,-1,-1,-1,     166],[1, 0, 1,-1,    -164],[4, 0, 1,-1,     132],\
+ [1, 0,-1,-1,    -119],[4,-1, 0,-1,     115],[2,-2, 0, 1,     107]])
+
+
+def julian_day(utc):
+    '''
+    Julian day of UTC times (datetime64, datetime or
+    ISO strings; scalars or arrays).
+    '''
+    seconds = (np.asarray(utc,dtype='datetime64[ms]')-np.datetime64(0,'ms'))\
+     /np.timedelta64(1,'s')
+    return(2440587.5+seconds/86400.)
+
+
+def delta_t(jd):
+    ''' TT-UT (days), Espenak and Meeus polynomial for 2005-2050 '''
+    years = (jd-J2000)/365.25
+    return((62.92+0.32217*years+0.005589*years**2)/86400.)
+
+
+def nutation(T):
+    ''' Nutation in longitude and obliquity (rad), main terms '''
+    omega = (125.04452-1934.136261*T)*DEG
+    sun_longitude = (280.4665+36000.7698*T)*DEG
+    moon_longitude = (218.3165+481267.8813*T)*DEG
+    dpsi = (-17.20*np.sin(omega)-1.32*np.sin(2*sun_longitude)\
+     -0.23*np.sin(2*moon_longitude)+0.21*np.sin(2*omega))*ARCSEC
+    deps = (9.20*np.cos(omega)+0.57*np.cos(2*sun_longitude)\
+     +0.10*np.cos(2*moon_longitude)-0.09*np.cos(2*omega))*ARCSEC
+    return(dpsi,deps)
+
+
+def obliquity(T):
+    ''' Mean obliquity of the ecliptic (rad) '''
+    return((23.439291111-(46.8150*T+0.00059*T**2-0.001813*T**3)/3600.)*DEG)
+
+
+def sun_ecliptic(jd):
+    '''
+    Apparent ecliptic longitude (rad) and distance (km) of the Sun
+    at the Julian days (TT) jd.
+    '''
+    T = (jd-J2000)/36525.
+    L0 = 280.46646+36000.76983*T+0.0003032*T**2
+    M = (357.52911+35999.05029*T-0.0001537*T**2)*DEG
+    e = 0.016708634-0.000042037*T-0.0000001267*T**2
+    C = (1.914602-0.004817*T-0.000014*T**2)*np.sin(M)\
+     +(0.019993-0.000101*T)*np.sin(2*M)+0.000289*np.sin(3*M)
+    true_anomaly = M+C*DEG
+    distance = 1.000001018*(1-e**2)/(1+e*np.cos(true_anomaly))*AU
+    # Aberration (-20.4898"/R) and nutation
+    dpsi,deps = nutation(T)
+    longitude = (L0+C)*DEG-20.4898*ARCSEC*AU/distance+dpsi
+    return(longitude,distance)
+
+
+def periodic_terms(table,D,M,Mp,F,E):
+    '''
+    Sums of the sine and cosine terms of a table
+    (the first axis of the arguments runs over the terms).
+    '''
+    column = lambda k: table[:,k].reshape((-1,)+(1,)*np.ndim(D))
+    arguments = (column(0)*D+column(1)*M+column(2)*Mp+column(3)*F)*DEG
+    eccentricity = E**np.abs(column(1))
+    sum_sin = (column(4)*eccentricity*np.sin(arguments)).sum(axis=0)
+    if table.shape[1]<6:
+        return(sum_sin,None)
+    sum_cos = (column(5)*eccentricity*np.cos(arguments)).sum(axis=0)
+    return(sum_sin,sum_cos)
+
+
+def moon_ecliptic(jd):
+    '''
+    Apparent ecliptic longitude, latitude (rad) and
+    distance (km) of the Moon at the Julian days (TT) jd.
+    '''
+    T = (np.asarray(jd)-J2000)/36525.
+    Lp = 218.3164477+481267.88123421*T-0.0015786*T**2+T**3/538841.
+    D = 297.8501921+445267.1114034*T-0.0018819*T**2+T**3/545868.
+    M = 357.5291092+35999.0502909*T-0.0001536*T**2
+    Mp = 134.9633964+477198.8675055*T+0.0087414*T**2+T**3/69699.
+    F = 93.2720950+483202.0175233*T-0.0036539*T**2
+    A1 = 119.75+131.849*T
+    A2 = 53.09+479264.290*T
+    A3 = 313.45+481266.484*T
+    E = 1-0.002516*T-0.0000074*T**2
+
+    sum_l,sum_r = periodic_terms(MOON_LR,D,M,Mp,F,E)
+    sum_b = periodic_terms(MOON_B,D,M,Mp,F,E)[0]
+
+    # Additive terms (Venus, Jupiter, flattening of the Earth)
+    sum_l += 3958*np.sin(A1*DEG)+1962*np.sin((Lp-F)*DEG)+318*np.sin(A2*DEG)
+    sum_b += -2235*np.sin(Lp*DEG)+382*np.sin(A3*DEG)\
+     +175*np.sin((A1-F)*DEG)+175*np.sin((A1+F)*DEG)\
+     +127*np.sin((Lp-Mp)*DEG)-115*np.sin((Lp+Mp)*DEG)
+
+    dpsi,deps = nutation(T)
+    longitude = (Lp+sum_l/1e6)*DEG+dpsi
+    latitude = sum_b/1e6*DEG
+    distance = 385000.56+sum_r/1000.
+    return(longitude,latitude,distance)
+
+
+def ecliptic_to_vector(longitude,latitude,distance,epsilon):
+    ''' Equatorial rectangular coordinates (km), one row per axis '''
+    x = np.cos(latitude)*np.cos(longitude)
+    y = np.cos(latitude)*np.sin(longitude)
+    z = np.sin(latitude)
+    return(distance*np.array([x,\
+     y*np.cos(epsilon)-z*np.sin(epsilon),\
+     y*np.sin(epsilon)+z*np.cos(epsilon)]))
+
+
+def sidereal_time(jd_ut,dpsi,epsilon):
+    ''' Greenwich apparent sidereal time (rad) '''
+    T = (jd_ut-J2000)/36525.
+    gmst = 280.46061837+360.98564736629*(jd_ut-J2000)\
+     +0.000387933*T**2-T**3/38710000.
+    return(gmst*DEG+dpsi*np.cos(epsilon))
+
+
+def refraction(altitude,pressure=1010.,temperature=15.):
+    '''
+    Apparent altitude (rad) of true altitudes, with the
+    model of PyEphem (libastro refract.c).
+    '''
+    altitude = np.array(altitude,dtype=float)
+    if pressure<=0:
+        return(altitude)
+
+    def unrefract(apparent):
+        degrees = apparent/DEG
+        low = ((2e-5*degrees+1.96e-2)*degrees+1.594e-1)*pressure/\
+         ((273+temperature)*((8.45e-2*degrees+5.05e-1)*degrees+1))*DEG
+        low = np.where((apparent<0)*(low<0),0.,low)
+        with np.errstate(divide='ignore'):
+            high = 7.888888e-5*pressure/((273+temperature)*np.tan(apparent))
+        return(apparent-np.where(apparent<15*DEG,low,high))
+
+    # Same secant iteration as PyEphem, only on the altitudes not
+    # converged yet (most of them, far below the horizon, never move)
+    apparent = altitude.reshape(-1)
+    target = apparent.copy()
+    true = unrefract(target)
+    step = 0.8*(target-true)
+    previous = true
+    pending = np.flatnonzero(step!=0)
+    step,previous = step[pending],previous[pending]
+    for iteration in range(50):
+        if len(pending)==0:
+            break
+        apparent[pending] += step
+        true = unrefract(apparent[pending])
+        error = target[pending]-true
+        converged = np.abs(error)<=0.1*ARCSEC
+        with np.errstate(divide='ignore',invalid='ignore'):
+            step = -step*error/(previous-true)
+        pending,step,previous = [values[~converged] for values in (pending,step,true)]
+    return(apparent.reshape(np.shape(altitude)))
+
+
+class Site(object):
+    '''
+    Observing site, in the units of config.py (latitude and
+    longitude in degrees, elevation in meters). Pressure (mbar)
+    and temperature (C) are used for the refraction, the
+    defaults are the same of ephem.Observer.
+    '''
+    def __init__(self,latitude,longitude,elevation=0.,pressure=1010.,temperature=15.):
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.elevation = float(elevation)
+        self.pressure = float(pressure)
+        self.temperature = float(temperature)
+
+        # Geocentric position of the site (km), at sidereal time 0
+        phi = self.latitude*DEG
+        u = np.arctan((1-EARTH_FLATTENING)*np.tan(phi))
+        height = self.elevation/1000./EARTH_RADIUS
+        self.rho_sin = ((1-EARTH_FLATTENING)*np.sin(u)+height*np.sin(phi))*EARTH_RADIUS
+        self.rho_cos = (np.cos(u)+height*np.cos(phi))*EARTH_RADIUS
+
+    def key(self):
+        return((round(self.latitude,6),round(self.longitude,6),round(self.elevation,1)))
+
+    def altitude(self,vector,sidereal):
+        '''
+        Refracted topocentric altitude (rad) of geocentric
+        vectors, at the Greenwich sidereal times.
+        '''
+        theta = sidereal+self.longitude*DEG
+        phi = self.latitude*DEG
+        topocentric = vector-np.array([\
+         self.rho_cos*np.cos(theta),self.rho_cos*np.sin(theta),\
+         self.rho_sin*np.ones(np.shape(theta))])
+        up = np.array([np.cos(phi)*np.cos(theta),\
+         np.cos(phi)*np.sin(theta),np.sin(phi)*np.ones(np.shape(theta))])
+        sine = (topocentric*up).sum(axis=0)/np.sqrt((topocentric**2).sum(axis=0))
+        return(refraction(np.arcsin(sine),self.pressure,self.temperature))
+
+
+def observer_site(Observer):
+    ''' Site of an ephem.Observer '''
+    return(Site(Observer.lat/DEG,Observer.lon/DEG,Observer.elev,\
+     Observer.pressure,Observer.temp))
+
+
+def config_site(config):
+    ''' Site in config.py '''
+    return(Site(config._observatory_latitude,config._observatory_longitude,\
+     config._observatory_altitude))
+
+
+def true_obliquity(jd):
+    ''' Nutation in longitude and true obliquity (rad) '''
+    T = (jd-J2000)/36525.
+    dpsi,deps = nutation(T)
+    return(dpsi,obliquity(T)+deps)
+
+
+def interpolated(function,jd,step=1/24.):
+    '''
+    function(jd) for many times: it is evaluated on a grid of
+    step days and interpolated. Only for slowly changing values
+    (positions in the ecliptic, nutation); the longitudes are
+    not wrapped, so they can be interpolated directly.
+    '''
+    jd = np.asarray(jd,dtype=float)
+    if jd.size<2:
+        return(function(jd))
+    grid = np.arange(np.floor(jd.min()/step),np.ceil(jd.max()/step)+1)*step
+    if grid.size*4>jd.size:
+        return(function(jd))
+    return([np.interp(jd,grid,values) for values in function(grid)])
+
+
+def _julian_days(utc):
+    ''' UT and TT Julian days '''
+    jd_ut = julian_day(utc)
+    return(jd_ut,jd_ut+delta_t(jd_ut))
+
+
+def _sun(jd):
+    return(tuple(sun_ecliptic(jd))+true_obliquity(jd))
+
+
+def _moon(jd):
+    return(tuple(moon_ecliptic(jd))+true_obliquity(jd))
+
+
+def sun_altitude(utc,site):
+    ''' Altitude (rad) of the Sun at the UTC times from the site '''
+    jd_ut,jd = _julian_days(utc)
+    longitude,distance,dpsi,epsilon = interpolated(_sun,jd)
+    vector = ecliptic_to_vector(longitude,0.,distance,epsilon)
+    return(site.altitude(vector,sidereal_time(jd_ut,dpsi,epsilon)))
+
+
+def moon_altitude(utc,site):
+    ''' Altitude (rad) of the Moon at the UTC times from the site '''
+    jd_ut,jd = _julian_days(utc)
+    longitude,latitude,distance,dpsi,epsilon = interpolated(_moon,jd)
+    vector = ecliptic_to_vector(longitude,latitude,distance,epsilon)
+    return(site.altitude(vector,sidereal_time(jd_ut,dpsi,epsilon)))
+
+
+def moon_phase(utc):
+    ''' Illuminated fraction of the Moon (%, as PyEphem's phase) '''
+    jd_ut,jd = _julian_days(utc)
+    sun_longitude,sun_distance = interpolated(sun_ecliptic,jd)
+    longitude,latitude,distance = interpolated(moon_ecliptic,jd)
+    elongation = np.arccos(np.cos(latitude)*np.cos(longitude-sun_longitude))
+    phase_angle = np.arctan2(sun_distance*np.sin(elongation),\
+     distance-sun_distance*np.cos(elongation))
+    return(50.*(1+np.cos(phase_angle)))
+
+
+def validate(number=20000,seed=0):
+    '''
+    Maximum differences with PyEphem (deg and %) at random
+    times (1990-2050) and sites (latitudes -65 to 65 deg).
+    See the tolerances in the notes at the top.
+    '''
+    import ephem
+    random = np.random.RandomState(seed)
+    start = np.datetime64('1990-01-01T00:00:00','s')
+    span = int((np.datetime64('2050-01-01T00:00:00','s')-start)/np.timedelta64(1,'s'))
+    utc = start+random.randint(0,span,number).astype('timedelta64[s]')
+    latitudes = random.uniform(-65,65,number)
+    longitudes = random.uniform(-180,180,number)
+    elevations = random.uniform(0,3000,number)
+
+    errors = {'sun_altitude':0.,'moon_altitude':0.,'moon_phase':0.}
+    Observer = ephem.Observer()
+    Sun,Moon = ephem.Sun(),ephem.Moon()
+    for k in range(number):
+        Observer.lat,Observer.lon = latitudes[k]*DEG,longitudes[k]*DEG
+        Observer.elev = elevations[k]
+        Observer.date = ephem.Date(utc[k].astype(object))
+        Sun.compute(Observer)
+        Moon.compute(Observer)
+        site = observer_site(Observer)
+        for name,value,reference in [\
+         ('sun_altitude',sun_altitude(utc[k],site)/DEG,Sun.alt/DEG),\
+         ('moon_altitude',moon_altitude(utc[k],site)/DEG,Moon.alt/DEG),\
+         ('moon_phase',moon_phase(utc[k]),Moon.phase)]:
+            errors[name] = max(errors[name],abs(float(value)-reference))
+    return(errors)
+
+
+if __name__ == '__main__':
+    import time
+    import ephem
+    print('Max. differences with PyEphem:')
+    for name,error in validate(2000).items():
+        print('  %-14s %.4f' %(name,error))
+
+    # A month of measures every 20 s
+    site = Site(40.447862,-3.364992,680)
+    utc = np.datetime64('2024-01-01T00:00:00')+\
+     np.arange(0,31*86400,20).astype('timedelta64[s]')
+    for function in [sun_altitude,moon_altitude]:
+        start = time.perf_counter()
+        altitudes = function(utc,site)
+        elapsed = time.perf_counter()-start
+        # Without the interpolation of the ecliptic positions
+        exact = np.array([function(utc[k],site) for k in range(0,len(utc),97)])
+        print('%s, %d times: %.3f s (interpolation error %.5f deg)' \
+         %(function.__name__,len(utc),elapsed,np.max(np.abs(altitudes[::97]-exact))/DEG))
+
+    Observer = ephem.Observer()
+    Observer.lat,Observer.lon,Observer.elev = site.latitude*DEG,site.longitude*DEG,site.elevation
+    Sun = ephem.Sun()
+    start = time.perf_counter()
+    for utcdatetime in utc.astype(object):
+        Observer.date = ephem.date(utcdatetime)
+        Sun.compute(Observer)
+    print('PyEphem Sun, %d times: %.3f s' %(len(utc),time.perf_counter()-start))
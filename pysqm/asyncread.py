@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+'''
+PySQM asynchronous reading program
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Acquisition engine for stations with many SQM-LE photometers.
+All the devices are polled concurrently from a single asyncio
+event loop, so one cycle costs roughly one device round-trip.
+Each device keeps its own data files (same format as pysqm.read),
+written by a separate thread so the event loop never waits for the disk.
+Devices are initialized in the background, and polled once ready.
+Those that cannot be initialized are retried (with the reconnection
+backoff) while the others are polled.
+
+Usage:
+> python -m pysqm.asyncread -c config.py
+
+with _device_addrs = ['192.168.1.10','192.168.1.11',...] in config.py
+(or _device_addrs = 'auto' to use every SQM-LE found in the LAN)
+____________________________
+'''
+
+import sys
+import time
+import asyncio
+import concurrent.futures
+import datetime
+
+'''
+Read configuration (if not already done by the caller)
+'''
+import pysqm.settings as settings
+if settings.GlobalConfig.config is None:
+    InputArguments = settings.ArgParser()
+    settings.GlobalConfig.read_config_file(InputArguments.config)
+config = settings.GlobalConfig.config
+
+from pysqm.read import *
+
+
+class AsyncSQMLE(SQM):
+    '''
+    SQM-LE photometer driven by asyncio streams.
+    Uses the same rx/ix/cx protocol (port 10001) as SQMLE,
+    but never blocks the event loop.
+    '''
+    def __init__(self,addr,port=10001,name=None,timeout=5):
+        self.addr = addr
+        self.port = int(port)
+        self.name = name
+        self.timeout = timeout
+        self.stream_reader = None
+        self.stream_writer = None
+
+    async def start_connection(self):
+        ''' Start photometer connection '''
+        self.stream_reader,self.stream_writer = await asyncio.wait_for(\
+         asyncio.open_connection(self.addr,self.port),self.timeout)
+
+    async def close_connection(self):
+        ''' End photometer connection '''
+        if self.stream_writer is None:
+            return
+        self.stream_writer.close()
+        try: await self.stream_writer.wait_closed()
+        except Exception: pass
+        self.stream_reader,self.stream_writer = None,None
+
+    async def reset_device(self):
+        ''' Connection reset '''
+        await self.close_connection()
+        await self.start_connection()
+
+    async def query(self,command):
+        ''' Send a command and wait for a complete reply '''
+        self.stream_writer.write(command)
+        await self.stream_writer.drain()
+        msg = await asyncio.wait_for(\
+         self.stream_reader.readuntil(b'\n'),self.timeout)
+        msg = msg.decode()
+        if self.fault_injector is not None:
+            msg = await self.fault_injector.inject(msg)
+        return(msg)
+
+    async def resync(self):
+        ''' Discard pending bytes, keep the connection '''
+        try:
+            while await asyncio.wait_for(self.stream_reader.read(255),0.05):
+                pass
+        except asyncio.TimeoutError:
+            pass
+
+    async def read_checked(self,command,check,tries=1):
+        '''
+        Send command until the reply passes check(msg).
+        Return the reply or -1 after the given number of tries.
+        '''
+        link = self.link_state()
+        msg = None
+
+        for attempt in range(tries):
+            try:
+                msg = await self.query(command)
+                check(msg)
+            except Exception:
+                action = link.failure()
+                if attempt==tries-1:
+                    break
+                await asyncio.sleep(link.backoff())
+                try:
+                    if action==ConnectionState.RESYNC:
+                        await self.resync()
+                    else:
+                        await self.reset_device()
+                except Exception:
+                    pass
+            else:
+                link.success()
+                return(msg)
+
+        link.give_up()
+        print('ERR. Reading the photometer %s!: %s' %(self.addr,str(msg)))
+        return(-1)
+
+    async def read_metadata(self,tries=1):
+        ''' Read the serial number, firmware version '''
+        def check(msg):
+            self.metadata_process(msg)
+        return(await self.read_checked(b'ix',check,tries))
+
+    async def read_calibration(self,tries=1):
+        ''' Read the calibration parameters '''
+        def check(msg):
+            parse_cx(msg)
+        return(await self.read_checked(b'cx',check,tries))
+
+    async def read_data(self,tries=1):
+        ''' Read the SQM and format the Temperature, Frequency and NSB measures '''
+        def check(msg):
+            self.last_data = self.data_process(msg)
+        return(await self.read_checked(b'rx',check,tries))
+
+    async def start(self,tries=10):
+        ''' Connect and read the test data (ix,cx,rx) '''
+        await self.start_connection()
+        self.ix_readout = await self.read_metadata(tries)
+        if self.ix_readout==-1:
+            raise IOError('No valid metadata (ix) from the photometer')
+        self.cx_readout = await self.read_calibration(tries)
+        if self.cx_readout==-1:
+            raise IOError('No valid calibration (cx) from the photometer')
+        self.rx_readout = await self.read_data(tries)
+        if self.rx_readout==-1:
+            raise IOError('No valid data (rx) from the photometer')
+        print('Device %s: serial number %s' %(self.addr,str(self.serial_number)))
+
+    async def read_photometer(self,Nmeasures=1,PauseMeasures=2):
+        ''' As SQM.read_photometer, without blocking the event loop '''
+        samples = []
+        Nremaining = Nmeasures
+
+        # Promediate N measures to remove jitter
+        timeutc_initial = self.read_datetime()
+        while(Nremaining>0):
+            InitialDateTime = datetime.datetime.now()
+
+            # Get the raw data from the photometer and process it.
+            raw_data = await self.read_data(tries=10)
+            if raw_data==-1:
+                raise IOError('No valid data from the photometer')
+            samples    += [self.last_data]
+            Nremaining -= 1
+            DeltaSeconds = (datetime.datetime.now()-InitialDateTime).total_seconds()
+
+            if (Nremaining>0):
+                await asyncio.sleep(max(1,PauseMeasures-DeltaSeconds))
+
+        return(self.promediate(timeutc_initial,self.read_datetime(),samples))
+
+
+class AcquisitionEngine(object):
+    '''
+    Poll a list of AsyncSQMLE devices concurrently and
+    save their data with the usual format_content/data_cache path.
+    '''
+    def __init__(self,devices,probe_timeout=10):
+        self.devices = devices
+        self.active  = []
+        self.pending = []
+        self.starting = []
+        self.probe_timeout = probe_timeout
+        self.niter   = 0
+        # File writes, out of the event loop (one thread keeps the order)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        '''
+        Initialize the devices in the background: each one is polled
+        as soon as it is ready, the failed ones are tried again
+        without delaying the others.
+        '''
+        self.active = []
+        self.pending = list(self.devices)
+        self.starting = [asyncio.create_task(self.start_device(dev)) \
+         for dev in self.devices]
+
+    async def probe(self,dev):
+        ''' Initialize dev (one try of each command, bounded time) '''
+        try:
+            await asyncio.wait_for(dev.start(tries=1),self.probe_timeout)
+        except Exception as ex:
+            if isinstance(ex,asyncio.TimeoutError):
+                ex = 'no reply in %.1f s' %self.probe_timeout
+            print('ERR. Cannot initialize device %s: %s' %(dev.addr,str(ex)))
+            try: await dev.close_connection()
+            except Exception: pass
+            return(False)
+        return(True)
+
+    async def start_device(self,dev):
+        ''' Try to initialize dev until it works (reconnection backoff) '''
+        link = dev.link_state()
+        while not await self.probe(dev):
+            link.failure()
+            await asyncio.sleep(link.backoff())
+        link.success()
+        self.pending.remove(dev)
+        self.active.append(dev)
+
+    async def poll_device(self,dev,Nmeasures,PauseMeasures):
+        ''' Take a (promediated) measure from one device and save it '''
+        try:
+            measure = await dev.read_photometer(\
+             Nmeasures=Nmeasures,PauseMeasures=PauseMeasures)
+        except Exception as ex:
+            print('Connection lost with %s: %s' %(dev.addr,str(ex)))
+            try: await dev.reset_device()
+            except Exception: pass
+            return(None)
+
+        formatted_data = dev.format_content(*measure)
+        await asyncio.get_running_loop().run_in_executor(\
+         self.executor,self.save,dev,formatted_data,self.niter)
+        return(formatted_data)
+
+    def save(self,dev,formatted_data,niter):
+        ''' Save a measure to the files of dev (in the executor) '''
+        dev.define_filenames()
+        dev.data_cache(formatted_data,\
+         number_measures=config._cache_measures,niter=niter)
+
+    async def cycle(self,Nmeasures=1,PauseMeasures=2):
+        ''' One acquisition cycle over all the active devices '''
+        self.niter += 1
+        return(await asyncio.gather(*[\
+         self.poll_device(dev,Nmeasures,PauseMeasures) \
+         for dev in self.active]))
+
+    async def run(self,Nmeasures=1,PauseMeasures=2,delay=20):
+        ''' Work as a daemon '''
+        self.start()
+        print('Starting readings (%d devices) ...' %len(self.devices))
+        while 1<2:
+            if len(self.active)==0:
+                # None ready yet, do not wait a whole cycle
+                await asyncio.sleep(1)
+                continue
+            StartTime = time.time()
+            await self.cycle(Nmeasures,PauseMeasures)
+            DeltaSeconds = time.time()-StartTime
+            await asyncio.sleep(max(1,delay-DeltaSeconds))
+
+
+def devices_from_config():
+    '''
+    Build the AsyncSQMLE list from config._device_addrs.
+    With _device_addrs = 'auto', use all the devices found in the LAN.
+    '''
+    try: addrs = config._device_addrs
+    except AttributeError: addrs = [config._device_addr]
+
+    if addrs == 'auto':
+        addrs = [addr for addr,mac in search_sqmle()]
+
+    devices = []
+    for k,addr in enumerate(addrs):
+        # Allow 'host' or 'host:port'
+        host,_,port = str(addr).partition(':')
+        name = None if len(addrs)==1 else str(k+1)
+        devices.append(AsyncSQMLE(host,port=port or 10001,name=name))
+    return(devices)
+
+
+def loop():
+    engine = AcquisitionEngine(devices_from_config())
+    asyncio.run(engine.run(\
+     Nmeasures=config._measures_to_promediate,PauseMeasures=10,\
+     delay=config._delay_between_measures))
+
+
+if __name__ == '__main__':
+    loop()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+'''
+PySQM checkpoint
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+State of the main loop (counters, measures not yet written, device
+metadata) saved after every measure to a small JSON file. The file is
+replaced atomically, so after a crash it holds either the previous or
+the new state, never a mix. On restart the loop resumes from it and
+the device is reopened without the initial handshake.
+____________________________
+'''
+
+import os
+import json
+import time
+
+
+class Checkpoint(object):
+    def __init__(self,filename,fsync=True):
+        self.filename = filename
+        self.fsync = fsync
+
+    def save(self,state):
+        state = dict(state,time=time.time())
+        temporary = self.filename+'.tmp'
+        with open(temporary,'w') as fstate:
+            json.dump(state,fstate)
+            if self.fsync:
+                fstate.flush()
+                os.fsync(fstate.fileno())
+        os.replace(temporary,self.filename)
+
+    def load(self,max_age=None):
+        '''
+        Return the saved state (None if there is no valid
+        state or it is older than max_age seconds).
+        '''
+        try:
+            with open(self.filename,'r') as fstate:
+                state = json.load(fstate)
+        except (OSError,ValueError):
+            return(None)
+        if max_age is not None and time.time()-state.get('time',0)>max_age:
+            return(None)
+        return(state)
+
+    def clear(self):
+        try: os.remove(self.filename)
+        except FileNotFoundError: pass
+
+
+def checkpoint_filename(config):
+    try: filename = config._checkpoint_file
+    except AttributeError: filename = None
+    if filename is None:
+        filename = os.path.join(config.monthly_data_directory,'pysqm.state')
+    return(filename)
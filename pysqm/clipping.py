@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+'''
+PySQM outlier clipping
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+'''
+
+import numpy as np
+
+# Scale factor to convert the MAD to a gaussian sigma
+MAD_TO_SIGMA = 1.4826
+
+
+def clipped_mean(data,sigma=3,max_dev=0.2,method='std',verbose=True):
+    '''
+    Clip outliers and average, for many series at once.
+
+    data has shape (..., M, K): M samples of K quantities, for any
+    number of leading dimensions (e.g. N devices x M samples x K quantities).
+    Missing samples can be given as NaN.
+
+    For each series (clipped along the M axis):
+     - center: median of the samples
+     - dispersion: std (method='std') or 1.4826*MAD (method='mad')
+     - a sample is kept if |x-median| <= min(max_dev*median, sigma*dispersion+0.1)
+     - the result is the mean of the kept samples (or the median if none is kept)
+
+    Return (means, mask):
+     means has shape (..., K), mask (same shape as data) is True for
+     the samples used in the mean.
+    '''
+    data = np.asarray(data,dtype=float)
+    if np.isnan(data).any():
+        median,std = np.nanmedian,np.nanstd
+    else:
+        median,std = np.median,np.std
+
+    # Get the median and dispersion.
+    data_median = median(data,axis=-2,keepdims=True)
+    if method == 'mad':
+        data_std = MAD_TO_SIGMA*median(np.abs(data-data_median),axis=-2,keepdims=True)
+    elif method == 'std':
+        data_std = std(data,axis=-2,keepdims=True)
+    else:
+        raise ValueError("method is one of 'std', 'mad'")
+
+    # Max discrepancy we allow.
+    clip_deviation = np.minimum(max_dev*data_median,data_std*sigma+0.1)
+
+    # NaN never passes the filter
+    mask = np.abs(data-data_median)<=clip_deviation
+
+    # Mean of filtered data or the median.
+    count = np.sum(mask,axis=-2)
+    total = np.sum(np.where(mask,data,0.),axis=-2)
+    data_median = data_median[...,0,:]
+    means = np.where(count>0,total/np.maximum(count,1),data_median)
+
+    if verbose and np.any(count==0):
+        print('Warning: High dispersion found on last measures')
+
+    return(means,mask)
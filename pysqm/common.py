@@ -84,9 +84,8 @@ class observatory(object):
 
     def calculate_sun_altitude(self,OBS,timeutc):
         # Calculate Sun altitude
-        OBS.date = ephem.date(timeutc)
-        Sun = ephem.Sun(OBS)
-        return(Sun.alt)
+        from pysqm.astro import sun_altitude,observer_site
+        return(float(sun_altitude(timeutc,observer_site(OBS))))
 
     def next_sunset(self,OBS):
         # Next sunset calculation
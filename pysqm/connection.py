@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+'''
+PySQM connection manager
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+'''
+
+import time
+import socket
+import threading
+
+
+class SQMLEConnection(object):
+    '''
+    Long-lived TCP connection to a SQM-LE.
+     - TCP keepalive is enabled, so dead links are detected by the kernel.
+     - When idle, the device is probed periodically with a short 'ix'.
+     - A broken connection is reopened by a background thread, so the
+       reader only waits for a (fast) reconnection, not for a full timeout.
+    '''
+    def __init__(self,addr,port=10001,connect_timeout=3,\
+     probe_interval=60,probe_timeout=5):
+        self.addr = addr
+        self.port = int(port)
+        self.connect_timeout = connect_timeout
+        self.probe_interval  = probe_interval
+        self.probe_timeout   = probe_timeout
+
+        self.sock = None
+        self.lock = threading.RLock()
+        self.connected = threading.Event()
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+        self.last_activity = time.time()
+        self.reconnections = 0
+
+    def set_keepalive(self,sock,idle=10,interval=5,count=3):
+        ''' Enable TCP keepalive (with short timers if the OS allows it) '''
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+        if hasattr(socket,'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPIDLE,idle)
+        elif hasattr(socket,'TCP_KEEPALIVE'):
+            # MacOS
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPALIVE,idle)
+        if hasattr(socket,'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPINTVL,interval)
+        if hasattr(socket,'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPCNT,count)
+        if hasattr(socket,'SIO_KEEPALIVE_VALS'):
+            # Windows
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS,(1,idle*1000,interval*1000))
+
+    def connect(self):
+        ''' Open a new socket to the device '''
+        sock = socket.create_connection(\
+         (self.addr,self.port),timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.set_keepalive(sock)
+
+        with self.lock:
+            self.drop_socket()
+            self.sock = sock
+            self.last_activity = time.time()
+            self.connected.set()
+
+    def open(self):
+        ''' First connection (raises if the device is not reachable) '''
+        self.connect()
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    def drop_socket(self):
+        ''' Close the current socket without waiting for pending data '''
+        self.connected.clear()
+        if self.sock is not None:
+            try: self.sock.close()
+            except OSError: pass
+            self.sock = None
+
+    def mark_broken(self):
+        ''' Close the connection and let the background thread reopen it '''
+        with self.lock:
+            self.drop_socket()
+        self.wakeup.set()
+
+    def wait_connected(self,timeout=None):
+        if timeout is None:
+            timeout = self.connect_timeout
+        return(self.connected.wait(timeout))
+
+    def close(self):
+        ''' Stop the background thread and close the connection '''
+        self.running = False
+        self.wakeup.set()
+        with self.lock:
+            self.drop_socket()
+
+    def send(self,data):
+        if not self.wait_connected():
+            raise ConnectionError('Not connected to %s' %self.addr)
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            self.mark_broken()
+            raise
+        self.last_activity = time.time()
+
+    def recv(self,timeout,size=255):
+        ''' Return the bytes received within timeout (b'' if none) '''
+        if not self.wait_connected(timeout):
+            return(b'')
+        try:
+            self.sock.settimeout(timeout)
+            chunk = self.sock.recv(size)
+        except (socket.timeout,BlockingIOError):
+            # Nothing received (timeout 0 does not wait at all)
+            return(b'')
+        except OSError:
+            self.mark_broken()
+            raise
+        if chunk == b'':
+            self.mark_broken()
+            raise ConnectionAbortedError('Connection closed by the device')
+        self.last_activity = time.time()
+        return(chunk)
+
+    def probe(self):
+        ''' Check that the device still answers '''
+        with self.lock:
+            if self.sock is None:
+                return(False)
+            try:
+                self.sock.settimeout(self.probe_timeout)
+                self.sock.sendall(b'ix')
+                reply = b''
+                while b'\n' not in reply:
+                    chunk = self.sock.recv(255)
+                    if chunk == b'':
+                        return(False)
+                    reply += chunk
+            except OSError:
+                return(False)
+            self.last_activity = time.time()
+            return(b'i,' in reply)
+
+    def run(self):
+        ''' Background thread: reconnect and health probing '''
+        backoff = 0.05
+        while self.running:
+            if not self.connected.is_set():
+                try:
+                    self.connect()
+                except OSError:
+                    time.sleep(backoff)
+                    backoff = min(backoff*2,self.probe_interval)
+                    continue
+                self.reconnections += 1
+                backoff = 0.05
+
+            self.wakeup.wait(self.probe_interval)
+            self.wakeup.clear()
+            if not self.running:
+                break
+
+            idle = time.time()-self.last_activity
+            if self.connected.is_set() and idle>=self.probe_interval:
+                if not self.probe():
+                    self.mark_broken()
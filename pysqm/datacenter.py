@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+'''
+PySQM data center uplink
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Records for the data center:
+ DEV_ID;;C;;           new data file (followed by the header lines)
+ DEV_ID;;D;;<line>     one line of the data file
+They are queued on disk (pysqm.spool) and sent by a background thread.
+Each record is sent in its own connection, as the data center expects
+('record' protocol), and removed from the queue once sent, so nothing
+is lost if the link (or the program) stops.
+
+The 'batch' protocol is only for receivers that support it (e.g. the
+local one below), given with _datacenter_host: the records are sent
+over a persistent TCP connection, in batches ending with
+ DEV_ID;;B;;<number of records>
+and the receiver answers 'OK <number of records>' once it has stored
+them. Enabled with _datacenter_protocol = 'batch'.
+
+Local receiver, to test the uplink without the data center:
+> python -m pysqm.datacenter --receiver --port 8739 --output /tmp/dc
+
+Throughput and time to drain a backlog of 100000 records:
+> python -m pysqm.datacenter --benchmark 100000
+____________________________
+'''
+
+import os,sys
+import time
+import socket
+import asyncio
+import threading
+import argparse
+
+from pysqm.spool import DiskQueue
+
+# Connection details (hardcoded to avoid user changes)
+DC_HOST = "muon.gae.ucm.es"
+DC_PORT = 8739
+
+
+class DatacenterSender(object):
+    '''
+    Send the queued records to the data center.
+    '''
+    def __init__(self,spool_filename,dev_id,host=DC_HOST,port=DC_PORT,\
+     protocol='record',batch=1000,timeout=30,retry_min=1,retry_max=600):
+        if protocol not in ('record','batch'):
+            raise ValueError('Unknown data center protocol '+str(protocol))
+        self.dev_id = dev_id
+        self.protocol = protocol
+        self.host = host
+        self.port = port
+        self.batch = batch
+        self.timeout = timeout
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.spool = DiskQueue(spool_filename)
+        self.sock = None
+        self.reader = None
+        self.sent = 0
+        self.online = True
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def put(self,formatted_data):
+        ''' Queue the data lines '''
+        self.spool.put([self.dev_id+';;D;;'+line+'\n' \
+         for line in formatted_data.splitlines() if line])
+        self.wakeup.set()
+
+    def put_header(self,header):
+        ''' Queue a new data file (and its header) '''
+        self.spool.put([self.dev_id+';;C;;\n']+\
+         [self.dev_id+';;D;;'+line+'\n' for line in header.splitlines()])
+        self.wakeup.set()
+
+    def connect(self):
+        if self.sock is None:
+            sock = socket.create_connection((self.host,self.port),timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+            self.sock = sock
+            self.reader = sock.makefile('rb')
+
+    def disconnect(self):
+        if self.sock is not None:
+            for closable in (self.reader,self.sock):
+                try: closable.close()
+                except OSError: pass
+            self.sock = None
+            self.reader = None
+
+    def send_record(self,record):
+        ''' Send one record in its own connection (record protocol) '''
+        if record.split(';;',2)[1]=='C':
+            record = record.rstrip('\n')
+        sock = socket.create_connection((self.host,self.port),timeout=self.timeout)
+        try:
+            sock.sendall(record.encode())
+            sock.shutdown(socket.SHUT_RDWR)
+        finally:
+            sock.close()
+
+    def send_records(self,records,position):
+        '''
+        Send the records, one by one. Each record is removed from
+        the queue once sent, so it is not sent again after a failure.
+        '''
+        start = position-sum(len(record.encode()) for record in records)
+        for record in records:
+            self.send_record(record)
+            start += len(record.encode())
+            self.spool.ack(start)
+            self.sent += 1
+
+    def send_batch(self,records):
+        ''' Send the records, wait for the receiver to acknowledge them '''
+        self.connect()
+        end = '%s;;B;;%d\n' %(self.dev_id,len(records))
+        self.sock.sendall((''.join(records)+end).encode())
+        reply = self.reader.readline().decode().split()
+        if reply!=['OK',str(len(records))]:
+            raise ConnectionError('Unexpected reply from the data center: %r' %reply)
+
+    def send_pending(self):
+        ''' Send the queue. Return False if the link failed. '''
+        while self.running:
+            records,position = self.spool.get(self.batch)
+            if len(records)==0:
+                return(True)
+            try:
+                if self.protocol=='batch':
+                    self.send_batch(records)
+                else:
+                    self.send_records(records,position)
+            except OSError as ex:
+                if self.online:
+                    print('Data center not available (%d bytes queued): %s' \
+                     %(self.spool.pending(),str(ex)))
+                self.online = False
+                self.disconnect()
+                return(False)
+            self.online = True
+            if self.protocol=='batch':
+                self.spool.ack(position)
+                self.sent += len(records)
+        return(True)
+
+    def run(self):
+        retry = self.retry_min
+        while self.running:
+            if self.send_pending():
+                retry = self.retry_min
+                self.wakeup.wait()
+                self.wakeup.clear()
+            else:
+                # New records do not shorten the wait
+                self.stopped.wait(retry)
+                retry = min(2*retry,self.retry_max)
+
+    def drain(self,timeout=None):
+        ''' Wait until the queue is empty. Return False on timeout. '''
+        start = time.time()
+        while self.spool.pending()>0:
+            if timeout is not None and time.time()-start>timeout:
+                return(False)
+            time.sleep(0.01)
+        return(True)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.stopped.set()
+        self.thread.join()
+        self.disconnect()
+        self.spool.close()
+
+
+def datacenter_sender(config,dev_id,name=None):
+    '''
+    Sender with the settings in config. The batch protocol is not
+    supported by the data center: it needs an explicit _datacenter_host.
+    Named devices (see pysqm.supervisor) have their own queue.
+    '''
+    try: spool_filename = config._datacenter_spool
+    except AttributeError: spool_filename = None
+    if spool_filename is None:
+        spool_filename = os.path.join(config.monthly_data_directory,'datacenter.spool')
+    if name is not None:
+        root,extension = os.path.splitext(spool_filename)
+        spool_filename = root+'_'+str(name)+extension
+    try: protocol = config._datacenter_protocol
+    except AttributeError: protocol = 'record'
+    try: host = config._datacenter_host
+    except AttributeError: host = None
+    if host is None:
+        if protocol=='batch':
+            raise ValueError('The batch protocol needs _datacenter_host')
+        host = DC_HOST
+    try: port = config._datacenter_port
+    except AttributeError: port = None
+    return(DatacenterSender(spool_filename,dev_id,host=host,\
+     port=port or DC_PORT,protocol=protocol))
+
+
+class Receiver(object):
+    '''
+    Stand-in data center. Stores the data lines of each DEV_ID in
+    <output>/<DEV_ID>.dat (if output is given) and acknowledges the batches.
+    '''
+    def __init__(self,output=None):
+        self.output = output
+        self.files = {}
+        self.received = 0
+        self.batches = 0
+
+    def store(self,dev_id,kind,content):
+        if self.output is None or kind not in ('C','D'):
+            return
+        if dev_id not in self.files:
+            self.files[dev_id] = open(os.path.join(self.output,dev_id+'.dat'),'a')
+        if kind=='D':
+            self.files[dev_id].write(content+'\n')
+
+    async def handle(self,reader,writer):
+        count = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = line.decode().rstrip('\n').split(';;',2)
+                if len(fields)!=3:
+                    continue
+                dev_id,kind,content = fields
+                if kind=='B':
+                    for datafile in self.files.values():
+                        datafile.flush()
+                    self.batches += 1
+                    writer.write(('OK %d\n' %count).encode())
+                    await writer.drain()
+                    count = 0
+                    continue
+                self.store(dev_id,kind,content)
+                count += 1
+                self.received += 1
+        except ConnectionError:
+            pass
+        finally:
+            for datafile in self.files.values():
+                datafile.flush()
+            writer.close()
+
+    async def start(self,host='127.0.0.1',port=DC_PORT):
+        if self.output is not None and not os.path.isdir(self.output):
+            os.makedirs(self.output)
+        self.server = await asyncio.start_server(self.handle,host,port)
+        return(self.server.sockets[0].getsockname()[1])
+
+
+def benchmark(nrecords=100000,batch=1000):
+    '''
+    Fill a queue with nrecords while the receiver is down, then start
+    it and measure the time to drain the backlog.
+    '''
+    import tempfile
+    line = '2024-01-15T22:00:00.000;2024-01-15T23:00:00.000;12.30;1.000;150.123;20.123\n'
+
+    receiver = Receiver()
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(receiver.start(port=0))
+    receiver.server.close()
+    loop.run_until_complete(receiver.server.wait_closed())
+    threading.Thread(target=loop.run_forever,daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        sender = DatacenterSender(os.path.join(directory,'dc.spool'),'bench',\
+         host='127.0.0.1',port=port,protocol='batch',batch=batch,\
+         retry_min=0.05,retry_max=0.05)
+        for first in range(0,nrecords,100):
+            sender.put(line*min(100,nrecords-first))
+
+        start = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(receiver.start(port=port),loop).result()
+        sender.drain()
+        elapsed = time.perf_counter()-start
+        sender.close()
+
+    loop.call_soon_threadsafe(loop.stop)
+    return({'records':receiver.received,'batches':receiver.batches,\
+     'seconds':elapsed,'records_per_second':receiver.received/elapsed})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PySQM data center uplink')
+    parser.add_argument('--receiver',action='store_true',help='Run a local receiver')
+    parser.add_argument('--port',type=int,default=DC_PORT)
+    parser.add_argument('--output',default=None,help='Directory to store the data')
+    parser.add_argument('--benchmark',type=int,default=0,metavar='NRECORDS')
+    parser.add_argument('--batch',type=int,default=1000)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        result = benchmark(args.benchmark,args.batch)
+        print('%(records)d records in %(batches)d batches: drained in '\
+         '%(seconds).2f s, %(records_per_second).0f records/s' %result)
+    elif args.receiver:
+        async def serve():
+            receiver = Receiver(args.output)
+            port = await receiver.start('0.0.0.0',args.port)
+            print('Receiving on port %d' %port)
+            await receiver.server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.print_help()
@@ -56,7 +56,7 @@ def relaxed_import(themodule):
 
 relaxed_import('socket')
 relaxed_import('serial')
-relaxed_import('mysql')
+relaxed_import('MySQLdb')
 relaxed_import('pysqm.email')
 
 
@@ -72,7 +72,40 @@ if config._device_type == 'SQM-LE':
 elif config._device_type == 'SQM-LU':
     import serial
 if config._use_mysql == True:
-    import mysql
+    import MySQLdb
+
+# High cadence (pipelined) sampling, disabled by default
+try: config._high_cadence
+except AttributeError: config._high_cadence = False
+try: config._pipeline_depth
+except AttributeError: config._pipeline_depth = 2
+
+# Checkpoint of the loop state, to resume quickly after a restart
+try: config._checkpoint_max_age
+except AttributeError: config._checkpoint_max_age = 600
+try: config._fsync_policy
+except AttributeError: config._fsync_policy = 'flush'
+
+from pysqm.checkpoint import Checkpoint,checkpoint_filename
+checkpoint = Checkpoint(checkpoint_filename(config),\
+ fsync=(config._fsync_policy=='flush'))
+
+
+def resume_device(device_class):
+    '''
+    Reopen the device of a recent checkpoint, without
+    the initial handshake. Return None if not possible.
+    '''
+    state = checkpoint.load(max_age=config._checkpoint_max_age)
+    if state is None or state['device']['class']!=device_class.__name__:
+        return(None)
+    try:
+        resumed = device_class.from_checkpoint(state['device'])
+    except Exception as ex:
+        print('Cannot resume the device ('+str(ex)+'), starting it again')
+        return(None)
+    print('Device resumed from checkpoint')
+    return(resumed)
 
 
 '''
@@ -81,14 +114,34 @@ and start the measures
 '''
 
 if config._device_type=='SQM-LU':
-    mydevice = SQMLU()
+    mydevice = resume_device(SQMLU) or SQMLU()
 elif config._device_type=='SQM-LE':
-    mydevice = SQMLE()
+    mydevice = resume_device(SQMLE) or SQMLE()
 else:
     print('ERROR. Unknown device type '+str(config._device_type))
     exit(0)
 
 
+def pending_records(filename):
+    ''' Records of filename still in the cache (for the plot process) '''
+    state = mydevice.cache_state()
+    if state is None or state['files'] is None or state['files'][2]!=filename:
+        return("")
+    return(state['data'])
+
+
+# The plots are made by a separate process
+from pysqm.plotworker import PlotWorker
+plotter = PlotWorker(pending_data=pending_records)
+
+
+def save_checkpoint(niter,DaytimePrint):
+    checkpoint.save({\
+     'niter':niter,'daytime_print':DaytimePrint,\
+     'device':mydevice.checkpoint_state(),\
+     'cache':mydevice.cache_state()})
+
+
 def loop():
     '''
     Ephem is used to calculate moon position (if above horizon)
@@ -97,6 +150,27 @@ def loop():
     observ = define_ephem_observatory()
     niter = 0
     DaytimePrint=True
+    # The plot process keeps the measures of the night in memory
+    PlotStateLoaded = False
+
+    state = checkpoint.load()
+    try: mydevice.DataCache
+    except AttributeError:
+        if state is not None:
+            # New process: recover the records not yet written.
+            # They go to their own files (those of the checkpoint).
+            mydevice.restore_cache(state['cache'])
+
+    # Resume the counters only from a recent checkpoint
+    state = checkpoint.load(max_age=config._checkpoint_max_age)
+    if state is not None:
+        niter = state['niter']
+        DaytimePrint = state['daytime_print']
+        print('Resuming readings from checkpoint (measure '+str(niter)+')')
+    else:
+        # Old records, write them now (not mixed with the new measures)
+        mydevice.flush_cache(sync=True)
+
     print('Starting readings ...')
     while 1<2:
         ''' The programs works as a daemon '''
@@ -104,7 +178,6 @@ def loop():
         #print (str(mydevice.local_datetime(utcdt))),
         if mydevice.is_nighttime(observ) or True:
             # If we are in a new night, create the new file.
-            config._send_to_datacenter = False ### Not enabled by default
             if config._send_to_datacenter: 
                 try:
                     assert(config._send_to_datacenter == True)
@@ -117,13 +190,24 @@ def loop():
 
             mydevice.define_filenames()
 
+            if not PlotStateLoaded:
+                plotter.load(mydevice.current_datafile,mydevice.serial_number)
+                PlotStateLoaded = True
+
             ''' Get values from the photometer '''
             try:
-                timeutc_mean,timelocal_mean,temp_sensor,\
-                freq_sensor,ticks_uC,sky_brightness = \
-                    mydevice.read_photometer(\
-                     Nmeasures=config._measures_to_promediate,PauseMeasures=10)
-            except:
+                if config._high_cadence:
+                    timeutc_mean,timelocal_mean,temp_sensor,\
+                    freq_sensor,ticks_uC,sky_brightness = \
+                        mydevice.read_photometer_pipelined(\
+                         Nmeasures=config._measures_to_promediate,\
+                         depth=config._pipeline_depth)
+                else:
+                    timeutc_mean,timelocal_mean,temp_sensor,\
+                    freq_sensor,ticks_uC,sky_brightness = \
+                        mydevice.read_photometer(\
+                         Nmeasures=config._measures_to_promediate,PauseMeasures=10)
+            except Exception:
                 print('Connection lost')
                 if config._reboot_on_connlost == True:
                     sleep(600)
@@ -147,13 +231,12 @@ def loop():
             except: pass
 
             mydevice.data_cache(formatted_data,number_measures=config._cache_measures,niter=niter)
+            save_checkpoint(niter,DaytimePrint)
+            plotter.append(formatted_data)
 
             if niter%config._plot_each == 0:
                 ''' Each X minutes, plot a new graph '''
-                try: pysqm.plot.make_plot(send_emails=False,write_stats=False)
-                except:
-                    print('Warning: Error plotting data.')
-                    print(sys.exc_info())
+                plotter.plot(send_emails=False,write_stats=False)
 
             if DaytimePrint==False:
                 DaytimePrint=True
@@ -169,20 +252,13 @@ def loop():
                 print('. Daytime. Waiting until '+str(mydevice.next_sunset(observ)))
                 DaytimePrint=False
             if niter>0:
-                mydevice.flush_cache()
-                if config._send_data_by_email==True:
-                    try: pysqm.plot.make_plot(send_emails=True,write_stats=True)
-                    except:
-                        print('Warning: Error plotting data / sending email.')
-                        print(sys.exc_info())
-
-                else:
-                    try: pysqm.plot.make_plot(send_emails=False,write_stats=True)
-                    except:
-                        print('Warning: Error plotting data.')
-                        print(sys.exc_info())
+                mydevice.flush_cache(sync=True)
+                # Plot of the whole night (data file), with the statistics
+                plotter.plot(send_emails=(config._send_data_by_email==True),\
+                 write_stats=True,use_state=False)
 
                 niter = 0
+                save_checkpoint(niter,DaytimePrint)
 
             # Send data that is still in the datacenter buffer
             try:
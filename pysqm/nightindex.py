@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+'''
+PySQM night index
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Index of the nights in a monthly data file, so one night (or a time
+range) can be read without parsing the rest of the month.
+
+The index is a text file next to the data file (same name + '.idx'),
+only appended by the writer, one line per write:
+ <night> <first byte> <end byte> <rows>
+where night is the local date of the noon to noon night (YYYYMMDD, as
+in the daily file names), or '-' for the header lines.
+The readers never write it: the lines not indexed yet are scanned.
+
+Read one night of a monthly file:
+> python -m pysqm.nightindex SQM_GURUGU_2024-01.dat 20240115
+____________________________
+'''
+
+import os,sys
+import datetime
+
+INDEX_SUFFIX = '.idx'
+# Night of the header (and invalid) lines
+HEADER = '-'
+
+
+def index_filename(datafile):
+    return(datafile+INDEX_SUFFIX)
+
+
+def night_of(local_time):
+    '''
+    Night (YYYYMMDD) of a local time in the data file format
+    (2024-01-15T23:10:05.000). The night starts at local noon.
+    '''
+    local_datetime = datetime.datetime.strptime(local_time[:19],'%Y-%m-%dT%H:%M:%S')
+    return((local_datetime-datetime.timedelta(hours=12)).strftime('%Y%m%d'))
+
+
+def scan_data(datafile,position=0):
+    '''
+    Index entries [night,first byte,end byte,rows] of the complete
+    lines of a data file, from position (the start of a line) on.
+    '''
+    entries = []
+    with open(datafile,'rb') as fdata:
+        fdata.seek(position)
+        for line in fdata:
+            if not line.endswith(b'\n'):
+                # Incomplete last line
+                break
+            start,position = position,position+len(line)
+            night = HEADER
+            if line[:1]!=b'#':
+                try: night = night_of(line.split(b';')[1].decode())
+                except (IndexError,ValueError): pass
+            rows = 0 if night==HEADER else 1
+            if entries and entries[-1][0]==night:
+                entries[-1][2:] = [position,entries[-1][3]+rows]
+            else:
+                entries.append([night,start,position,rows])
+    return(entries)
+
+
+def build_index(datafile):
+    '''
+    Scan a data file and write its index (e.g. for files written
+    before the index existed). Only for the writer, which owns the
+    index file. Return the index.
+    '''
+    entries = scan_data(datafile)
+    temporary = index_filename(datafile)+'.tmp'
+    with open(temporary,'w') as findex:
+        for entry in entries:
+            findex.write('%s %d %d %d\n' %tuple(entry))
+    os.replace(temporary,index_filename(datafile))
+    return(load_index(datafile))
+
+
+def load_index(datafile):
+    '''
+    Return {night: [(first byte,end byte,rows), ...]}, with the
+    contiguous ranges merged.
+    '''
+    index = {}
+    try:
+        findex = open(index_filename(datafile),'r')
+    except FileNotFoundError:
+        return(index)
+    with findex:
+        for line in findex:
+            fields = line.split()
+            if len(fields)!=4 or not line.endswith('\n'):
+                # Incomplete last line
+                continue
+            add_entry(index,fields[0],*[int(field) for field in fields[1:]])
+    return(index)
+
+
+def add_entry(index,night,start,end,rows):
+    ''' Add a byte range to the index, merged with the contiguous one '''
+    ranges = index.setdefault(night,[])
+    if ranges and ranges[-1][1]==start:
+        ranges[-1] = (ranges[-1][0],end,ranges[-1][2]+rows)
+    else:
+        ranges.append((start,end,rows))
+
+
+def index_end(index):
+    ''' Last byte of the data file covered by the index '''
+    return(max([ranges[-1][1] for ranges in index.values()],default=0))
+
+
+def up_to_date_index(datafile):
+    '''
+    Load the index of datafile. The lines not indexed yet (e.g. written
+    but not recorded in the index) are scanned, in memory only: the
+    index file belongs to the writer, which may be appending to it.
+    '''
+    index = load_index(datafile)
+    end = index_end(index)
+    if end==data_end(datafile):
+        return(index)
+    if end>data_end(datafile):
+        # Not the index of this file (e.g. the file was replaced)
+        index,end = {},0
+    for entry in scan_data(datafile,end):
+        add_entry(index,*entry)
+    return(index)
+
+
+def data_end(datafile):
+    ''' End of the last complete line of the data file '''
+    size = os.path.getsize(datafile)
+    if size==0:
+        return(0)
+    with open(datafile,'rb') as fdata:
+        fdata.seek(max(0,size-4096))
+        tail = fdata.read()
+    return(size-len(tail)+tail.rfind(b'\n')+1)
+
+
+class NightIndex(object):
+    '''
+    Writer side of the index of a data file.
+    '''
+    def __init__(self,datafile):
+        self.datafile = datafile
+        if os.path.exists(datafile) and \
+         index_end(load_index(datafile))!=data_end(datafile):
+            build_index(datafile)
+        self.handle = open(index_filename(datafile),'a')
+
+    def record(self,night,start,end,rows):
+        self.handle.write('%s %d %d %d\n' %(night,start,end,rows))
+        self.handle.flush()
+
+    def sync(self):
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        self.handle.close()
+
+
+def list_nights(datafile):
+    ''' Nights (YYYYMMDD) in a data file and their number of rows '''
+    index = up_to_date_index(datafile)
+    return({night:sum(rows for start,end,rows in ranges) \
+     for night,ranges in sorted(index.items()) if night!=HEADER})
+
+
+def read_night(datafile,night,index=None):
+    '''
+    Data lines of one night (YYYYMMDD) in a monthly data file.
+    Only the indexed byte ranges are read.
+    '''
+    if index is None:
+        index = up_to_date_index(datafile)
+    lines = []
+    with open(datafile,'rb') as fdata:
+        for start,end,rows in index.get(night,[]):
+            fdata.seek(start)
+            lines.extend(fdata.read(end-start).decode().splitlines(True))
+    return(lines)
+
+
+def read_range(datafile,start_utc,end_utc):
+    '''
+    Data lines of a monthly data file with start_utc <= UTC < end_utc
+    (datetime objects). Only the nights around the range are read.
+    '''
+    index = up_to_date_index(datafile)
+    # Nights that may hold the range (any local offset)
+    first = (start_utc-datetime.timedelta(days=1)).strftime('%Y%m%d')
+    last  = (end_utc+datetime.timedelta(days=1)).strftime('%Y%m%d')
+    start_str = start_utc.strftime('%Y-%m-%dT%H:%M:%S')
+    end_str   = end_utc.strftime('%Y-%m-%dT%H:%M:%S')
+
+    lines = []
+    for night in sorted(index):
+        if night!=HEADER and first<=night<=last:
+            lines.extend(line for line in read_night(datafile,night,index) \
+             if start_str<=line[:19]<end_str)
+    return(lines)
+
+
+if __name__ == '__main__':
+    datafile,night = sys.argv[1:3]
+    sys.stdout.write(''.join(read_night(datafile,night)))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+'''
+PySQM night state
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Measures of the current night, kept in memory by the main loop.
+Each new measure is appended with its derived values (Sun altitude,
+pre/after-midnight group, corrected NSB), so the periodic plots do not
+read and process again the current data file: only the new measures
+are processed. The arrays grow by doubling their size, and the data
+given to the plot and the statistics are views of them (no copies).
+
+The night of a measure is the local date of the noon to noon night
+(as in the daily file names). A measure of a new night starts again
+the state.
+____________________________
+'''
+
+import os
+import numpy as np
+
+from pysqm import astro
+
+# Columns of the state (times also as datetime objects, for the plots)
+STATE_COLUMNS = [\
+ ('utc_times','datetime64[s]'),('local_times','datetime64[s]'),\
+ ('utcdates',object),('localdates',object),\
+ ('temperatures','f8'),('tick_counts','f8'),('frequencies','f8'),\
+ ('night_sbs','f8'),('sun_altitude','f8')]
+
+
+class GrowingArrays(object):
+    '''
+    Columns that only grow. The storage is doubled when full,
+    so appending is O(1) per measure (amortized).
+    '''
+    def __init__(self,columns,capacity=1024):
+        self.columns = columns
+        self.size = 0
+        self.arrays = dict((name,np.empty(capacity,dtype=kind)) \
+         for name,kind in columns)
+
+    def append(self,values):
+        ''' Append the arrays in values (dict with all the columns) '''
+        number = len(values[self.columns[0][0]])
+        capacity = len(self.arrays[self.columns[0][0]])
+        if self.size+number>capacity:
+            capacity = max(2*capacity,self.size+number)
+            for name,array in self.arrays.items():
+                grown = np.empty(capacity,dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                self.arrays[name] = grown
+        for name,array in self.arrays.items():
+            array[self.size:self.size+number] = values[name]
+        self.size += number
+
+    def __getitem__(self,name):
+        return(self.arrays[name][:self.size])
+
+    def __len__(self):
+        return(self.size)
+
+
+class NightGroup(object):
+    ''' Pre or after-midnight measures of the night '''
+    def __init__(self):
+        self.data = GrowingArrays(STATE_COLUMNS)
+        self.label_dates = []
+
+    def append(self,values):
+        if len(values['utc_times'])==0:
+            return
+        self.data.append(values)
+        # Date in str format: 20130115
+        for label in np.unique(values['label_dates']).tolist():
+            if label not in self.label_dates:
+                self.label_dates.append(label)
+
+    def __getattr__(self,name):
+        # Same attributes as SQMData.premidnight / aftermidnight
+        try:
+            return(self.data[name])
+        except KeyError:
+            raise AttributeError(name)
+
+
+class NightState(object):
+    '''
+    Measures of the current night.
+    '''
+    def __init__(self,site,plot_offset=0.):
+        self.site = site
+        # Added to the NSB in the plots (see _plot_corrected_data)
+        self.plot_offset = plot_offset
+        self.serial_number = '00000000'
+        self.clear()
+
+    def clear(self,night=None):
+        self.night = night
+        self.all_night = GrowingArrays(STATE_COLUMNS)
+        self.premidnight = NightGroup()
+        self.aftermidnight = NightGroup()
+
+    def __len__(self):
+        return(len(self.all_night))
+
+    def append_rows(self,data):
+        ''' Append the rows of a plot.parse_data array '''
+        if len(data)==0:
+            return
+        utc_times = data['utc'].astype('datetime64[s]')
+        local_times = data['local'].astype('datetime64[s]')
+
+        # Only the measures of the last night
+        nights = (local_times-np.timedelta64(12,'h')).astype('datetime64[D]')
+        if self.night is None or nights[-1]!=self.night:
+            self.clear(nights[-1])
+        keep = nights==self.night
+        if not np.all(keep):
+            data,utc_times,local_times = data[keep],utc_times[keep],local_times[keep]
+
+        # Derived values, only for the new measures
+        local_days = local_times.astype('datetime64[D]')
+        values = {\
+         'utc_times':utc_times,'local_times':local_times,\
+         'temperatures':data['temperature'],'tick_counts':data['counts'],\
+         'frequencies':data['frequency'],'night_sbs':data['msas']+self.plot_offset,\
+         'sun_altitude':astro.sun_altitude(utc_times,self.site),\
+         'utcdates':utc_times.astype(object),'localdates':local_times.astype(object),\
+         'label_dates':np.char.replace(np.datetime_as_string(local_days),'-','')}
+        self.all_night.append(values)
+
+        # Split pre and after-midnight data (local hour > 12)
+        is_premidnight = (local_times-local_days)>=np.timedelta64(13,'h')
+        for group,selection in [\
+         (self.premidnight,is_premidnight),(self.aftermidnight,~is_premidnight)]:
+            group.append(dict((name,value[selection]) for name,value in values.items()))
+
+    def append(self,formatted_data):
+        ''' Append the data lines (as written in the data files) '''
+        from pysqm.plot import parse_data
+        self.append_rows(parse_data(formatted_data))
+
+    def load(self,filename):
+        '''
+        Start from the measures of a data file (e.g. the current
+        data file, when the program is started in the night).
+        '''
+        from pysqm.plot import SQMData,read_datafile
+        if not os.path.exists(filename):
+            return
+        header_lines,data = read_datafile(filename)
+        Data = SQMData.__new__(SQMData)
+        Data.extract_metadata(header_lines)
+        self.serial_number = Data.serial_number
+        self.clear()
+        self.append_rows(data)
+
+    def sqmdata(self):
+        '''
+        SQMData of the night (for the plot and the statistics),
+        with views of the state arrays.
+        '''
+        from pysqm.plot import SQMData
+        Data = SQMData.__new__(SQMData)
+        Data.serial_number = self.serial_number
+        Data.premidnight = self.premidnight
+        Data.aftermidnight = self.aftermidnight
+        Data.Statistics = type('Statistics',(object,),{})
+        Data.utc_times = self.all_night['utc_times']
+        Data.local_times = self.all_night['local_times']
+        Data.all_night_dt = self.all_night['utcdates'] # Must be in UTC!
+        Data.all_night_sb = self.all_night['night_sbs']
+        Data.all_night_temp = self.all_night['temperatures']
+        Data.all_night_sun_altitude = self.all_night['sun_altitude']
+        Data.Night = None if self.night is None else self.night.astype(object)
+        return(Data)
+
+
+def night_state(config):
+    ''' Night state for the site in config '''
+    try: plot_corrected = config._plot_corrected_data
+    except AttributeError: plot_corrected = False
+    plot_offset = 0.
+    if plot_corrected:
+        plot_offset = plot_corrected*config._offset_calibration
+    return(NightState(astro.config_site(config),plot_offset))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+'''
+PySQM night store
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Binary copy of the measures, one directory per night (named as the
+daily data file) with one raw little-endian file per column:
+
+ utc.f8          UTC time, seconds since 1970-01-01
+ utc_offset.i4   local time - UTC, seconds
+ temperature.f4  sensor temperature (C)
+ counts.f8       counts
+ frequency.f8    frequency (Hz)
+ msas.f4         sky brightness (mag/arcsec2)
+
+The columns only grow by appends and can be memory-mapped by any
+number of readers, without parsing:
+
+> night = open_night(directory,'20240101_120000_SQM-GURUGU')
+> night['msas'][-10:]
+
+Enabled with _use_nightstore = True in config.py. Existing data files
+can be converted with:
+> python -m pysqm.nightstore -c config.py file1.dat [file2.dat ...]
+____________________________
+'''
+
+import os,sys
+import json
+import numpy as np
+
+COLUMNS = [\
+ ('utc','<f8'),('utc_offset','<i4'),('temperature','<f4'),\
+ ('counts','<f8'),('frequency','<f8'),('msas','<f4')]
+
+META_FILE = 'columns.json'
+
+
+def column_filename(directory,name,dtype):
+    return(os.path.join(directory,name+'.'+np.dtype(dtype).str[1:]))
+
+
+def parse_records(text):
+    '''
+    Convert the data lines (as written in the data files) to columns.
+    Comments and invalid lines are skipped.
+    '''
+    rows = [line.split(';') for line in text.splitlines() \
+     if line and line[0]!='#']
+    rows = [row for row in rows if len(row)==6]
+    if len(rows)==0:
+        return({name:np.zeros(0,dtype=dtype) for name,dtype in COLUMNS})
+
+    fields = list(zip(*rows))
+    utc = np.array(fields[0],dtype='datetime64[ms]')
+    local = np.array(fields[1],dtype='datetime64[ms]')
+    values = np.array(fields[2:],dtype=float)
+    columns = {
+     'utc':utc.astype(np.int64)/1000.,
+     'utc_offset':(local-utc).astype('timedelta64[s]').astype(np.int64),
+     'temperature':values[0],
+     'counts':values[1],
+     'frequency':values[2],
+     'msas':values[3]}
+    return({name:columns[name].astype(dtype) for name,dtype in COLUMNS})
+
+
+class NightStore(object):
+    '''
+    Append the measures to the per night column files.
+    Only the files of the current night are kept open.
+    '''
+    def __init__(self,directory):
+        self.directory = directory
+        self.night = None
+        self.handles = {}
+
+    def open_night(self,night):
+        self.close()
+        night_directory = os.path.join(self.directory,night)
+        if not os.path.exists(night_directory):
+            os.makedirs(night_directory)
+            with open(os.path.join(night_directory,META_FILE),'w') as meta:
+                json.dump(COLUMNS,meta)
+        filenames = {name:column_filename(night_directory,name,dtype) \
+         for name,dtype in COLUMNS}
+
+        # A record may be incomplete after a crash: keep only the
+        # records complete in all the columns, so they stay aligned.
+        sizes = {name:os.path.getsize(filenames[name]) \
+         if os.path.exists(filenames[name]) else 0 for name,dtype in COLUMNS}
+        length = min(sizes[name]//np.dtype(dtype).itemsize for name,dtype in COLUMNS)
+        for name,dtype in COLUMNS:
+            if sizes[name]>length*np.dtype(dtype).itemsize:
+                os.truncate(filenames[name],length*np.dtype(dtype).itemsize)
+
+        self.handles = {name:open(filenames[name],'ab') for name,dtype in COLUMNS}
+        self.night = night
+
+    def append(self,night,text):
+        ''' Append the data lines in text to the columns of night '''
+        columns = parse_records(text)
+        if len(columns['utc'])==0:
+            return
+        if night!=self.night:
+            self.open_night(night)
+        for name,dtype in COLUMNS:
+            self.handles[name].write(columns[name].tobytes())
+            self.handles[name].flush()
+
+    def sync(self):
+        for handle in self.handles.values():
+            os.fsync(handle.fileno())
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+        self.night = None
+
+
+def list_nights(directory):
+    ''' Nights available in the store (sorted) '''
+    if not os.path.isdir(directory):
+        return([])
+    return(sorted(night for night in os.listdir(directory) \
+     if os.path.exists(os.path.join(directory,night,META_FILE))))
+
+
+def open_night(directory,night,mmap=True):
+    '''
+    Columns of one night as a dict of arrays (read only memory maps
+    if mmap is True). All the columns have the same length: a record
+    being written is not seen until it is complete.
+    '''
+    night_directory = os.path.join(directory,night)
+    with open(os.path.join(night_directory,META_FILE)) as meta:
+        columns = [tuple(column) for column in json.load(meta)]
+
+    filenames = {name:column_filename(night_directory,name,dtype) \
+     for name,dtype in columns}
+    length = min(os.path.getsize(filenames[name])//np.dtype(dtype).itemsize \
+     for name,dtype in columns)
+
+    night_data = {}
+    for name,dtype in columns:
+        if length==0:
+            night_data[name] = np.zeros(0,dtype=dtype)
+        elif mmap:
+            night_data[name] = np.memmap(\
+             filenames[name],dtype=dtype,mode='r',shape=(length,))
+        else:
+            night_data[name] = np.fromfile(\
+             filenames[name],dtype=dtype,count=length)
+    return(night_data)
+
+
+def import_datafile(filename,directory):
+    '''
+    Add the measures of an existing (daily) data file to the store.
+    Nights already in the store are not imported again.
+    '''
+    night = os.path.basename(filename).rsplit('.',1)[0]
+    if night in list_nights(directory):
+        print('%s already in the store' %night)
+        return(night)
+    with open(filename,'r') as datafile:
+        text = datafile.read()
+    store = NightStore(directory)
+    store.append(night,text)
+    store.close()
+    return(night)
+
+
+def store_directory(config):
+    try: return(config.nightstore_directory)
+    except AttributeError:
+        return(os.path.join(config.monthly_data_directory,'nightstore'))
+
+
+if __name__ == '__main__':
+    import pysqm.settings as settings
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert data files to the night store')
+    parser.add_argument('-c','--config',default='config.py')
+    parser.add_argument('datafiles',nargs='+')
+    args = parser.parse_args()
+    settings.GlobalConfig.read_config_file(args.config)
+    directory = store_directory(settings.GlobalConfig.config)
+    for filename in args.datafiles:
+        night = import_datafile(filename,directory)
+        print('%s: %d measures' %(night,len(open_night(directory,night)['utc'])))
@@ -25,6 +25,8 @@ ____________________________
 
 from ast import Try
 import os,sys
+import io
+import warnings
 import ephem
 import numpy as np
 import matplotlib
@@ -41,22 +43,50 @@ if __name__ != '__main__':
     import pysqm.settings as settings
     config = settings.GlobalConfig.config
 
+# Columns of the data files. Times may be not complete
+# (e.g. without seconds), numpy parses them anyway.
+DATA_COLUMNS = [\
+ ('utc','datetime64[ms]'),('local','datetime64[ms]'),\
+ ('temperature','f8'),('counts','f8'),('frequency','f8'),('msas','f8')]
+
+
+def parse_data(text):
+    '''
+    Data lines (as in the data files) to a numpy array with the
+    DATA_COLUMNS. All the lines are parsed at once by numpy. If some
+    line is not valid, keep only the complete ones (6 fields) and retry.
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # Files without data
+        try:
+            return(np.loadtxt(io.StringIO(text),delimiter=';',\
+             dtype=DATA_COLUMNS,comments='#',ndmin=1))
+        except ValueError:
+            rows = [line for line in text.replace(' ','').splitlines() \
+             if line[:1]!='#' and line.count(';')==5]
+            return(np.loadtxt(rows,delimiter=';',\
+             dtype=DATA_COLUMNS,comments=None,ndmin=1))
+
+
+def read_datafile(filename):
+    ''' Header lines and data (see parse_data) of a data file '''
+    header_lines = []
+    with open(filename,'r') as sqm_file:
+        for line in sqm_file:
+            if line.lstrip()[:1]!='#':
+                break
+            header_lines.append(line)
+        else:
+            line = ''
+        text = line+sqm_file.read()
+    return(header_lines,parse_data(text))
+
 
 class Ephemerids(object):
     def __init__(self):
         from pysqm.common import define_ephem_observatory
         self.Observatory = define_ephem_observatory()
 
-    def ephem_date_to_datetime(self,ephem_date):
-        # Convert ephem dates to datetime
-        date_,time_ = str(ephem_date).split(' ')
-        date_ = date_.split('/')
-        time_ = time_.split(':')
-
-        return(datetime(\
-            int(date_[0]),int(date_[1]),int(date_[2]),\
-            int(time_[0]),int(time_[1]),int(time_[2])))
-
     def end_of_the_day(self,thedate):
         newdate = thedate+timedelta(days=1)
         newdatetime = datetime(\
@@ -66,77 +96,54 @@ class Ephemerids(object):
         newdatetime = newdatetime-timedelta(hours=config._local_timezone)
         return(newdatetime)
 
+    def night_events(self,thedate):
+        '''
+        Sun and Moon events of the night, from the almanac
+        of the year (computed once and cached on disk).
+        '''
+        from pysqm.almanac import night_events
+        return(night_events(config,thedate))
 
     def calculate_moon_ephems(self,thedate):
         # Moon ephemerids
-        self.Observatory.horizon = '0'
-        self.Observatory.date = str(self.end_of_the_day(thedate))
+        events = self.night_events(thedate)
 
-        # Moon phase
-        Moon = ephem.Moon()
-        Moon.compute(self.Observatory)
-        self.moon_phase = Moon.phase
-        self.moon_maxelev = Moon.transit_alt # TODO: transit_alt deprecated, needs to be converted.
-
-        try:
-            float(self.moon_maxelev)
-        except:
-            # The moon has no culmination time for 1 day
-            # per month, so there is no max altitude.
-            # As a workaround, we use the previous day culmination.
-            # The error should be small.
-
-            # Set the previous day date
-            thedate2 = thedate - timedelta(days=1)
-            self.Observatory.date = str(self.end_of_the_day(thedate2))
-            Moon2 = ephem.Moon()
-            Moon2.compute(self.Observatory)
-            self.moon_maxelev = Moon2.transit_alt
-
-            # Recover the real date
-            self.Observatory.date = str(self.end_of_the_day(thedate))
+        # Moon phase and altitude at transit. The moon has no
+        # culmination time for 1 day per month, the almanac
+        # uses then the previous day culmination.
+        self.moon_phase = events['moon_phase']
+        self.moon_maxelev = events['moon_transit_alt']
 
         # Moon rise and set
-        self.moon_prev_rise = \
-         self.ephem_date_to_datetime(self.Observatory.previous_rising(ephem.Moon()))
-        self.moon_prev_set  = \
-         self.ephem_date_to_datetime(self.Observatory.previous_setting(ephem.Moon()))
-        self.moon_next_rise = \
-         self.ephem_date_to_datetime(self.Observatory.next_rising(ephem.Moon()))
-        self.moon_next_set  = \
-         self.ephem_date_to_datetime(self.Observatory.next_setting(ephem.Moon()))
+        self.moon_prev_rise = events['moon_prev_rise']
+        self.moon_prev_set  = events['moon_prev_set']
+        self.moon_next_rise = events['moon_next_rise']
+        self.moon_next_set  = events['moon_next_set']
 
     def calculate_twilight(self,thedate,twilight=-18):
         '''
-        Changing the horizon forces ephem to
-        calculate different types of twilights:
+        Twilight for the Sun center at the given altitude:
         -6: civil,
         -12: nautical,
         -18: astronomical,
         '''
-        self.Observatory.horizon = str(twilight)
-        self.Observatory.date = str(self.end_of_the_day(thedate))
+        from pysqm.almanac import TWILIGHTS,twilight_events
+        from pysqm.astro import config_site
 
-        try:
-            ## Plotting only uses twilight_prev_set and twilight_next_rise
-            # self.twilight_prev_rise = self.ephem_date_to_datetime(\
-            # self.Observatory.previous_rising(ephem.Sun(),use_center=True)) 
-            self.twilight_prev_set = self.ephem_date_to_datetime(\
-            self.Observatory.previous_setting(ephem.Sun(),use_center=True))
-            self.twilight_next_rise = self.ephem_date_to_datetime(\
-            self.Observatory.next_rising(ephem.Sun(),use_center=True))
-            # self.twilight_next_set = self.ephem_date_to_datetime(\
-            # self.Observatory.next_setting(ephem.Sun(),use_center=True))
-        # If you're north or south enough, night, day or the twilights might not exist. 
-        # Here we are catching the root class of the exception hierarchy 
-        # to catch NeverUpError or AlwaysUpError
-        except ephem.CircumpolarError:
-            # self.twilight_prev_rise = None
-            self.twilight_prev_set = None
-            self.twilight_next_rise = None
-            # self.twilight_next_set = None 
-            
+        # If you're north or south enough, night, day or the
+        # twilights might not exist (None).
+        names = dict((altitude,name) for name,altitude in TWILIGHTS.items())
+        if twilight in names:
+            events = self.night_events(thedate)
+            self.twilight_prev_set = events[names[twilight]+'_set']
+            self.twilight_next_rise = events[names[twilight]+'_rise']
+            return
 
+        # Other altitudes are not in the almanac
+        reference = (self.end_of_the_day(thedate)-datetime(1970,1,1)).total_seconds()
+        events = twilight_events(config_site(config),reference,twilight)
+        self.twilight_prev_set,self.twilight_next_rise = [None if np.isnan(event[0]) \
+         else datetime(1970,1,1)+timedelta(seconds=round(event[0])) for event in events]
 
 
 class SQMData(object):
@@ -155,6 +162,7 @@ class SQMData(object):
         self.all_night_sb = []
         self.all_night_dt = []
         self.all_night_temp = []
+        self.all_night_sun_altitude = []
 
         for variable in [\
          'utcdates','localdates','sun_altitudes',\
@@ -167,159 +175,98 @@ class SQMData(object):
         self.process_rawdata(Ephem)
         self.check_number_of_nights()
 
-    def extract_metadata(self,raw_data_and_metadata):
+    def extract_metadata(self,header_lines):
         from pysqm.common import format_value
-        metadata_lines = [\
-         line for line in raw_data_and_metadata \
-         if format_value(line)[0]=='#']
-
         # Extract the serial number
-        if not len(metadata_lines) == 0:
-            self.serial_number = '00000000'
-            return
-
-        try:
-            serial_number_line = [\
-                line for line in metadata_lines \
-                if 'SQM serial number:' in line][0]
-            self.serial_number = format_value(serial_number_line.split(':')[-1])
-        except IndexError:
-            self.serial_number = '00000000'
-
-
-    def check_validdata(self,data_line):
-        from pysqm.common import format_value
-        try:
-            assert(format_value(data_line)[0]!='#')
-            assert(format_value(data_line)[0]!='')
-        except:
-            return(False)
-        else:
-            return(True)
+        self.serial_number = '00000000'
+        for line in header_lines:
+            if 'SQM serial number:' in line:
+                self.serial_number = format_value(line.split(':')[-1])
+                break
 
     def load_rawdata(self,filename):
         '''
-        Open the file, read the data and close the file
+        Open the file, read the header and the data and close the file.
+        The data columns are converted in bulk to numpy arrays
+        (datetime64 for the UTC and local times).
         '''
-        sqm_file = open(filename, 'r')
-        raw_data_and_metadata = sqm_file.readlines()
-        self.metadata = self.extract_metadata(raw_data_and_metadata)
-
-        self.raw_data = [\
-         line for line in raw_data_and_metadata \
-         if self.check_validdata(line)==True]
-        sqm_file.close()
+        header_lines,data = read_datafile(filename)
+        self.extract_metadata(header_lines)
 
-    def process_datetimes(self,str_datetime):
-        '''
-        Get date and time in a str format
-        Return as datetime object
-        '''
-        str_date,str_time = str_datetime.split('T')
-
-        year  = int(str_date.split('-')[0])
-        month = int(str_date.split('-')[1])
-        day   = int(str_date.split('-')[2])
-
-        # Time may be not complete. Workaround
-        hour   = int(str_time.split(':')[0])
-        try:
-            minute = int(str_time.split(':')[1])
-        except:
-            minute = 0
-            second = 0
-        else:
-            try:
-                second = int(str_time.split(':')[2])
-            except:
-                second = 0
+        # The fraction of second is not used
+        self.utc_times = data['utc'].astype('datetime64[s]')
+        self.local_times = data['local'].astype('datetime64[s]')
+        self.temperatures = data['temperature']
+        self.tick_counts = data['counts']
+        self.frequencies = data['frequency']
+        self.night_sbs = data['msas']
 
-        return(datetime(year,month,day,hour,minute,second))
-    
     def utc_offset(self):
         """
         """
         now = datetime.now(tz=ZoneInfo(config._timezone))
         return int(now.utcoffset().total_seconds() / 60 / 60)
 
+    def sun_altitudes(self,Ephem):
+        ''' Sun altitude (rad) for each measure '''
+        from pysqm.astro import sun_altitude,observer_site
+        return(sun_altitude(self.utc_times,observer_site(Ephem.Observatory)))
+
     def process_rawdata(self,Ephem):
-        from pysqm.common import format_value_list
         '''
         Get the important information from the raw_data
         and put it in a more useful format
 
-        Splits string read from file into columns, converts string formats into python binary formats.
+        All the measures are processed at once with numpy arrays.
         if data and timezone config disagree return 1 (and no data is processed)
         '''
 
-        # Split rows on ";"
-        self.raw_data = format_value_list(self.raw_data)
-       
-        # convert to Python data formats
-        for k,line in enumerate(self.raw_data):
-            # DateTime extraction
-            utcdatetime = self.process_datetimes(line[0])
-            localdatetime = self.process_datetimes(line[1])
-
-            # Check that datetimes are corrent)
-            calc_localdatetime = utcdatetime+timedelta(hours=self.utc_offset())
- 
-            if ((calc_localdatetime - localdatetime) > timedelta(minutes=60)): 
-                print("WARNING: Difference between localtime and utctime in data DO NOT MATCH configured timezone difference. Check config.py ")
-                print("**** ABORT processing raw data ****")
-                print("No data will be plotted")
-                return 1
-
-            # Set the datetime for astronomical calculations.
-            Ephem.Observatory.date = ephem.date(utcdatetime)
-
-            # Date in str format: 20130115
-            label_date = str(localdatetime.date()).replace('-','')
-
-            # Temperature
-            temperature = float(line[2])
-            # Counts
-            tick_counts = float(line[3])
-            # Frequency
-            frequency   = float(line[4])
-            # Night sky background
-            night_sb    = float(line[5])
-            try: config._plot_corrected_nsb
-            except AttributeError: config._plot_corrected_data=False
-            if (config._plot_corrected_data):
-                night_sb += config._plot_corrected_data*config._offset_calibration
-            # Define sun in pyephem
-            Sun = ephem.Sun(Ephem.Observatory)
-
-            self.premidnight.label_date=[]
-            self.aftermidnight.label_dates=[]
-
-
-            if localdatetime.hour > 12:
-                self.premidnight.utcdates.append(utcdatetime)
-                self.premidnight.localdates.append(localdatetime)
-                self.premidnight.temperatures.append(temperature)
-                self.premidnight.tick_counts.append(tick_counts)
-                self.premidnight.frequencies.append(frequency)
-                self.premidnight.night_sbs.append(night_sb)
-                self.premidnight.sun_altitude.append(Sun.alt)
-                if label_date not in self.premidnight.label_dates:
-                    self.premidnight.label_dates.append(label_date)
-            else:
-                self.aftermidnight.utcdates.append(utcdatetime)
-                self.aftermidnight.localdates.append(localdatetime)
-                self.aftermidnight.temperatures.append(temperature)
-                self.aftermidnight.tick_counts.append(tick_counts)
-                self.aftermidnight.frequencies.append(frequency)
-                self.aftermidnight.night_sbs.append(night_sb)
-                self.aftermidnight.sun_altitude.append(Sun.alt)
-                if label_date not in self.aftermidnight.label_dates:
-                    self.aftermidnight.label_dates.append(label_date)
-
-            # Data for the complete night
-            self.all_night_dt.append(utcdatetime) # Must be in UTC!
-            self.all_night_sb.append(night_sb)
-            self.all_night_temp.append(temperature)
+        # Check that datetimes are corrent (same UTC offset for all the rows)
+        calc_localtimes = self.utc_times+np.timedelta64(self.utc_offset(),'h')
+        if np.any((calc_localtimes-self.local_times)>np.timedelta64(60,'m')):
+            print("WARNING: Difference between localtime and utctime in data DO NOT MATCH configured timezone difference. Check config.py ")
+            print("**** ABORT processing raw data ****")
+            print("No data will be plotted")
+            return 1
+
+        # Night sky background
+        night_sbs = self.night_sbs
+        try: config._plot_corrected_nsb
+        except AttributeError: config._plot_corrected_data=False
+        if (config._plot_corrected_data):
+            night_sbs = night_sbs+config._plot_corrected_data*config._offset_calibration
+
+        sun_altitudes = self.sun_altitudes(Ephem)
+
+        # Date in str format: 20130115
+        local_days = self.local_times.astype('datetime64[D]')
+        label_dates = np.char.replace(np.datetime_as_string(local_days),'-','')
+
+        # Split pre and after-midnight data (local hour > 12)
+        self.is_premidnight = \
+         (self.local_times-local_days)>=np.timedelta64(13,'h')
+
+        utcdates = self.utc_times.astype(object)
+        localdates = self.local_times.astype(object)
+
+        for TheData,selection in [\
+         (self.premidnight,self.is_premidnight),\
+         (self.aftermidnight,~self.is_premidnight)]:
+            TheData.utcdates = utcdates[selection]
+            TheData.localdates = localdates[selection]
+            TheData.local_times = self.local_times[selection]
+            TheData.temperatures = self.temperatures[selection]
+            TheData.tick_counts = self.tick_counts[selection]
+            TheData.frequencies = self.frequencies[selection]
+            TheData.night_sbs = night_sbs[selection]
+            TheData.sun_altitude = sun_altitudes[selection]
+            TheData.label_dates = np.unique(label_dates[selection]).tolist()
+
+        # Data for the complete night
+        self.all_night_dt = utcdates # Must be in UTC!
+        self.all_night_sb = night_sbs
+        self.all_night_temp = self.temperatures
+        self.all_night_sun_altitude = sun_altitudes
 
     def check_number_of_nights(self):
         '''
@@ -329,12 +276,12 @@ class SQMData(object):
         to make the plot.
         '''
 
-        if np.size(self.premidnight.localdates)>0:
-            self.Night = np.unique([DT.date() \
-             for DT in self.premidnight.localdates])[0]
-        elif np.size(self.aftermidnight.localdates)>0:
-            self.Night = np.unique([(DT-timedelta(hours=12)).date() \
-             for DT in self.aftermidnight.localdates])[0]
+        if np.any(self.is_premidnight):
+            self.Night = np.unique(\
+             self.local_times[self.is_premidnight].astype('datetime64[D]'))[0].astype(object)
+        elif np.size(self.local_times)>0:
+            self.Night = np.unique(\
+             (self.local_times-np.timedelta64(12,'h')).astype('datetime64[D]'))[0].astype(object)
         else:
             print('Warning, No Night detected.')
             self.Night = None
@@ -372,12 +319,10 @@ class SQMData(object):
             y=np.convolve(w/w.sum(),s,mode='valid')
             return(y)
 
-        if Ephem.twilight_prev_set is not None and Ephem.twilight_next_rise is not None:
-            astronomical_night_filter = (\
-            (np.array(self.all_night_dt)>Ephem.twilight_prev_set)*\
-            (np.array(self.all_night_dt)<Ephem.twilight_next_rise))
-        else: # No astronomical twilight at current location (poor lads)
-            astronomical_night_filter = (0)
+        # Sun below -18 deg. Empty if there is no astronomical
+        # twilight at current location (poor lads)
+        astronomical_night_filter = \
+         np.asarray(self.all_night_sun_altitude)<-18*np.pi/180.
 
         if np.sum(astronomical_night_filter)>10:
             self.astronomical_night_sb = \
@@ -420,20 +365,41 @@ class SQMData(object):
 
 
 class Plot(object):
+    '''
+    Figure of a night. The figure, axes, lines and labels are made
+    once; update only refreshes the data, the limits and the Moon
+    and twilight marks (see night_plot).
+    '''
     def __init__(self,Data,Ephem):
-        plt.clf() # plt.hold(True/False) is deprecated
-        Data = self.prepare_plot(Data,Ephem)
+        self.Night = Data.Night
 
         try: config.full_plot
         except: config.full_plot = False
+        self.full_plot = config.full_plot
         if (config.full_plot):
             self.make_figure(thegraph_altsun=True,thegraph_time=True)
-            self.plot_data_sunalt(Data,Ephem)
         else:
             self.make_figure(thegraph_altsun=False,thegraph_time=True)
 
+        self.ephem_artists = []
+        self.update(Data,Ephem)
+
+    def update(self,Data,Ephem):
+        '''
+        Draw the data of the same night again
+        '''
+        Data = self.prepare_plot(Data,Ephem)
+
+        if (self.full_plot):
+            self.plot_data_sunalt(Data,Ephem)
+
         self.plot_data_time(Data,Ephem)
 
+        # Remove the previous Moon and twilight marks
+        for artist in self.ephem_artists:
+            artist.remove()
+        self.ephem_artists = []
+
         self.plot_moonphase(Ephem)
         self.plot_twilight(Ephem)
 
@@ -441,22 +407,27 @@ class Plot(object):
         '''
         shade the period of time for which the moon is above the horizon
         '''
+        # If the moon does not rise or set (high latitudes), skip plotting
+        if None in (Ephem.moon_prev_rise,Ephem.moon_prev_set,\
+         Ephem.moon_next_rise,Ephem.moon_next_set):
+            return
+
         if Ephem.moon_next_rise > Ephem.moon_next_set:
             # We need to divide the plotting in two phases
             #(pre-midnight and after-midnight)
-            self.thegraph_time.axvspan(\
+            self.ephem_artists.append(self.thegraph_time.axvspan(\
              Ephem.moon_prev_rise+timedelta(hours=config._local_timezone),\
              Ephem.moon_next_set+timedelta(hours=config._local_timezone),\
-              edgecolor='#d62728',facecolor='#d62728', alpha=0.1,clip_on=True)
+              edgecolor='#d62728',facecolor='#d62728', alpha=0.1,clip_on=True))
         else:
-            self.thegraph_time.axvspan(\
+            self.ephem_artists.append(self.thegraph_time.axvspan(\
              Ephem.moon_prev_rise+timedelta(hours=config._local_timezone),\
              Ephem.moon_prev_set+timedelta(hours=config._local_timezone),\
-             edgecolor='#d62728',facecolor='#d62728', alpha=0.1,clip_on=True)
-            self.thegraph_time.axvspan(\
+             edgecolor='#d62728',facecolor='#d62728', alpha=0.1,clip_on=True))
+            self.ephem_artists.append(self.thegraph_time.axvspan(\
              Ephem.moon_next_rise+timedelta(hours=config._local_timezone),\
              Ephem.moon_next_set+timedelta(hours=config._local_timezone),\
-             edgecolor='#d62728',facecolor='#d62728', alpha=0.1,clip_on=True)
+             edgecolor='#d62728',facecolor='#d62728', alpha=0.1,clip_on=True))
 
     def plot_twilight(self,Ephem):
         '''
@@ -466,12 +437,12 @@ class Plot(object):
         if Ephem.twilight_prev_set is None or Ephem.twilight_next_rise is None: 
             return 
 
-        self.thegraph_time.axvline(\
+        self.ephem_artists.append(self.thegraph_time.axvline(\
          Ephem.twilight_prev_set+timedelta(hours=config._local_timezone),\
-         color='black', ls='dashdot', lw=1, alpha=0.75, clip_on=True)
-        self.thegraph_time.axvline(\
+         color='black', ls='dashdot', lw=1, alpha=0.75, clip_on=True))
+        self.ephem_artists.append(self.thegraph_time.axvline(\
          Ephem.twilight_next_rise+timedelta(hours=config._local_timezone),\
-         color='black', ls='dashdot', lw=1, alpha=0.75, clip_on=True)
+         color='black', ls='dashdot', lw=1, alpha=0.75, clip_on=True))
 
     def make_subplot_sunalt(self,twinplot=0):
         '''
@@ -512,6 +483,25 @@ class Plot(object):
         self.thegraph_sunalt.grid(True,which='minor',
                 alpha=0.2,color='k',ls='solid',lw=0.5)
 
+        # Lines (pre and after-midnight) and labels, filled by plot_data_sunalt
+        self.sunalt_premidnight, = self.thegraph_sunalt.plot([],[],color='#2ca02c')
+        self.sunalt_aftermidnight, = self.thegraph_sunalt.plot([],[],color='#1f77b4')
+
+        # Make limits on data range.
+        self.thegraph_sunalt.set_xlim([\
+         config.limits_sunalt[0]*np.pi/180.,\
+         config.limits_sunalt[1]*np.pi/180.])
+        self.thegraph_sunalt.set_ylim(config.limits_nsb)
+
+        self.sunalt_serial = self.thegraph_sunalt.text(0.00,1.015,'',\
+         color='0.25',fontsize='small',fontname='monospace',\
+         transform = self.thegraph_sunalt.transAxes)
+
+        self.sunalt_premidnight_label = self.thegraph_sunalt.text(0.75,0.92,'',\
+         color='#2ca02c',fontsize='small',transform = self.thegraph_sunalt.transAxes)
+        self.sunalt_aftermidnight_label = self.thegraph_sunalt.text(0.75,0.84,'',\
+         color='#1f77b4',fontsize='small',transform = self.thegraph_sunalt.transAxes)
+
     def make_subplot_time(self,twinplot=0):
         '''
         Make a subplot.
@@ -561,6 +551,25 @@ class Plot(object):
         self.thegraph_time.grid(True,which='minor',
                 alpha=0.2,color='k',ls='solid',lw=0.5)
 
+        # Lines (pre and after-midnight) and labels, filled by plot_data_time
+        self.time_premidnight, = self.thegraph_time.plot([],[],color='#2ca02c')
+        self.time_aftermidnight, = self.thegraph_time.plot([],[],color='#1f77b4')
+
+        # Vertical line to mark 0h
+        self.thegraph_time.axvline(\
+         self.Night+timedelta(days=1),
+         color='black', alpha=0.75,lw=1,ls='solid',clip_on=True)
+
+        self.thegraph_time.set_ylim(config.limits_nsb)
+
+        self.time_serial = self.thegraph_time.text(0.00,1.015,'',\
+         color='0.25',fontsize='small',fontname='monospace',\
+         transform = self.thegraph_time.transAxes)
+
+        self.time_moon = self.thegraph_time.text(0.75,1.015,'',\
+         color='black',fontsize='small',fontname='monospace',\
+         transform = self.thegraph_time.transAxes)
+
     def make_figure(self,thegraph_altsun=True,thegraph_time=True):
         # Make the figure and the graph
         if thegraph_time==False:
@@ -586,15 +595,14 @@ class Plot(object):
         '''
 
         # Mean datetime
-        dts       = Data.all_night_dt
-        mean_dt   = dts[0]+np.sum(np.array(dts)-dts[0])/np.size(dts)
-        sel_night = (mean_dt - timedelta(hours=12)).date()
+        utc_times = Data.utc_times
+        mean_dt   = utc_times[0]+np.mean(utc_times-utc_times[0])
+        sel_night = (mean_dt-np.timedelta64(12,'h')).astype('datetime64[D]')
 
-        Data.premidnight.filter = np.array(\
-         [Date.date()==sel_night for Date in Data.premidnight.localdates])
-        Data.aftermidnight.filter = np.array(\
-         [(Date-timedelta(days=1)).date()==sel_night\
-           for Date in Data.aftermidnight.localdates])
+        Data.premidnight.filter = \
+         Data.premidnight.local_times.astype('datetime64[D]')==sel_night
+        Data.aftermidnight.filter = \
+         (Data.aftermidnight.local_times-np.timedelta64(1,'D')).astype('datetime64[D]')==sel_night
 
         return(Data)
 
@@ -604,86 +612,44 @@ class Plot(object):
         '''
         # Plot the data
         TheData = Data.premidnight
-        if np.size(TheData.filter)>0:
-            self.thegraph_sunalt.plot(\
-             np.array(TheData.sun_altitude)[TheData.filter],\
-             np.array(TheData.night_sbs)[TheData.filter],color='#2ca02c')
-            '''
-            self.thegraph_sunalt.plot(\
-             np.array(TheData.sun_altitude)[TheData.filter],\
-             np.array(TheData.temperatures)[TheData.filter],color='#9467bd',alpha=0.5))
-            '''
+        self.sunalt_premidnight.set_data(\
+         np.array(TheData.sun_altitude)[TheData.filter],\
+         np.array(TheData.night_sbs)[TheData.filter])
         TheData = Data.aftermidnight
-        if np.size(TheData.filter)>0:
-            self.thegraph_sunalt.plot(\
-             np.array(TheData.sun_altitude)[TheData.filter],\
-             np.array(TheData.night_sbs)[TheData.filter],color='#1f77b4')
-            '''
-            self.thegraph_sunalt.plot(\
-             np.array(TheData.sun_altitude)[TheData.filter],\
-             np.array(TheData.temperatures)[TheData.filter],color='#9467bd',alpha=0.5))
-            '''
-
-        # Make limits on data range.
-        self.thegraph_sunalt.set_xlim([\
-         config.limits_sunalt[0]*np.pi/180.,\
-         config.limits_sunalt[1]*np.pi/180.])
-        self.thegraph_sunalt.set_ylim(config.limits_nsb)
+        self.sunalt_aftermidnight.set_data(\
+         np.array(TheData.sun_altitude)[TheData.filter],\
+         np.array(TheData.night_sbs)[TheData.filter])
 
         premidnight_label = str(Data.premidnight.label_dates).replace('[','').replace(']','')
         aftermidnight_label = str(Data.aftermidnight.label_dates).replace('[','').replace(']','')
 
-        self.thegraph_sunalt.text(0.00,1.015,\
-         config._device_shorttype+'-'+config._observatory_name+' '*5+'Serial #'+str(Data.serial_number),\
-         color='0.25',fontsize='small',fontname='monospace',\
-         transform = self.thegraph_sunalt.transAxes)
-
-        self.thegraph_sunalt.text(0.75,0.92,'PM: '+premidnight_label,\
-         color='#2ca02c',fontsize='small',transform = self.thegraph_sunalt.transAxes)
-        self.thegraph_sunalt.text(0.75,0.84,'AM: '+aftermidnight_label,\
-         color='#1f77b4',fontsize='small',transform = self.thegraph_sunalt.transAxes)
+        self.sunalt_serial.set_text(\
+         config._device_shorttype+'-'+config._observatory_name+' '*5+'Serial #'+str(Data.serial_number))
 
-        '''
-        if np.size(Data.Night)==1:
-            self.thegraph_sunalt.text(0.75,1.015,'Moon: %d%s (%d%s)' \
-             %(Ephem.moon_phase, "%", Ephem.moon_maxelev*180./np.pi,"$^\mathbf{o}$"),\
-             color='#d62728',fontsize='small',fontname='monospace',\
-             transform = self.thegraph_sunalt.transAxes)
-        '''
+        self.sunalt_premidnight_label.set_text('PM: '+premidnight_label)
+        self.sunalt_aftermidnight_label.set_text('AM: '+aftermidnight_label)
 
     def plot_data_time(self,Data,Ephem):
         '''
         Plot NSB data vs Sun altitude
         '''
 
-        # Plot the data (NSB and temperature)
+        # Plot the data (NSB)
         TheData = Data.premidnight
-        if np.size(TheData.filter)>0:
-            self.thegraph_time.plot(\
-             np.array(TheData.localdates)[TheData.filter],\
-             np.array(TheData.night_sbs)[TheData.filter],color='#2ca02c')
-            '''
-            self.thegraph_time_temp.plot(\
-             np.array(TheData.localdates)[TheData.filter],\
-             np.array(TheData.temperatures)[TheData.filter],color='#9467bd',alpha=0.5)
-            '''
-
-
+        self.time_premidnight.set_data(\
+         np.array(TheData.localdates)[TheData.filter],\
+         np.array(TheData.night_sbs)[TheData.filter])
         TheData = Data.aftermidnight
-        if np.size(TheData.filter)>0:
-            self.thegraph_time.plot(\
-             np.array(TheData.localdates)[TheData.filter],\
-             np.array(TheData.night_sbs)[TheData.filter],color='#1f77b4')
-            '''
-            self.thegraph_time_temp.plot(\
-             np.array(TheData.localdates)[TheData.filter],\
-             np.array(TheData.temperatures)[TheData.filter],color='#9467bd',alpha=0.5)
-            '''
+        self.time_aftermidnight.set_data(\
+         np.array(TheData.localdates)[TheData.filter],\
+         np.array(TheData.night_sbs)[TheData.filter])
 
-        # Vertical line to mark 0h
-        self.thegraph_time.axvline(\
-         Data.Night+timedelta(days=1),
-         color='black', alpha=0.75,lw=1,ls='solid',clip_on=True)
+        self.time_serial.set_text(\
+         config._device_shorttype+'-'+config._observatory_name+' '*5+'Serial #'+str(Data.serial_number))
+
+        if np.size(Data.Night)==1:
+            self.time_moon.set_text('Moon: %d%s (%d%s)' \
+             %(Ephem.moon_phase, "%", Ephem.moon_maxelev*180./np.pi,"$^\mathbf{o}$"))
 
         # Set the xlimit for the time plot.
         if np.size(Data.premidnight.filter)>0:
@@ -709,21 +675,6 @@ class Plot(object):
             return(None)
 
         self.thegraph_time.set_xlim(begin_plot_dt,end_plot_dt)
-        self.thegraph_time.set_ylim(config.limits_nsb)
-
-        premidnight_label = str(Data.premidnight.label_dates).replace('[','').replace(']','')
-        aftermidnight_label = str(Data.aftermidnight.label_dates).replace('[','').replace(']','')
-
-        self.thegraph_time.text(0.00,1.015,\
-         config._device_shorttype+'-'+config._observatory_name+' '*5+'Serial #'+str(Data.serial_number),\
-         color='0.25',fontsize='small',fontname='monospace',\
-         transform = self.thegraph_time.transAxes)
-
-        if np.size(Data.Night)==1:
-            self.thegraph_time.text(0.75,1.015,'Moon: %d%s (%d%s)' \
-             %(Ephem.moon_phase, "%", Ephem.moon_maxelev*180./np.pi,"$^\mathbf{o}$"),\
-             color='black',fontsize='small',fontname='monospace',\
-             transform = self.thegraph_time.transAxes)
 
     def save_figure(self,output_filename):
         self.thefigure.savefig(output_filename, bbox_inches='tight',dpi=150)
@@ -732,7 +683,30 @@ class Plot(object):
         plt.show(self.thefigure)
 
     def close_figure(self):
-        plt.close('all')
+        plt.close(self.thefigure)
+
+
+# Figure of the last night plotted (see night_plot)
+_night_plot = None
+
+
+def night_plot(Data,Ephem):
+    '''
+    Plot of the night of Data. The figure of the previous plot is
+    reused (and only its data updated) if it is for the same night,
+    else it is closed and a new one is made.
+    '''
+    global _night_plot
+    try: full_plot = config.full_plot
+    except AttributeError: full_plot = False
+    if _night_plot is not None and \
+     _night_plot.Night==Data.Night and _night_plot.full_plot==full_plot:
+        _night_plot.update(Data,Ephem)
+    else:
+        if _night_plot is not None:
+            _night_plot.close_figure()
+        _night_plot = Plot(Data,Ephem)
+    return(_night_plot)
 
 
 def save_stats_to_file(Night,NSBData,Ephem):
@@ -829,11 +803,12 @@ def save_stats_to_file(Night,NSBData,Ephem):
     append_file(statistics_filename,formatted_data)
 
 
-def make_plot(input_filename=None,send_emails=False,write_stats=False):
+def make_plot(input_filename=None,send_emails=False,write_stats=False,state=None):
     '''
     Main function (allows to execute the program
     from within python.
      - Extracts the NSB data from a given data file
+       (or from the measures of state, a nightstate.NightState)
      - Performs statistics
      - Save statistics to file
      - Create the plot
@@ -849,7 +824,10 @@ def make_plot(input_filename=None,send_emails=False,write_stats=False):
     Ephem = Ephemerids()
 
     # Get and process the data from input_filename
-    NSBData = SQMData(input_filename,Ephem)
+    if state is not None and len(state)>0:
+        NSBData = state.sqmdata()
+    else:
+        NSBData = SQMData(input_filename,Ephem)
 
     # Moon and twilight ephemerids.
     Ephem.calculate_moon_ephems(thedate=NSBData.Night)
@@ -863,7 +841,8 @@ def make_plot(input_filename=None,send_emails=False,write_stats=False):
         save_stats_to_file(NSBData.Night,NSBData,Ephem)
 
     # Plot the data and save the resulting figure
-    NSBPlot = Plot(NSBData,Ephem)
+    # (the figure is kept for the next plots of the night)
+    NSBPlot = night_plot(NSBData,Ephem)
 
     output_filenames = [\
         str("%s/%s_%s.png" %(config.data_directory,\
@@ -876,9 +855,6 @@ def make_plot(input_filename=None,send_emails=False,write_stats=False):
     for output_filename in output_filenames:
         NSBPlot.save_figure(output_filename)
 
-    # Close figure
-    NSBPlot.close_figure()
-
     if send_emails == True:
         import pysqm.email
         night_label = str(datetime.date.today()-timedelta(days=1))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+'''
+PySQM plot worker
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+The plots (and the night statistics) are made by a separate process,
+so the measures are never delayed by matplotlib. The main loop only
+puts requests in a queue:
+ - load: start the night state from a data file,
+ - append: data lines of new measures (the process keeps its own
+   in-memory night state, see pysqm.nightstate),
+ - plot: plot the night state, or a data file (end of the night,
+   with the statistics and the emails).
+
+The process takes all the pending requests at once. The data lines
+are appended in order, but a periodic plot is skipped if another plot
+is pending after it (only the newest state is drawn). Plots with
+statistics or emails are never skipped.
+
+The process is spawned (not forked), so it does not inherit the
+sockets, files and threads of the main process (e.g. a duplicate of
+the SQM-LE connection would keep it open for the device).
+
+A dead plot process is started again at the next request (waiting a
+bit more after each restart, the requests are dropped meanwhile), with
+a new queue and the night state loaded again from the data file and
+the records not yet written to it.
+____________________________
+'''
+
+import sys
+import time
+import atexit
+import queue
+import multiprocessing
+
+import pysqm.settings as settings
+config = settings.GlobalConfig.config
+
+
+def plot_process(requests,config_filename):
+    '''
+    Make the requested plots, forever.
+    '''
+    # Not a copy of the parent process (e.g. Windows)? Read the config.
+    if settings.GlobalConfig.config is None:
+        settings.GlobalConfig.read_config_file(config_filename)
+
+    import pysqm.plot
+    from pysqm.nightstate import night_state
+    State = night_state(settings.GlobalConfig.config)
+
+    while 1<2:
+        messages = [requests.get()]
+        while 1<2:
+            try: messages.append(requests.get_nowait())
+            except queue.Empty: break
+
+        lines = []
+        for k,message in enumerate(messages):
+            if message is None:
+                return
+            kind = message[0]
+            if kind=='append':
+                lines.append(message[1])
+                continue
+            # Add the pending lines before anything else
+            if lines:
+                State.append(''.join(lines))
+                lines = []
+            if kind=='load':
+                State.serial_number = message[2]
+                State.load(message[1])
+                if message[3]:
+                    State.append(message[3])
+            elif kind=='plot':
+                options = message[1]
+                periodic = not (options['write_stats'] or options['send_emails'])
+                if periodic and \
+                 any(later is not None and later[0]=='plot' for later in messages[k+1:]):
+                    continue
+                try:
+                    pysqm.plot.make_plot(\
+                     state=(State if options['use_state'] else None),\
+                     send_emails=options['send_emails'],\
+                     write_stats=options['write_stats'])
+                except:
+                    print('Warning: Error plotting data.')
+                    print(sys.exc_info())
+        if lines:
+            State.append(''.join(lines))
+
+
+class PlotWorker(object):
+    '''
+    Queue of requests for the plot process.
+    pending_data(filename): records of filename not yet written (cached).
+    '''
+    def __init__(self,pending_data=None,max_restart_delay=300):
+        self.context = multiprocessing.get_context('spawn')
+        self.pending_data = pending_data
+        self.requests = None
+        self.process = None
+        self.loaded = None
+        self.max_restart_delay = max_restart_delay
+        self.restarts = 0
+        self.next_start = 0.
+        atexit.register(self.stop)
+
+    def start(self):
+        # The queue may be locked by the dead process, make a new one
+        self.requests = self.context.Queue()
+        self.process = self.context.Process(\
+         target=plot_process,args=(self.requests,config.__file__),\
+         name='pysqm-plot',daemon=True)
+        self.process.start()
+
+    def check_process(self):
+        ''' Start the process if needed. Return True if (re)started '''
+        if self.process is not None and self.process.is_alive():
+            return(False)
+        now = time.time()
+        if self.process is not None:
+            # Crashed. Wait a bit more after each restart.
+            print('Plot process died (exit code %s)' %str(self.process.exitcode))
+            self.restarts += 1
+            self.next_start = now+min(\
+             self.max_restart_delay,2**min(self.restarts,10))
+            self.process = None
+        if now>=self.next_start:
+            self.start()
+            return(True)
+        return(False)
+
+    def request(self,message):
+        if self.check_process() and self.loaded is not None and message[0]!='load':
+            # Started again: the night state from the data file
+            self.requests.put(self.load_message(*self.loaded))
+            if message[0]=='append':
+                # Already in the data file or in the cache
+                return
+        if self.process is not None:
+            self.requests.put(message)
+
+    def load_message(self,filename,serial_number):
+        pending = ""
+        if self.pending_data is not None:
+            pending = self.pending_data(filename)
+        return(('load',filename,serial_number,pending))
+
+    def load(self,filename,serial_number):
+        ''' Start the night state from a data file (and its cached records) '''
+        self.loaded = (filename,str(serial_number))
+        self.request(self.load_message(*self.loaded))
+
+    def append(self,formatted_data):
+        ''' Data lines (as written in the data files), once saved or cached '''
+        if formatted_data!="":
+            self.request(('append',formatted_data))
+
+    def plot(self,send_emails=False,write_stats=False,use_state=True):
+        '''
+        Plot the night state (or the current data file if not use_state)
+        '''
+        self.request(('plot',{'send_emails':send_emails,\
+         'write_stats':write_stats,'use_state':use_state}))
+
+    def stop(self,timeout=60):
+        ''' Finish the pending requests and stop the process '''
+        if self.process is None or not self.process.is_alive():
+            return
+        self.requests.put(None)
+        self.process.join(timeout)
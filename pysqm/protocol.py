@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+'''
+PySQM protocol parser
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Single pass parsers for the rx/ix/cx replies. Each reply is validated
+and all its fields extracted by one regular expression, working on the
+raw bytes (or memoryview) from the device without intermediate strings.
+
+Example of replies:
+ r, 19.23m,0000000002Hz,0000000000c,0000000.000s, 027.0C
+ i,00000004,00000003,00000060,00000413
+ c,00000019.84m,0000151.517s, 022.2C,00000008.71m, 023.2C
+
+Compare with the previous (str based) parser:
+> python -m pysqm.protocol
+____________________________
+'''
+
+import re
+import time
+import numpy as np
+
+RX_REGEX = \
+ r'r,\s*(-?\d+\.\d+)m,\s*(\d+)Hz,\s*(\d+)c,\s*(\d+\.\d+)s,\s*(-?\d+\.\d+)C'
+IX_REGEX = \
+ r'i,\s*(\d+),\s*(\d+),\s*(\d+),\s*(\d+)'
+CX_REGEX = \
+ r'c,\s*(-?\d+\.\d+)m,\s*(\d+\.\d+)s,\s*(-?\d+\.\d+)C,\s*(-?\d+\.\d+)m,\s*(-?\d+\.\d+)C'
+
+# Patterns for bytes-like replies (the fast path) and for str
+RX_BYTES = re.compile(RX_REGEX.encode())
+IX_BYTES = re.compile(IX_REGEX.encode())
+CX_BYTES = re.compile(CX_REGEX.encode())
+RX_STR = re.compile(RX_REGEX)
+IX_STR = re.compile(IX_REGEX)
+CX_STR = re.compile(CX_REGEX)
+
+# Below this frequency (Hz) the period is more precise
+LOW_FREQUENCY = 30
+
+
+def match_reply(reply,bytes_pattern,str_pattern):
+    pattern = str_pattern if isinstance(reply,str) else bytes_pattern
+    match = pattern.search(reply)
+    if match is None:
+        if not isinstance(reply,str):
+            reply = bytes(reply)
+        raise ValueError('Invalid reply: %r' %reply)
+    return(match)
+
+
+def parse_rx(reply):
+    '''
+    Validate and parse a rx reply.
+    Return (temperature,frequency,ticks,sky_brightness).
+    '''
+    mag,freq,ticks,period,temp = match_reply(reply,RX_BYTES,RX_STR).groups()
+    freq   = float(freq)
+    period = float(period)
+
+    # For low frequencies, use the period instead
+    if freq<LOW_FREQUENCY and period>0:
+        freq = 1./period
+
+    return(float(temp),freq,float(ticks),float(mag))
+
+
+def parse_ix(reply):
+    '''
+    Validate and parse a ix reply.
+    Return (protocol_number,model_number,feature_number,serial_number).
+    '''
+    return(tuple(int(value) for value in \
+     match_reply(reply,IX_BYTES,IX_STR).groups()))
+
+
+def parse_cx(reply):
+    '''
+    Validate and parse a cx reply.
+    Return (light_offset,dark_period,temperature_light,
+     sensor_offset,temperature_dark)
+    '''
+    return(tuple(float(value) for value in \
+     match_reply(reply,CX_BYTES,CX_STR).groups()))
+
+
+'''
+Fixed width stream parser.
+The device pads every rx field with zeros, so all the replies have the
+same layout. A buffer of such replies is viewed (without copies) as a
+2D array of bytes, validated against the template and converted to
+numbers with array operations.
+ '#' digit, '?' sign (space or minus), anything else must match.
+'''
+RX_TEMPLATE = b'r,?##.##m,##########Hz,##########c,#######.###s,?###.#C\r\n'
+RX_FIELDS = ['mag','freq','ticks','period','temp']
+
+def template_layout(template):
+    '''
+    Weight matrix (line bytes -> numeric fields) and sign positions
+    of a fixed width template.
+    '''
+    weights = np.zeros((len(template),0))
+    signs = []
+    k = 0
+    while k<len(template):
+        if template[k:k+1] not in (b'#',b'?'):
+            k += 1
+            continue
+        start = k
+        while k<len(template) and template[k:k+1] in (b'#',b'?',b'.'):
+            k += 1
+        number = template[start:k]
+        point = number.find(b'.')
+        ndecimals = 0 if point<0 else len(number)-point-1
+        digits = [start+j for j,char in enumerate(number) if char==ord('#')]
+        column = np.zeros((len(template),1))
+        column[digits,0] = 10.**np.arange(len(digits)-ndecimals-1,-ndecimals-1,-1)
+        weights = np.hstack([weights,column])
+        signs.append(start if number[:1]==b'?' else None)
+    return(weights,signs)
+
+RX_WEIGHTS,RX_SIGNS = template_layout(RX_TEMPLATE)
+
+
+def parse_rx_fixed(data,chunk=4096):
+    '''
+    Parse a buffer of fixed width rx replies.
+    Return (values,valid): values has one column per RX_FIELDS,
+    valid flags the lines that match the template.
+    Return None if the buffer is not made of fixed width lines.
+    '''
+    size = len(RX_TEMPLATE)
+    raw = np.frombuffer(data,dtype=np.uint8)
+    if raw.size%size!=0:
+        return(None)
+    lines = raw.reshape(-1,size)
+
+    template = np.frombuffer(RX_TEMPLATE,dtype=np.uint8)
+    is_digit = (template==ord('#'))
+    is_sign  = (template==ord('?'))
+    is_fixed = ~(is_digit+is_sign)
+    digit_weights = RX_WEIGHTS[is_digit]
+
+    values = np.empty((len(lines),len(RX_FIELDS)))
+    valid  = np.empty(len(lines),dtype=bool)
+    for first in range(0,len(lines),chunk):
+        block = lines[first:first+chunk]
+        # Every byte must be the fixed char, a digit or a sign
+        digits = block-np.uint8(ord('0'))
+        ok = is_fixed*(block==template)
+        ok |= is_digit*(digits<=9)
+        ok |= is_sign*((block==ord(' '))+(block==ord('-')))
+        valid[first:first+chunk] = np.all(ok,axis=1)
+        values[first:first+chunk] = \
+         digits[:,is_digit].astype(np.float64)@digit_weights
+
+    for column,sign in enumerate(RX_SIGNS):
+        if sign is not None:
+            values[lines[:,sign]==ord('-'),column] *= -1
+
+    return(values,valid)
+
+
+def parse_rx_stream(data):
+    '''
+    Parse all the rx replies in a buffer (e.g. a replayed capture).
+    Invalid lines are skipped.
+    Return (temperature,frequency,ticks,sky_brightness) arrays.
+    '''
+    fixed = parse_rx_fixed(data)
+    if fixed is not None and np.any(fixed[1]):
+        values = fixed[0][fixed[1]]
+        if not np.all(fixed[1]):
+            print('Warning: %d invalid rx lines skipped' %np.sum(~fixed[1]))
+    else:
+        # Variable width lines
+        fields = RX_BYTES.findall(data)
+        if len(fields)==0:
+            return(tuple(np.zeros(0) for k in range(4)))
+        values = np.array(fields,dtype=float)
+
+    mag,freq,ticks,period,temp = values.T
+    low_frequency = (freq<LOW_FREQUENCY)*(period>0)
+    freq[low_frequency] = 1./period[low_frequency]
+    return(temp,freq,ticks,mag)
+
+
+def benchmark(nlines=200000):
+    '''
+    Lines per second of the old str based parser (format_value chain),
+    the single reply parser and the stream parser.
+    '''
+    from pysqm.common import format_value
+
+    def old_data_process(msg,sep=','):
+        msg = format_value(msg)
+        msg_array = msg.split(sep)
+        sky_brightness = float(format_value(msg_array[1],'m'))
+        freq_sensor    = float(format_value(msg_array[2],'Hz'))
+        ticks_uC       = float(format_value(msg_array[3],'c'))
+        period_sensor  = float(format_value(msg_array[4],'s'))
+        temp_sensor    = float(format_value(msg_array[5],'C'))
+        if freq_sensor<30 and period_sensor>0:
+            freq_sensor = 1./period_sensor
+        return(temp_sensor,freq_sensor,ticks_uC,sky_brightness)
+
+    reply = b'r, 19.23m,0000000002Hz,0000000000c,0000000.500s, 027.0C\r\n'
+    stream = reply*nlines
+    results = {}
+
+    start = time.perf_counter()
+    for k in range(nlines):
+        old_data_process(reply.decode())
+    results['format_value'] = nlines/(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    view = memoryview(stream)
+    size = len(reply)
+    for k in range(nlines):
+        parse_rx(view[k*size:(k+1)*size])
+    results['parse_rx'] = nlines/(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    parse_rx_stream(stream)
+    results['parse_rx_stream'] = nlines/(time.perf_counter()-start)
+
+    assert(old_data_process(reply.decode())==parse_rx(reply))
+    return(results)
+
+
+if __name__ == '__main__':
+    for name,rate in benchmark().items():
+        print('%-16s %12.0f lines/s' %(name,rate))
@@ -25,12 +25,21 @@ ____________________________
 '''
 
 import os,sys
+import glob
+import json
 import inspect
+import atexit
+import contextlib
+import concurrent.futures
+import asyncio
 import time
+import random
+import selectors
 import datetime
 import numpy as np
 import struct
 import socket
+import sqlite3
 from zoneinfo import ZoneInfo
 
 # Default, to ignore the length of the read string.
@@ -39,6 +48,13 @@ _meta_len_ = None
 _data_len_ = None
 
 from pysqm.common import *
+from pysqm.clipping import clipped_mean
+from pysqm.protocol import parse_rx,parse_ix,parse_cx
+from pysqm.connection import SQMLEConnection
+from pysqm.writer import DataWriter,exit_on_sigterm
+from pysqm.nightstore import NightStore,store_directory
+from pysqm.sinks import SQLiteSink,sqlite_filename,mysql_sink
+from pysqm.datacenter import datacenter_sender
 
 '''
 This import section is only for software build purposes.
@@ -73,52 +89,188 @@ config._device_type = config._device_type.replace('_','-')
 
 if config._device_type == 'SQM-LE':
     import socket
-elif config._device_type == 'SQM-LU':
+# SQM-LU devices (may be used by the supervisor with any _device_type)
+try:
     import serial
+except ImportError:
+    if config._device_type == 'SQM-LU': raise
 if config._use_mysql == True:
-    from MySQLdb import _mysql as mysql
+    import MySQLdb
 
 
 def filtered_mean(array,sigma=3):
     # Our data probably contains outliers, filter them
-    # Notes:
-    #   Median is more robust than mean
-    #    Std increases if the outliers are far away from real values.
-    #    We need to limit the amount of discrepancy we want in the data (20%?).
-
-    # We will use data masking and some operations with arrays. Convert to numpy.
-    array = np.array(array)
-
-    # Get the median and std.
-    data_median = np.median(array)
-    data_std    = np.std(array)
-
-    # Max discrepancy we allow.
-    fixed_max_dev  = 0.2*data_median
-    clip_deviation = np.min([fixed_max_dev,data_std*sigma+0.1])
-
-    # Create the filter (10% flux + variable factor)
-    filter_values_ok = np.abs(array-data_median)<=clip_deviation
-    filtered_values = array[filter_values_ok]
-
-    # Return the mean of filtered data or the median.
-    if np.size(filtered_values)==0:
-        print('Warning: High dispersion found on last measures')
-        filtered_mean = data_median
-    else:
-        filtered_mean = np.mean(filtered_values)
-
-    return(filtered_mean)
+    # (median +- min(20%, sigma*std+0.1), see pysqm.clipping)
+    means,mask = clipped_mean(np.reshape(array,(-1,1)),sigma=sigma)
+    return(means[0])
+
+
+def written_records(filename,offset):
+    '''
+    Number of complete data records in filename after offset
+    (None if the file did not exist: skip the header instead).
+    '''
+    try:
+        with open(filename,'rb') as datafile:
+            datafile.seek(offset or 0)
+            lines = datafile.read().splitlines(True)
+    except OSError:
+        return(0)
+    return(len([line for line in lines \
+     if line.endswith(b'\n') and not line.startswith(b'#')]))
+
+
+def search_sqmle(timeout=3):
+    '''
+    Search SQM LE devices in the LAN (Lantronix discovery, UDP port 30718).
+    Wait (without busy looping) for the f7 replies until timeout.
+    Return a list of (address,MAC) for all the devices found.
+    '''
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.setblocking(False)
+
+    if hasattr(socket,'SO_BROADCAST'):
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    selector = selectors.DefaultSelector()
+    selector.register(udp,selectors.EVENT_READ)
+
+    print("Looking for replies; press Ctrl-C to stop")
+    udp.sendto(bytes.fromhex("000000f6"), ("255.255.255.255", 30718))
+
+    found = {}
+    timelimit = time.time()+timeout
+    try:
+        while True:
+            # Allow all devices time to respond
+            remaining = timelimit-time.time()
+            if remaining<=0 or not selector.select(remaining):
+                break
+            try:
+                (buf, addr) = udp.recvfrom(64)
+            except (BlockingIOError,ConnectionResetError):
+                continue
+            if len(buf)>=30 and buf[3]==0xf7 and addr[0] not in found:
+                found[addr[0]] = buf[24:30].hex()
+                print("Received from %s: MAC: %s" %(addr, found[addr[0]]))
+    finally:
+        selector.close()
+        udp.close()
+
+    return(list(found.items()))
+
+
+class ConnectionState(object):
+    '''
+    Connection state machine shared by the photometer readers.
+    On each failed read it decides the recovery action:
+     - resync: drop pending bytes and ask again (cheap)
+     - reconnect: close and reopen the connection
+    and the (bounded, exponential) delay before the next attempt.
+    It also keeps the failure counters of the device.
+    '''
+    CONNECTED = 'connected'
+    RESYNC    = 'resync'
+    RECONNECT = 'reconnect'
+
+    def __init__(self,resync_tries=2,backoff_min=0.1,backoff_max=5.):
+        self.resync_tries = resync_tries
+        self.backoff_min  = backoff_min
+        self.backoff_max  = backoff_max
+        self.state = self.CONNECTED
+        self.consecutive_failures = 0
+        self.failure_start = None
+        self.last_recovery_time = None
+        self.counters = {\
+         'reads':0,'failures':0,'resyncs':0,'reconnects':0,'lost':0}
+
+    def success(self):
+        ''' A valid reply was received '''
+        self.counters['reads'] += 1
+        if self.failure_start is not None:
+            self.last_recovery_time = time.time()-self.failure_start
+        self.state = self.CONNECTED
+        self.consecutive_failures = 0
+        self.failure_start = None
+
+    def failure(self):
+        ''' A read failed. Return the next recovery action '''
+        self.counters['failures'] += 1
+        self.consecutive_failures += 1
+        if self.failure_start is None:
+            self.failure_start = time.time()
+
+        if self.consecutive_failures<=self.resync_tries:
+            self.state = self.RESYNC
+            self.counters['resyncs'] += 1
+        else:
+            self.state = self.RECONNECT
+            self.counters['reconnects'] += 1
+        return(self.state)
+
+    def give_up(self):
+        ''' All the tries failed, the measure is lost '''
+        self.counters['lost'] += 1
+
+    def backoff(self):
+        ''' Seconds to wait before the next attempt '''
+        return(min(self.backoff_max,\
+         self.backoff_min*2**max(0,self.consecutive_failures-1)))
+
+
+class FaultInjector(object):
+    '''
+    Fault injection hook for the photometer readers (testing only).
+    Replies are dropped, delayed or garbled with the given
+    probabilities, e.g.:
+      mydevice.fault_injector = FaultInjector(drop=0.1,garble=0.05,delay=0.5)
+    The asyncio readers (pysqm.asyncread) use inject, with a non
+    blocking delay.
+    '''
+    def __init__(self,drop=0.,garble=0.,delay=0.,seed=None):
+        self.drop   = drop
+        self.garble = garble
+        self.delay  = delay
+        self.random = random.Random(seed)
+        self.injected = {'drop':0,'garble':0,'delay':0}
+
+    def __call__(self,reply):
+        if self.delay>0:
+            self.injected['delay'] += 1
+            time.sleep(self.delay)
+        return(self.corrupt(reply))
+
+    async def inject(self,reply):
+        ''' Same as calling it, for the asyncio readers (the loop is not blocked) '''
+        if self.delay>0:
+            self.injected['delay'] += 1
+            await asyncio.sleep(self.delay)
+        return(self.corrupt(reply))
+
+    def corrupt(self,reply):
+        ''' Drop or garble the reply '''
+        if self.random.random()<self.drop:
+            self.injected['drop'] += 1
+            raise TimeoutError('Injected fault: reply dropped')
+        if self.random.random()<self.garble:
+            self.injected['garble'] += 1
+            position = self.random.randrange(max(1,len(reply)))
+            garbage = '#' if isinstance(reply,str) else b'#'
+            reply = reply[:position]+garbage+reply[position+1:]
+        return(reply)
 
 
 class device(observatory):
+    # Device type in the header (default: config._device_type)
+    device_type = None
+
     def standard_file_header(self):
         # Data Header, at the end of this script.
         header_content=RAWHeaderContent
 
         # Update data file header with observatory data
         header_content = header_content.replace(\
-         '$DEVICE_TYPE',str(config._device_type))
+         '$DEVICE_TYPE',str(self.device_type or config._device_type))
         header_content = header_content.replace(\
          '$DEVICE_ID',str(config._device_id))
         header_content = header_content.replace(\
@@ -187,6 +339,15 @@ class device(observatory):
 
         return(formatted_data)
 
+    def observatory_label(self):
+        # Observatory name used in the data filenames.
+        # Stations with several devices add the device name.
+        try: name = self.name
+        except AttributeError: name = None
+        if name is None:
+            return(config._observatory_name)
+        return(config._observatory_name+'-'+str(name))
+
     def define_filenames(self):
         # Filenames should follow a standard based on observatory name and date.
         date_time_file = self.local_datetime(\
@@ -194,151 +355,216 @@ class device(observatory):
         date_file = date_time_file.date()
         yearmonth = str(date_file)[0:7]
         yearmonthday = str(date_file)[0:10]
+        observatory_name = self.observatory_label()
 
         self.monthly_datafile = \
          config.data_directory+"/"+config._device_shorttype+\
-         "_"+config._observatory_name+"_"+yearmonth+".dat"
+         "_"+observatory_name+"_"+yearmonth+".dat"
         #self.daily_datafile = \
         # config.daily_data_directory+"/"+config._device_shorttype+\
         # "_"+config._observatory_name+"_"+yearmonthday+".dat"
         self.daily_datafile = \
          config.daily_data_directory+"/"+\
          yearmonthday.replace('-','')+'_120000_'+\
-         config._device_shorttype+'-'+config._observatory_name+'.dat'
+         config._device_shorttype+'-'+observatory_name+'.dat'
         self.current_datafile = \
          config.data_directory+"/"+config._device_shorttype+\
-         "_"+config._observatory_name+".dat"
+         "_"+observatory_name+".dat"
 
-    def save_data(self,formatted_data):
+    def save_data(self,formatted_data,datafiles=None):
         '''
         Save data to file and duplicate to current
-        data file (the one that will be ploted)
+        data file (the one that will be ploted).
+        The files are kept open and only appended.
+        datafiles: (monthly,daily,current), default the current ones.
+        '''
+        if formatted_data=="":
+            return
+        try: self.writer
+        except AttributeError:
+            self.writer = DataWriter()
+
+        if datafiles is None:
+            datafiles = \
+             (self.monthly_datafile,self.daily_datafile,self.current_datafile)
+
+        # Night key (YYYYMMDD) of the daily file, for the monthly file index
+        night = os.path.basename(datafiles[1])[:8]
+        self.writer.write(*datafiles,\
+         header=self.standard_file_header,data=formatted_data,night=night)
+
+        try: use_nightstore = config._use_nightstore
+        except AttributeError: use_nightstore = False
+        if use_nightstore:
+            self.save_data_nightstore(formatted_data,datafiles[1])
+
+        try: use_sqlite = config._use_sqlite
+        except AttributeError: use_sqlite = False
+        if use_sqlite:
+            self.save_data_sqlite(formatted_data,night)
+
+    def save_data_nightstore(self,formatted_data,daily_datafile):
+        '''
+        Binary copy of the data (pysqm.nightstore), one
+        directory per night named as the daily data file.
         '''
-        for each_file in [self.monthly_datafile,self.daily_datafile]:
-            if not os.path.exists(each_file):
-                datafile = open(each_file,'w')
-                datafile.write(self.standard_file_header())
-                datafile.close()
+        try: self.nightstore
+        except AttributeError:
+            self.nightstore = NightStore(store_directory(config))
 
-            datafile = open(each_file,'a+')
-            datafile.write(formatted_data)
-            datafile.close()
+        night = os.path.basename(daily_datafile).rsplit('.',1)[0]
+        self.nightstore.append(night,formatted_data)
 
-        self.copy_file(self.daily_datafile,self.current_datafile)
 
+    def save_data_sqlite(self,formatted_data,night):
+        '''
+        Save data to the local SQLite database (pysqm.sinks),
+        one transaction per call.
+        '''
+        try: self.sqlite
+        except AttributeError:
+            try: fsync_policy = config._fsync_policy
+            except AttributeError: fsync_policy = 'flush'
+            self.sqlite = SQLiteSink(sqlite_filename(config),fsync_policy)
+
+        try:
+            self.sqlite.insert(self.observatory_label(),night,formatted_data)
+        except sqlite3.Error as ex:
+            print(str(inspect.stack()[0][2:4][::-1])+\
+             ' SQLite Error. Exception: %s' % str(ex))
 
     def save_data_datacenter(self,formatted_data):
         '''
         This function sends the data from this pysqm client to the central
         node @ UCM. It saves the data there (only the SQM data file contents)
+        The records are queued on disk and sent in batches by a
+        background thread (pysqm.datacenter.DatacenterSender).
         '''
-
-        # Connection details (hardcoded to avoid user changes)
-        DC_HOST = "muon.gae.ucm.es"
-        DC_PORT = 8739
         DEV_ID = str(config._device_id)+"_"+str(self.serial_number)
 
-        def send_data(data):
-            pass
-        #     try:
-        #         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #         client.connect((DC_HOST, DC_PORT))
-        #         client.sendall(data)
-        #         client.shutdown(socket.SHUT_RDWR)
-        #         client.close()
-        #     except:
-        #         return(0)
-        #     else:
-        #         return(1)
-
-        def write_buffer():
-            for data_line in self.DataBuffer[:]:
-                success = send_data(DEV_ID+";;D;;"+data_line)
-                if (success==1): self.DataBuffer.remove(data_line)
-
-            return(success)
+        try: self.datacenter
+        except AttributeError:
+            self.datacenter = datacenter_sender(config,DEV_ID,self.name)
 
         '''
         Send the new file initialization to the datacenter
-        Appends the header to the buffer (it will be sent later)
+        Appends the header to the queue (it will be sent later)
         '''
-
         if (formatted_data=="NEWFILE"):
-            self.DataBuffer=[\
-                hl+"\n" for hl in self.standard_file_header().split("\n")[:-1]]
-
-            # Try to connect with the datacenter and send the header
-            success = send_data(DEV_ID+";;C;;")
-            success = write_buffer()
-            return(success)
+            self.datacenter.put_header(self.standard_file_header())
         else:
+            self.datacenter.put(formatted_data)
 
-            '''
-            Send the data to the datacenter
-            '''
-
-            # If the buffer is full, dont append more data.
-            if (len(self.DataBuffer)<10000):
-                self.DataBuffer.append(formatted_data)
-
-            # Try to connect with the datacenter and send the data
-            success = write_buffer()
-            return(success)
+        return(1)
 
     def save_data_mysql(self,formatted_data):
         '''
         Use the Python MySQL API to save the
-        data to a database
+        data to a database. The data is spooled to disk and sent
+        by a background thread (pysqm.sinks.MySQLSink), so a slow or
+        unreachable server does not stop the measures.
         '''
-        mydb = None
-        values = formatted_data.split(';')
-        try:
-            ''' Start database connection '''
-            mydb = mysql.connect(\
-             host = config._mysql_host,
-             user = config._mysql_user,
-             password = config._mysql_pass,
-             database = config._mysql_database,
-             port = config._mysql_port)
-
-            ''' Insert the data '''
-            mysql_insert = "INSERT INTO "+str(config._mysql_dbtable)+" VALUES ('"+\
-             values[0]+"','"+values[1]+"',"+\
-             values[2]+","+values[3]+","+\
-             values[4]+","+values[5]+")"
-            mydb.query(mysql_insert)
-        except Exception as ex:
-            print(str(inspect.stack()[0][2:4][::-1])+\
-             ' DB Error. Exception: %s' % str(ex))
-            print(mysql_insert)
+        try: self.mysql
+        except AttributeError:
+            self.mysql = mysql_sink(config)
 
-        if mydb != None:
-            mydb.close()
+        self.mysql.put(formatted_data)
 
     def data_cache(self,formatted_data,number_measures=1,niter=0):
         '''
         Append data to DataCache str.
-        If len(data)>number_measures, write to file
-        and flush the cache
+        The cache is written to the files when it holds number_measures
+        records, when config._cache_seconds passed since the last write
+        or when a new night (new files) starts.
         '''
         try:
             self.DataCache
-        except:
-            self.DataCache=""
+        except AttributeError:
+            self.init_cache()
+
+        datafiles = \
+         (self.monthly_datafile,self.daily_datafile,self.current_datafile)
+        if self.DataCacheFiles is not None and datafiles!=self.DataCacheFiles:
+            # New night, the cached data goes to the previous files
+            self.flush_cache(sync=True)
 
         self.DataCache = self.DataCache+formatted_data
+        self.DataCacheSize += 1
+        self.DataCacheFiles = datafiles
+        print(str(niter)+'\t'+formatted_data[:-1])
+
+        try: cache_seconds = config._cache_seconds
+        except AttributeError: cache_seconds = 300
 
-        #if len(self.DataCache.split("\n"))>=number_measures+1:
-        self.save_data(self.DataCache)
+        if self.DataCacheSize>=number_measures or \
+         time.time()-self.DataCacheTime>=cache_seconds:
+            self.flush_cache()
+
+    def init_cache(self):
         self.DataCache = ""
-        print(str(niter)+'\t'+formatted_data[:-1])
-        #else:
-        #print("Invalid DataCache {} != {}".format(len(self.DataCache.split("\n")), number_measures+1))
+        self.DataCacheSize = 0
+        self.DataCacheFiles = None
+        self.DataCacheTime = time.time()
+        # Never lose the cached data
+        atexit.register(self.flush_cache,sync=True)
+        exit_on_sigterm()
+
+    def cache_state(self):
+        '''
+        Records not yet written (for the checkpoint), and the size of
+        the daily file, where they will be written.
+        '''
+        try:
+            daily_size = None
+            if self.DataCacheFiles is not None and \
+             os.path.exists(self.DataCacheFiles[1]):
+                daily_size = os.path.getsize(self.DataCacheFiles[1])
+            return({'data':self.DataCache,'size':self.DataCacheSize,\
+             'files':self.DataCacheFiles,'daily_size':daily_size})
+        except AttributeError:
+            return(None)
+
+    def restore_cache(self,state):
+        '''
+        Restore the records of cache_state(). The records written to
+        the daily file (after its size in the checkpoint) before the
+        checkpoint was updated are dropped.
+        '''
+        self.init_cache()
+        if state is None or state['files'] is None or state['data']=="":
+            return
+        records = state['data'].splitlines(True)
+        records = records[written_records(state['files'][1],state.get('daily_size')):]
+        if not records:
+            return
+        self.DataCache = ''.join(records)
+        self.DataCacheSize = len(records)
+        self.DataCacheFiles = tuple(state['files'])
+
+    def flush_cache(self,sync=False):
+        '''
+        Flush the data cache.
+        sync: end of the night (or of the program), the files
+        are synced to disk also with the 'night' fsync policy.
+        '''
+        try:
+            self.DataCache
+        except AttributeError:
+            return
 
-    def flush_cache(self):
-        ''' Flush the data cache '''
-        self.save_data(self.DataCache)
+        self.save_data(self.DataCache,self.DataCacheFiles)
         self.DataCache = ""
+        self.DataCacheSize = 0
+        self.DataCacheTime = time.time()
+
+        try: fsync_policy = config._fsync_policy
+        except AttributeError: fsync_policy = 'flush'
+
+        if fsync_policy=='flush' or (fsync_policy=='night' and sync):
+            try: self.writer.sync()
+            except AttributeError: pass
+            try: self.nightstore.sync()
+            except AttributeError: pass
 
     def copy_file(self,source,destination):
         # Copy file content from source to dest.
@@ -355,17 +581,42 @@ class device(observatory):
 
     def remove_currentfile(self):
         # Remove a file from the host
+        try: self.writer.close_file('current')
+        except AttributeError: pass
         if os.path.exists(self.current_datafile):
             os.remove(self.current_datafile)
 
 
 class SQM(device):
+    def promediate(self,timeutc_initial,timeutc_final,samples):
+        '''
+        Mean measure from the samples (temperature, frequency, ticks,
+        sky brightness) taken between timeutc_initial and timeutc_final.
+        '''
+        timeutc_delta = timeutc_final - timeutc_initial
+
+        timeutc_mean   = timeutc_initial+\
+         datetime.timedelta(seconds=int(timeutc_delta.seconds/2.+0.5))
+        timelocal_mean = self.local_datetime(timeutc_mean)
+
+        # Calculate the mean of the data (all quantities at once), in flux.
+        values = np.array(samples,dtype=float)
+        values[:,3] = 10**(-0.4*values[:,3])
+        (temp_sensor,freq_sensor,ticks_uC,flux_sensor),self.last_mask = \
+         clipped_mean(values)
+        sky_brightness = -2.5*np.log10(flux_sensor)
+
+        # Correct from offset (if cover is installed on the photometer)
+        #sky_brightness = sky_brightness+config._offset_calibration
+
+        return(\
+         timeutc_mean,timelocal_mean,\
+         temp_sensor,freq_sensor,\
+         ticks_uC,sky_brightness)
+
     def read_photometer(self,Nmeasures=1,PauseMeasures=2):
         # Initialize values
-        temp_sensor   = []
-        flux_sensor   = []
-        freq_sensor   = []
-        ticks_uC      = []
+        samples = []
         Nremaining = Nmeasures
 
         # Promediate N measures to remove jitter
@@ -375,14 +626,10 @@ class SQM(device):
 
             # Get the raw data from the photometer and process it.
             raw_data = self.read_data(tries=10)
-            temp_sensor_i,freq_sensor_i,ticks_uC_i,sky_brightness_i = \
-             self.data_process(raw_data)
-
-            temp_sensor += [temp_sensor_i]
-            freq_sensor += [freq_sensor_i]
-            ticks_uC    += [ticks_uC_i]
-            flux_sensor += [10**(-0.4*sky_brightness_i)]
-            Nremaining  -= 1
+            if raw_data==-1:
+                raise IOError('No valid data from the photometer')
+            samples    += [self.last_data]
+            Nremaining -= 1
             DeltaSeconds = (datetime.datetime.now()-InitialDateTime).total_seconds()
 
             # Just to show on screen that the program is alive and running
@@ -391,63 +638,120 @@ class SQM(device):
 
             if (Nremaining>0): time.sleep(max(1,PauseMeasures-DeltaSeconds))
 
-        timeutc_final = self.read_datetime()
-        timeutc_delta = timeutc_final - timeutc_initial
+        return(self.promediate(timeutc_initial,self.read_datetime(),samples))
 
-        timeutc_mean   = timeutc_initial+\
-         datetime.timedelta(seconds=int(timeutc_delta.seconds/2.+0.5))
+    def read_photometer_pipelined(self,Nmeasures=1,depth=2,tries=10):
+        '''
+        High cadence mode.
+        Keep depth rx requests queued in the device, so it starts the next
+        reading as soon as it answers the previous one (no idle sleeps).
+        Each sample is timestamped when its reply arrives.
+        The effective rate is stored in self.samples_per_second.
+        '''
+        samples = []
+        failures = 0
+        link = self.link_state()
+        deadline = self.reply_deadlines.get(b'rx',20)
+
+        with self.exclusive_access():
+            self.clear_buffer(timeout=0)
+        requested = 0
+        start = time.time()
+        while len(samples)<Nmeasures:
+            try:
+                # The link is locked only for each burst, so the connection
+                # manager can reopen it between them (see reset_device).
+                # It does not probe while the link is active.
+                with self.exclusive_access():
+                    # Fill the pipeline
+                    while requested-len(samples)<depth and requested<Nmeasures:
+                        self.write_command(b'rx')
+                        requested += 1
+
+                    msg = self.read_frame(deadline)
+                timeutc = self.read_datetime()
+                if self.fault_injector is not None:
+                    msg = self.fault_injector(msg)
+                samples.append((timeutc,)+parse_rx(msg))
+            except Exception:
+                failures += 1
+                action = link.failure()
+                if failures>=tries:
+                    link.give_up()
+                    raise
+                # Pending replies are unknown now, start again.
+                time.sleep(link.backoff())
+                try:
+                    if action==ConnectionState.RESYNC:
+                        with self.exclusive_access():
+                            self.resync()
+                    else:
+                        self.reset_device()
+                except Exception:
+                    pass
+                requested = len(samples)
+            else:
+                link.success()
+                sys.stdout.write('.')
+                sys.stdout.flush()
+        elapsed = time.time()-start
+
+        self.samples_per_second = len(samples)/elapsed if elapsed>0 else float('inf')
+        self.last_samples = samples
+        if (DEBUG): print('%.2f samples/s' %self.samples_per_second)
+
+        timeutc = [sample[0] for sample in samples]
+        timeutc_mean = timeutc[0]+\
+         (timeutc[-1]-timeutc[0])/2
+        timeutc_mean = timeutc_mean.replace(microsecond=0)
         timelocal_mean = self.local_datetime(timeutc_mean)
 
-        # Calculate the mean of the data.
-        temp_sensor = filtered_mean(temp_sensor)
-        freq_sensor = filtered_mean(freq_sensor)
-        flux_sensor = filtered_mean(flux_sensor)
-        ticks_uC    = filtered_mean(ticks_uC)
+        # Calculate the mean of the data (all quantities at once).
+        values = np.array([sample[1:] for sample in samples])
+        values[:,3] = 10**(-0.4*values[:,3])
+        (temp_sensor,freq_sensor,ticks_uC,flux_sensor),self.last_mask = \
+         clipped_mean(values)
         sky_brightness = -2.5*np.log10(flux_sensor)
 
-        # Correct from offset (if cover is installed on the photometer)
-        #sky_brightness = sky_brightness+config._offset_calibration
-
         return(\
          timeutc_mean,timelocal_mean,\
          temp_sensor,freq_sensor,\
          ticks_uC,sky_brightness)
 
     def metadata_process(self,msg,sep=','):
-        # Separate the output array in items
-        msg = format_value(msg)
-        msg_array = msg.split(sep)
-
-        # Get Photometer identification codes
-        self.protocol_number = int(format_value(msg_array[1]))
-        self.model_number    = int(format_value(msg_array[2]))
-        self.feature_number  = int(format_value(msg_array[3]))
-        self.serial_number   = int(format_value(msg_array[4]))
+        # Get Photometer identification codes (validates the reply)
+        self.protocol_number,self.model_number,\
+        self.feature_number,self.serial_number = parse_ix(msg)
 
     def data_process(self,msg,sep=','):
-        # Separate the output array in items
-        msg = format_value(msg)
-        msg_array = msg.split(sep)
-
-        # Output definition characters
-        mag_char  = 'm'
-        freq_char = 'Hz'
-        perc_char = 'c'
-        pers_char = 's'
-        temp_char = 'C'
-
-        # Get the measures
-        sky_brightness = float(format_value(msg_array[1],mag_char))
-        freq_sensor    = float(format_value(msg_array[2],freq_char))
-        ticks_uC       = float(format_value(msg_array[3],perc_char))
-        period_sensor  = float(format_value(msg_array[4],pers_char))
-        temp_sensor    = float(format_value(msg_array[5],temp_char))
-
-        # For low frequencies, use the period instead
-        if freq_sensor<30 and period_sensor>0:
-            freq_sensor = 1./period_sensor
-
-        return(temp_sensor,freq_sensor,ticks_uC,sky_brightness)
+        # Validate and get the measures in a single pass (see pysqm.protocol)
+        return(parse_rx(msg))
+
+    # Device state saved in the checkpoint (see pysqm.checkpoint)
+    checkpoint_attributes = ['addr','name','protocol_number','model_number',\
+     'feature_number','serial_number','ix_readout','cx_readout','rx_readout']
+
+    def checkpoint_state(self):
+        ''' Device state needed to reopen it without the initial handshake '''
+        state = {key:getattr(self,key,None) for key in self.checkpoint_attributes}
+        state['class'] = self.__class__.__name__
+        return(state)
+
+    @classmethod
+    def from_checkpoint(cls,state):
+        '''
+        Reopen a device from checkpoint_state(): only the connection
+        and one ix (to check that it is the same photometer).
+        '''
+        self = cls.__new__(cls)
+        for key in cls.checkpoint_attributes:
+            setattr(self,key,state.get(key))
+        self.start_connection()
+        if self.read_metadata(tries=2)==-1 or \
+         self.serial_number!=state['serial_number']:
+            self.close_connection()
+            raise IOError('Not the photometer of the checkpoint')
+        return(self)
 
     def start_connection(self):
         ''' Start photometer connection '''
@@ -464,18 +768,181 @@ class SQM(device):
         #self.__init__()
         self.start_connection()
 
+    '''
+    Framed protocol reader.
+    Replies from the photometer end with \r\n. Instead of waiting a fixed
+    time and doing a single read, keep reading chunks until a complete
+    reply is in the buffer (a reply may arrive split in several chunks)
+    or the deadline for the command expires.
+    '''
+
+    # Max time (seconds) to wait for the reply of each command
+    reply_deadlines = {b'ix':5, b'cx':5, b'rx':20}
+
+    def exclusive_access(self):
+        ''' Context that keeps other users of the link out (if any) '''
+        return(contextlib.nullcontext())
+
+    def write_command(self,command):
+        ''' Send a command to the photometer '''
+        pass
+
+    def read_chunk(self,timeout):
+        ''' Return the bytes available within timeout (b'' if none) '''
+        return(b'')
+
+    def clear_buffer(self,timeout=0.1):
+        ''' Discard any pending data from the device '''
+        discarded = b''
+        chunk = True
+        while chunk:
+            try: chunk = self.read_chunk(timeout)
+            except Exception: chunk = b''
+            discarded += chunk
+        self.rx_buffer = b''
+        return(discarded.decode(errors='replace'))
+
+    def read_reply(self,deadline=20):
+        ''' Return the next complete reply from the device '''
+        return(self.read_frame(deadline).decode())
+
+    def read_frame(self,deadline=20):
+        ''' Return the next complete reply from the device (bytes) '''
+        try: self.rx_buffer
+        except AttributeError: self.rx_buffer = b''
+
+        timelimit = time.time()+deadline
+        while b'\n' not in self.rx_buffer:
+            remaining = timelimit-time.time()
+            if remaining<=0:
+                raise TimeoutError('No complete reply after %.1f s' %deadline)
+            self.rx_buffer += self.read_chunk(remaining)
+
+        reply,_,self.rx_buffer = self.rx_buffer.partition(b'\n')
+        return(reply+b'\n')
+
+    def query(self,command,deadline=None):
+        ''' Send a command and return its reply '''
+        if deadline is None:
+            deadline = self.reply_deadlines.get(command,20)
+        with self.exclusive_access():
+            # Forget replies that arrived after a previous deadline
+            # (buffered or still waiting in the link), without waiting
+            self.clear_buffer(timeout=0)
+            self.write_command(command)
+            reply = self.read_reply(deadline)
+        if self.fault_injector is not None:
+            reply = self.fault_injector(reply)
+        return(reply)
+
+    '''
+    Reads with retries.
+    Failures are handled iteratively by the ConnectionState of the device
+    (resync first, then reconnect, with exponential backoff).
+    '''
+
+    # Optional FaultInjector (testing only)
+    fault_injector = None
+
+    def link_state(self):
+        ''' ConnectionState of this device '''
+        try: self.link
+        except AttributeError: self.link = ConnectionState()
+        return(self.link)
+
+    def resync(self):
+        ''' Discard pending bytes, keep the connection '''
+        self.clear_buffer(timeout=0.05)
+
+    def read_checked(self,command,check,tries=1):
+        '''
+        Send command until the reply passes check(msg).
+        Return the reply or -1 after the given number of tries.
+        '''
+        link = self.link_state()
+        msg = None
+        last_error = None
+
+        for attempt in range(tries):
+            try:
+                msg = self.query(command)
+                check(msg)
+            except Exception as ex:
+                last_error = ex
+                action = link.failure()
+                if attempt==tries-1:
+                    break
+                time.sleep(link.backoff())
+                try:
+                    if action==ConnectionState.RESYNC:
+                        self.resync()
+                    else:
+                        self.reset_device()
+                except Exception as ex:
+                    last_error = ex
+            else:
+                link.success()
+                return(msg)
+
+        link.give_up()
+        print('ERR. Reading the photometer!: %s' %str(msg))
+        if (DEBUG): raise last_error
+        return(-1)
+
+    def read_metadata(self,tries=1):
+        ''' Read the serial number, firmware version '''
+        def check(msg):
+            # Sanity check
+            assert(len(msg)==_meta_len_ or _meta_len_==None)
+            self.metadata_process(msg)
+
+        msg = self.read_checked(b'ix',check,tries)
+        if msg!=-1: print('Sensor info: '+str(msg)),
+        return(msg)
+
+    def read_calibration(self,tries=1):
+        ''' Read the calibration parameters '''
+        def check(msg):
+            # Sanity check
+            assert(len(msg)==_cal_len_ or _cal_len_==None)
+            parse_cx(msg)
+
+        msg = self.read_checked(b'cx',check,tries)
+        if msg!=-1: print('Calibration info: '+str(msg)),
+        return(msg)
+
+    def read_data(self,tries=1):
+        ''' Read the SQM and format the Temperature, Frequency and NSB measures '''
+        def check(msg):
+            # Sanity check
+            assert(len(msg)==_data_len_ or _data_len_==None)
+            self.last_data = self.data_process(msg)
+
+        msg = self.read_checked(b'rx',check,tries)
+        if msg!=-1 and (DEBUG): print('Data msg: '+str(msg))
+        return(msg)
+
 
 class SQMLE(SQM):
-    def __init__(self):
+    device_type = 'SQM-LE'
+    checkpoint_attributes = SQM.checkpoint_attributes+['port']
+
+    def __init__(self,addr=None,name=None):
         '''
         Search the photometer in the network and
-        read its metadata
+        read its metadata.
+        addr defaults to config._device_addr, name (if given) is
+        added to the data filenames.
         '''
+        self.name = name
+        if addr is None:
+            addr = config._device_addr
 
         try:
-            print('Trying fixed device address %s ... ' %str(config._device_addr))
-            self.addr = config._device_addr
-            self.port = 10001
+            print('Trying fixed device address %s ... ' %str(addr))
+            # Allow 'host' or 'host:port'
+            self.addr,_,port = str(addr).partition(':')
+            self.port = int(port or 10001)
             self.start_connection()
         except:
             print('Trying auto device address ...')
@@ -487,202 +954,79 @@ class SQMLE(SQM):
         # Clearing buffer
 
         print('Clearing buffer ... |'),
-        buffer_data = self.read_buffer()
+        buffer_data = self.clear_buffer()
         print(buffer_data),
         print('| ... DONE')
         print('Reading test data (ix,cx,rx)...')
-        time.sleep(1)
         self.ix_readout = self.read_metadata(tries=10)
-        time.sleep(1)
         self.cx_readout = self.read_calibration(tries=10)
-        time.sleep(1)
         self.rx_readout = self.read_data(tries=10)
 
     def search(self):
         ''' Search SQM LE in the LAN. Return its adress '''
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.s.setblocking(False)
-
-        if hasattr(socket,'SO_BROADCAST'):
-            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-
-        self.s.sendto("000000f6".decode("hex"), ("255.255.255.255", 30718))
-        buf=''
-        starttime = time.time()
-
-        print("Looking for replies; press Ctrl-C to stop")
-        addr=[None,None]
-        while True:
-            try:
-                (buf, addr) = self.s.recvfrom(30)
-                if buf[3].encode("hex")=="f7":
-                    print("Received from %s: MAC: %s" % \
-                     (addr, buf[24:30].encode("hex")))
-            except:
-                #Timeout in seconds. Allow all devices time to respond
-                if time.time()-starttime > 3:
-                    break
-                pass
+        devices = search_sqmle()
 
         try:
-            assert(addr[0]!=None)
+            assert(len(devices)>0)
         except:
             print('ERR. Device not found!')
             raise
         else:
-            return(addr[0])
+            return(devices[0][0])
 
     def start_connection(self):
         ''' Start photometer connection '''
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.settimeout(20)
-        self.s.connect((self.addr,int(self.port)))
-        #self.s.settimeout(1)
+        try: self.conn.close()
+        except AttributeError: pass
+        self.conn = SQMLEConnection(self.addr,self.port)
+        self.conn.open()
+        self.rx_buffer = b''
 
     def close_connection(self):
         ''' End photometer connection '''
-        self.s.setsockopt(\
-         socket.SOL_SOCKET,\
-         socket.SO_LINGER,\
-         struct.pack('ii', 1, 0))
+        self.conn.close()
 
-        # Check until there is no answer from device
-        request = ""
-        r = True
-        while r:
-            r = self.read_buffer()
-            request += str(r)
-        self.s.close()
+    def exclusive_access(self):
+        ''' No probes while a command is in progress '''
+        return(self.conn.lock)
 
-    def read_buffer(self):
-        ''' Read the data '''
-        msg = None
-        try:
-            msg = self.s.recv(255).decode()
-        except ConnectionAbortedError as ex:
-            print(ex)
-            self.start_connection()
+    def write_command(self,command):
+        ''' Send a command to the photometer '''
+        self.conn.send(command)
 
-        return(msg)
+    def read_chunk(self,timeout):
+        ''' Read the data received within timeout '''
+        return(self.conn.recv(timeout))
 
     def reset_device(self):
-        ''' Connection reset '''
-        #print('Trying to reset connection')
-        self.close_connection()
-        self.start_connection()
-
-    def read_metadata(self,tries=1):
-        ''' Read the serial number, firmware version '''
-        self.s.send(b'ix')
-        time.sleep(1)
-
-        read_err = False
-        msg = self.read_buffer()
-
-        # Check metadata
-        try:
-            # Sanity check
-            assert(len(msg)==_meta_len_ or _meta_len_==None)
-            assert("i," in msg)
-            self.metadata_process(msg)
-        except:
-            tries-=1
-            read_err=True
-
-        if (read_err==True and tries>0):
-            time.sleep(1)
-            self.reset_device()
-            time.sleep(1)
-            msg = self.read_metadata(tries)
-            if (msg!=-1): read_err=False
-
-        # Check that msg contains data
-        if read_err==True:
-            print('ERR. Reading the photometer!: %s' %str(msg))
-            if (DEBUG): raise
-            return(-1)
-        else:
-            print('Sensor info: '+str(msg)),
-            return(msg)
-
-    def read_calibration(self,tries=1):
-        ''' Read the calibration parameters '''
-        self.s.send(b'cx')
-        time.sleep(1)
-
-        read_err = False
-        msg = self.read_buffer()
-
-        # Check caldata
-        try:
-            # Sanity check
-            assert(len(msg)==_cal_len_ or _cal_len_==None)
-            assert("c," in msg)
-        except:
-            tries-=1
-            read_err=True
-
-        if (read_err==True and tries>0):
-            time.sleep(1)
-            self.reset_device()
-            time.sleep(1)
-            msg = self.read_calibration(tries)
-            if (msg!=-1): read_err=False
-
-        # Check that msg contains data
-        if read_err==True:
-            print('ERR. Reading the photometer!: %s' %str(msg))
-            if (DEBUG): raise
-            return(-1)
-        else:
-            print('Calibration info: '+str(msg)),
-            return(msg)
-
-    def read_data(self,tries=1):
-        ''' Read the SQM and format the Temperature, Frequency and NSB measures '''
-        self.s.send(b'rx')
-        time.sleep(1)
-
-        read_err = False
-        msg = self.read_buffer()
-
-        # Check data
-        try:
-            # Sanity check
-            assert(len(msg)==_data_len_ or _data_len_==None)
-            assert("r," in msg)
-            self.data_process(msg)
-        except:
-            tries-=1
-            read_err=True
-
-        if (read_err==True and tries>0):
-            time.sleep(1)
-            self.reset_device()
-            time.sleep(1)
-            msg = self.read_data(tries)
-            if (msg!=-1): read_err=False
-
-        # Check that msg contains data
-        if read_err==True:
-            print('ERR. Reading the photometer!: %s' %str(msg))
-            if (DEBUG): raise
-            return(-1)
-        else:
-            if (DEBUG): print('Data msg: '+str(msg))
-            return(msg)
+        '''
+        Connection reset.
+        The connection manager reopens the socket in background,
+        just wait (shortly) for it.
+        '''
+        self.rx_buffer = b''
+        self.conn.mark_broken()
+        self.conn.wait_connected()
 
 
 class SQMLU(SQM):
-    def __init__(self):
+    device_type = 'SQM-LU'
+    checkpoint_attributes = SQM.checkpoint_attributes+['bauds']
+
+    def __init__(self,addr=None,name=None):
         '''
         Search the photometer and
-        read its metadata
+        read its metadata.
+        addr defaults to config._device_addr, name (if given) is
+        added to the data filenames.
         '''
+        self.name = name
+        if addr is None:
+            addr = config._device_addr
 
         try:
-            print('Trying fixed device address %s ... ' %str(config._device_addr))
-            self.addr = config._device_addr
+            print('Trying fixed device address %s ... ' %str(addr))
+            self.addr = addr
             self.bauds = 115200
             self.start_connection()
         except:
@@ -694,42 +1038,135 @@ class SQMLU(SQM):
 
         # Clearing buffer
         print('Clearing buffer ... |'),
-        buffer_data = self.read_buffer()
+        buffer_data = self.clear_buffer()
         print(buffer_data),
         print('| ... DONE')
         print('Reading test data (ix,cx,rx)...')
-        time.sleep(1)
         self.ix_readout = self.read_metadata(tries=10)
-        time.sleep(1)
         self.cx_readout = self.read_calibration(tries=10)
-        time.sleep(1)
         self.rx_readout = self.read_data(tries=10)
 
+        if self.ix_readout!=-1:
+            self.remember_port()
+
+    '''
+    Serial port discovery.
+    Candidate ports are narrowed by the USB vendor/product ID of the
+    FTDI chip used by the SQM-LU and probed in parallel. The port where
+    each serial number was last found is cached and checked first.
+    '''
+
+    # FTDI FT232R (USB VID:PID) used by the SQM-LU
+    usb_ids = [(0x0403,0x6001)]
+
+    def port_cache_file(self):
+        try: return(config._port_cache_file)
+        except AttributeError:
+            return(os.path.join(os.path.expanduser('~'),'.pysqm_ports.json'))
+
+    def load_port_cache(self):
+        try:
+            with open(self.port_cache_file(),'r') as cachefile:
+                return(json.load(cachefile))
+        except (OSError,ValueError):
+            return({})
+
+    def remember_port(self):
+        ''' Store the port used by this serial number '''
+        cache = self.load_port_cache()
+        if cache.get(str(self.serial_number))==self.addr:
+            return
+        cache[str(self.serial_number)] = self.addr
+        try:
+            with open(self.port_cache_file(),'w') as cachefile:
+                json.dump(cache,cachefile)
+        except OSError as ex:
+            print('Warning: cannot write the port cache: %s' %str(ex))
+
+    def candidate_ports(self):
+        ''' List the serial ports that may have a SQM-LU attached '''
+        try:
+            import serial.tools.list_ports
+            ports = list(serial.tools.list_ports.comports())
+        except ImportError:
+            ports = []
+
+        if ports:
+            matching = [port.device for port in ports \
+             if (port.vid,port.pid) in self.usb_ids]
+            # Unknown adapters (no USB ids) are probed anyway
+            unknown = [port.device for port in ports if port.vid is None]
+            return(matching+unknown)
+
+        # No port enumeration available, try the usual names.
+        os_in_use = sys.platform
+        if os_in_use.startswith('linux'):
+            print('Detected Linux platform')
+            return(sorted(glob.glob('/dev/ttyUSB*')))
+        elif os_in_use == 'darwin':
+            print('Detected MacOS platform')
+            return(sorted(glob.glob('/dev/tty.usbserial*')))
+        elif os_in_use == 'win32':
+            print('Detected Windows platform')
+            return(['COM'+str(num) for num in range(100)])
+        return([])
+
+    def probe_port(self,port,timeout=1):
+        ''' Return the serial number of the SQM-LU at port (or None) '''
+        try:
+            conn_test = serial.Serial(port, 115200, timeout=timeout)
+        except (OSError,ValueError,serial.SerialException):
+            return(None)
+        try:
+            conn_test.reset_input_buffer()
+            conn_test.write(b'ix')
+            reply = conn_test.read_until(b'\n').decode(errors='replace')
+        except (OSError,serial.SerialException):
+            return(None)
+        finally:
+            conn_test.close()
+
+        if not reply.startswith('i,'):
+            return(None)
+        try: return(str(int(format_value(reply.split(',')[4]))))
+        except (IndexError,ValueError): return(None)
 
     def search(self):
         '''
         Photometer search.
-        Name of the port depends on the platform.
+        If config._device_serial is set, look for that serial number.
         '''
-        ports_unix = ['/dev/ttyUSB'+str(num) for num in range(100)]
-        ports_win  = ['COM'+str(num) for num in range(100)]
+        try: wanted = str(int(config._device_serial))
+        except (AttributeError,TypeError,ValueError): wanted = None
 
-        os_in_use = sys.platform
+        def accept(serial_number):
+            return(serial_number is not None and \
+             (wanted is None or serial_number==wanted))
 
-        if os_in_use == 'linux2':
-            print('Detected Linux platform')
-            ports = ports_unix
-        elif os_in_use == 'win32':
-            print('Detected Windows platform')
-            ports = ports_win
+        # Last known ports first
+        cache = self.load_port_cache()
+        if wanted is not None:
+            cached_ports = [cache[wanted]] if wanted in cache else []
+        else:
+            cached_ports = list(cache.values())
+
+        for port in cached_ports:
+            if accept(self.probe_port(port)):
+                print('Found device at cached port %s' %port)
+                return(port)
+
+        # Probe all the remaining candidates at once
+        ports = [port for port in self.candidate_ports() \
+         if port not in cached_ports]
 
         used_port = None
-        for port in ports:
-            conn_test = serial.Serial(port, 115200, timeout=1)
-            conn_test.write(b'ix')
-            if conn_test.readline()[0] == 'i':
-                used_port = port
-                break
+        if ports:
+            with concurrent.futures.ThreadPoolExecutor(\
+             max_workers=min(16,len(ports))) as pool:
+                for port,serial_number in zip(ports,pool.map(self.probe_port,ports)):
+                    if accept(serial_number):
+                        used_port = port
+                        break
 
         try:
             assert(used_port!=None)
@@ -743,129 +1180,31 @@ class SQMLU(SQM):
         '''Start photometer connection '''
 
         self.s = serial.Serial(self.addr, 115200, timeout=2)
+        self.rx_buffer = b''
 
     def close_connection(self):
         ''' End photometer connection '''
         # Check until there is no answer from device
-        request = ""
-        r = True
-        while r:
-            r = self.read_buffer()
-            request += str(r)
-
+        self.clear_buffer()
         self.s.close()
 
     def reset_device(self):
         ''' Connection reset '''
         #print('Trying to reset connection')
-        self.close_connection()
-        self.start_connection()
-
-    def read_buffer(self):
-        ''' Read the data '''
-        msg = None
-        try: msg = self.s.readline()
-        except: pass
-        return(msg)
-
-    def read_metadata(self,tries=1):
-        ''' Read the serial number, firmware version '''
-        self.s.write(b'ix')
-        time.sleep(1)
-
-        read_err = False
-        msg = self.read_buffer()
-
-        # Check metadata
-        try:
-            # Sanity check
-            assert(len(msg)==_meta_len_ or _meta_len_==None)
-            assert("i," in msg)
-            self.metadata_process(msg)
-        except:
-            tries-=1
-            read_err=True
-
-        if (read_err==True and tries>0):
-            time.sleep(1)
-            self.reset_device()
-            time.sleep(1)
-            msg = self.read_metadata(tries)
-            if (msg!=-1): read_err=False
-
-        # Check that msg contains data
-        if read_err==True:
-            print('ERR. Reading the photometer!: %s' %str(msg))
-            if (DEBUG): raise
-            return(-1)
-        else:
-            print('Sensor info: '+str(msg)),
-            return(msg)
-
-    def read_calibration(self,tries=1):
-        ''' Read the calibration data '''
-        self.s.write(b'cx')
-        time.sleep(1)
-
-        read_err = False
-        msg = self.read_buffer()
-
-        # Check caldata
+        try: self.close_connection()
+        except Exception: pass
         try:
-            # Sanity check
-            assert(len(msg)==_cal_len_ or _cal_len_==None)
-            assert("c," in msg)
-        except:
-            tries-=1
-            read_err=True
-
-        if (read_err==True and tries>0):
-            time.sleep(1)
-            self.reset_device()
-            time.sleep(1)
-            msg = self.read_calibration(tries)
-            if (msg!=-1): read_err=False
-
-        # Check that msg contains data
-        if read_err==True:
-            print('ERR. Reading the photometer!: %s' %str(msg))
-            if (DEBUG): raise
-            return(-1)
-        else:
-            print('Calibration info: '+str(msg)),
-            return(msg)
-
-    def read_data(self,tries=1):
-        ''' Read the SQM and format the Temperature, Frequency and NSB measures '''
-        self.s.write(b'rx')
-        time.sleep(1)
-
-        read_err = False
-        msg = self.read_buffer()
+            self.start_connection()
+        except (OSError,serial.SerialException):
+            # The port may have changed (USB re-enumeration)
+            self.addr = self.search()
+            self.start_connection()
 
-        # Check data
-        try:
-            # Sanity check
-            assert(len(msg)==_data_len_ or _data_len_==None)
-            assert("r," in msg)
-            self.data_process(msg)
-        except:
-            tries-=1
-            read_err=True
-
-        if (read_err==True and tries>0):
-            time.sleep(1)
-            self.reset_device()
-            time.sleep(1)
-            msg = self.read_data(tries)
-            if (msg!=-1): read_err=False
-
-        # Check that msg contains data
-        if read_err==True:
-            print('ERR. Reading the photometer!: %s' %str(msg))
-            if (DEBUG): raise
-            return(-1)
-        else:
-            if (DEBUG): print('Data msg: '+str(msg))
-            return(msg)
+    def write_command(self,command):
+        ''' Send a command to the photometer '''
+        self.s.write(command)
 
+    def read_chunk(self,timeout):
+        ''' Read the data received within timeout '''
+        self.s.timeout = timeout
+        return(self.s.read(max(1,self.s.in_waiting)))
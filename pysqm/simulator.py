@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+'''
+PySQM device simulator
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Virtual SQM photometers that answer the rx/ix/cx protocol, either
+on a local TCP port (as a SQM-LE) or on a pseudo-terminal (as a SQM-LU).
+Reply latency, jitter, segmentation, dropped replies and the sky
+brightness curve can be adjusted, so the acquisition layer can be
+tested and benchmarked without hardware.
+
+Serve 100 SQM-LE on consecutive ports starting at 10001:
+> python -m pysqm.simulator --devices 100 --port 10001
+
+Measure samples/s and latency of pysqm.asyncread against 200 of them:
+> python -m pysqm.simulator --devices 200 --benchmark -c config.py
+____________________________
+'''
+
+import os,sys
+import math
+import time
+import random
+import select
+import asyncio
+import threading
+import argparse
+
+
+def default_brightness(t):
+    '''
+    Sky brightness (mag/arcsec2) at unix time t.
+    A smooth night curve: ~21 mag at local midnight, bright at noon.
+    '''
+    hours = (t/3600.)%24
+    return(14.+7.*max(0.,math.cos((hours/24.)*2*math.pi)))
+
+
+class VirtualSQM(object):
+    '''
+    Reply generator for one virtual photometer.
+     latency: mean reply delay (s)
+     jitter: gaussian sigma of the delay (s)
+     segment: if >0, send the replies in chunks of this size
+     drop: probability of not answering a command
+     brightness: function of the unix time returning mag/arcsec2
+    '''
+    def __init__(self,serial_number=None,latency=0.,jitter=0.,segment=0,\
+     drop=0.,brightness=default_brightness,temperature=15.,seed=None):
+        self.random = random.Random(seed)
+        if serial_number is None:
+            serial_number = self.random.randrange(1,99999999)
+        self.serial_number = serial_number
+        self.latency = latency
+        self.jitter = jitter
+        self.segment = segment
+        self.drop = drop
+        self.brightness = brightness
+        self.temperature = temperature
+        self.served = 0
+        self.dropped = 0
+
+    def delay(self):
+        return(max(0.,self.random.gauss(self.latency,self.jitter)))
+
+    def reply(self,command):
+        ''' Reply to a command (None if there is no reply) '''
+        if self.random.random()<self.drop:
+            self.dropped += 1
+            return(None)
+
+        if command == b'ix':
+            msg = 'i,%08d,%08d,%08d,%08d\r\n' \
+             %(4,3,60,self.serial_number)
+        elif command == b'cx':
+            msg = 'c,%011.2fm,%011.3fs,% 06.1fC,%011.2fm,% 06.1fC\r\n' \
+             %(19.84,151.517,22.2,8.71,23.2)
+        elif command == b'rx':
+            mag  = self.brightness(time.time())
+            freq = 22921.*10**(-0.4*(mag-6.7))
+            period = 1./freq if freq<30 else 0.
+            temp = self.temperature+self.random.gauss(0,0.1)
+            msg = 'r,% 06.2fm,%010dHz,%010dc,%011.3fs,% 06.1fC\r\n' \
+             %(mag,int(freq),self.random.randrange(0,1000),period,temp)
+        else:
+            return(None)
+
+        self.served += 1
+        return(msg.encode())
+
+    def chunks(self,data):
+        ''' Split a reply in segments '''
+        if self.segment<=0:
+            return([data])
+        return([data[k:k+self.segment] \
+         for k in range(0,len(data),self.segment)])
+
+
+class TCPSimulator(object):
+    '''
+    Serve many virtual SQM-LE on local TCP ports (asyncio).
+    '''
+    def __init__(self,devices,host='127.0.0.1',base_port=0):
+        self.devices = devices
+        self.host = host
+        self.base_port = base_port
+        self.servers = []
+        self.ports = []
+
+    async def handle(self,device,reader,writer):
+        try:
+            while True:
+                command = await reader.readexactly(2)
+                data = device.reply(command)
+                if data is None:
+                    continue
+                await asyncio.sleep(device.delay())
+                for chunk in device.chunks(data):
+                    writer.write(chunk)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError,ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        for k,device in enumerate(self.devices):
+            port = self.base_port+k if self.base_port else 0
+            server = await asyncio.start_server(\
+             lambda r,w,device=device: self.handle(device,r,w),\
+             self.host,port)
+            self.servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+        return(self.ports)
+
+    async def stop(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+
+
+class PTYSimulator(object):
+    '''
+    Virtual SQM-LU on a pseudo-terminal (POSIX only).
+    self.port is the device name to be opened with pyserial.
+    '''
+    def __init__(self,device):
+        import tty
+        self.device = device
+        self.master,self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        return(self.port)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        pending = b''
+        while self.running:
+            ready,_,_ = select.select([self.master],[],[],0.1)
+            if not ready:
+                continue
+            pending += os.read(self.master,64)
+            while len(pending)>=2:
+                command,pending = pending[:2],pending[2:]
+                data = self.device.reply(command)
+                if data is None:
+                    continue
+                time.sleep(self.device.delay())
+                for chunk in self.device.chunks(data):
+                    os.write(self.master,chunk)
+
+
+def percentile(values,q):
+    values = sorted(values)
+    if not values:
+        return(float('nan'))
+    return(values[min(len(values)-1,int(q/100.*len(values)))])
+
+
+async def benchmark(ndevices=100,cycles=20,**device_options):
+    '''
+    Poll ndevices virtual SQM-LE with pysqm.asyncread.
+    Return samples/s and the latency percentiles (s) of the rx reads.
+    '''
+    from pysqm.asyncread import AsyncSQMLE
+
+    simulator = TCPSimulator(\
+     [VirtualSQM(seed=k,**device_options) for k in range(ndevices)])
+    ports = await simulator.start()
+
+    readers = [AsyncSQMLE('127.0.0.1',port) for port in ports]
+    await asyncio.gather(*[reader.start_connection() for reader in readers])
+
+    latencies = []
+    async def timed_read(reader):
+        start = time.perf_counter()
+        msg = await reader.read_data(tries=3)
+        if msg!=-1:
+            latencies.append(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    for cycle in range(cycles):
+        await asyncio.gather(*[timed_read(reader) for reader in readers])
+    elapsed = time.perf_counter()-start
+
+    await asyncio.gather(*[reader.close_connection() for reader in readers])
+    await simulator.stop()
+
+    return({\
+     'devices':ndevices,'samples':len(latencies),\
+     'samples_per_second':len(latencies)/elapsed,\
+     'p50':percentile(latencies,50),'p99':percentile(latencies,99),\
+     'max':max(latencies) if latencies else float('nan')})
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Virtual SQM photometers')
+    parser.add_argument('-c','--config',default='config.py')
+    parser.add_argument('--devices',type=int,default=1)
+    parser.add_argument('--port',type=int,default=10001,\
+     help='First TCP port (0: random ports)')
+    parser.add_argument('--pty',action='store_true',\
+     help='Serve SQM-LU devices on pseudo-terminals instead of TCP')
+    parser.add_argument('--latency',type=float,default=0.)
+    parser.add_argument('--jitter',type=float,default=0.)
+    parser.add_argument('--segment',type=int,default=0)
+    parser.add_argument('--drop',type=float,default=0.)
+    parser.add_argument('--benchmark',action='store_true')
+    parser.add_argument('--cycles',type=int,default=20)
+    return(parser.parse_args())
+
+
+def main():
+    args = parse_arguments()
+    options = dict(latency=args.latency,jitter=args.jitter,\
+     segment=args.segment,drop=args.drop)
+
+    if args.benchmark:
+        # The readers need the PySQM configuration
+        import pysqm.settings as settings
+        settings.GlobalConfig.read_config_file(args.config)
+        result = asyncio.run(benchmark(args.devices,args.cycles,**options))
+        print('%(devices)d devices, %(samples)d samples: '\
+         '%(samples_per_second).1f samples/s, '\
+         'latency p50 %(p50).4f s, p99 %(p99).4f s, max %(max).4f s' %result)
+        return
+
+    devices = [VirtualSQM(**options) for k in range(args.devices)]
+    if args.pty:
+        simulators = [PTYSimulator(device) for device in devices]
+        for simulator in simulators:
+            print('SQM-LU #%d at %s' %(simulator.device.serial_number,simulator.start()))
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    async def serve():
+        simulator = TCPSimulator(devices,base_port=args.port)
+        for device,port in zip(devices,await simulator.start()):
+            print('SQM-LE #%d at 127.0.0.1:%d' %(device.serial_number,port))
+        await asyncio.gather(*[server.serve_forever() for server in simulator.servers])
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
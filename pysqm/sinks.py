@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+'''
+PySQM database sinks
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+SQLite sink: a local database with the measures, written with the data
+cache (one transaction per cache flush). The database is in WAL mode,
+so it can be queried while the measures are being written.
+
+Table measures:
+ device, night (YYYYMMDD), utc, local (as in the data files),
+ temperature, counts, frequency, msas
+
+Enabled with _use_sqlite = True in config.py.
+
+MySQL sink: the measures are appended to a local spool and sent by a
+background thread, with one persistent connection and multi-row
+parameterized inserts. While the server is unreachable the measures
+stay in the spool, and they are sent in bulk when it is back.
+Enabled with _use_mysql = True.
+
+Measure the ingest rate:
+> python -m pysqm.sinks
+____________________________
+'''
+
+import os,sys
+import re
+import time
+import sqlite3
+import threading
+
+from pysqm.spool import DiskQueue
+
+SQLITE_SCHEMA = [\
+ '''CREATE TABLE IF NOT EXISTS measures (
+     device TEXT NOT NULL,
+     night TEXT NOT NULL,
+     utc TEXT NOT NULL,
+     local TEXT NOT NULL,
+     temperature REAL,
+     counts REAL,
+     frequency REAL,
+     msas REAL,
+     PRIMARY KEY (device,utc))''',
+ 'CREATE INDEX IF NOT EXISTS measures_utc ON measures (utc)',
+ 'CREATE INDEX IF NOT EXISTS measures_night ON measures (device,night)']
+
+SQLITE_INSERT = \
+ 'INSERT OR IGNORE INTO measures VALUES (?,?,?,?,?,?,?,?)'
+
+# fsync policy (see _fsync_policy) -> SQLite synchronous mode
+SQLITE_SYNCHRONOUS = {'never':'OFF','night':'NORMAL','flush':'FULL'}
+
+
+def parse_lines(text):
+    '''
+    Data lines (as written in the data files) to
+    (utc,local,temperature,counts,frequency,msas) rows.
+    '''
+    rows = []
+    for line in text.splitlines():
+        fields = line.split(';')
+        if line[:1]=='#' or len(fields)!=6:
+            continue
+        try:
+            rows.append(tuple(fields[:2])+tuple(float(value) for value in fields[2:]))
+        except ValueError:
+            continue
+    return(rows)
+
+
+class SQLiteSink(object):
+    '''
+    Local SQLite database with the measures.
+    '''
+    def __init__(self,filename,fsync_policy='flush'):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=%s' \
+         %SQLITE_SYNCHRONOUS.get(fsync_policy,'FULL'))
+        with self.connection:
+            for statement in SQLITE_SCHEMA:
+                self.connection.execute(statement)
+
+    def insert(self,device,night,text):
+        ''' Insert the data lines in text, in one transaction '''
+        rows = [(device,night)+row for row in parse_lines(text)]
+        if len(rows)==0:
+            return(0)
+        with self.connection:
+            # The statement is prepared once and reused for every row
+            self.connection.executemany(SQLITE_INSERT,rows)
+        return(len(rows))
+
+    def query(self,device,start_utc,end_utc):
+        '''
+        Measures of device with start_utc <= utc < end_utc
+        (strings in the data file format, e.g. 2024-01-15T22:00:00)
+        '''
+        return(self.connection.execute(\
+         'SELECT * FROM measures WHERE device=? AND utc>=? AND utc<? ORDER BY utc',\
+         (device,start_utc,end_utc)).fetchall())
+
+    def night(self,device,night):
+        return(self.connection.execute(\
+         'SELECT * FROM measures WHERE device=? AND night=? ORDER BY utc',\
+         (device,night)).fetchall())
+
+    def checkpoint(self):
+        ''' Move the WAL contents to the database file '''
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.connection.close()
+
+
+def sqlite_filename(config):
+    try: filename = config._sqlite_database
+    except AttributeError: filename = None
+    if filename is None:
+        filename = os.path.join(config.monthly_data_directory,'pysqm.sqlite')
+    return(filename)
+
+
+class MySQLSink(object):
+    '''
+    Send the measures to a MySQL table (same columns as the data files).
+    put() only appends to the spool, the database is written by a
+    background thread.
+    '''
+    def __init__(self,spool_filename,table,batch=500,retry_interval=30,\
+     **connect_options):
+        import MySQLdb
+        self.driver = MySQLdb
+        if not re.match(r'^[A-Za-z0-9_.]+$',str(table)):
+            raise ValueError('Invalid MySQL table name %r' %table)
+        self.insert_query = 'INSERT INTO '+table+' VALUES (%s,%s,%s,%s,%s,%s)'
+        self.connect_options = {key:value for key,value in \
+         connect_options.items() if value is not None}
+        self.batch = batch
+        self.retry_interval = retry_interval
+        self.spool = DiskQueue(spool_filename)
+        self.connection = None
+        self.online = True
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def put(self,text):
+        ''' Queue the data lines in text '''
+        self.spool.put([line+'\n' for line in text.splitlines() \
+         if line and line[0]!='#'])
+        self.wakeup.set()
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = self.driver.connect(**self.connect_options)
+        return(self.connection)
+
+    def disconnect(self):
+        if self.connection is not None:
+            try: self.connection.close()
+            except self.driver.Error: pass
+            self.connection = None
+
+    def insert(self,rows):
+        ''' One multi-row insert (one transaction) '''
+        connection = self.connect()
+        cursor = connection.cursor()
+        try:
+            cursor.executemany(self.insert_query,rows)
+            connection.commit()
+        finally:
+            cursor.close()
+
+    def insert_rows(self,lines,position):
+        '''
+        Insert the spooled lines one by one, dropping the bad ones.
+        Each line leaves the spool once committed, so a server failure
+        halfway does not insert the first ones again.
+        Return False if the server failed.
+        '''
+        start = position-sum(len(line.encode()) for line in lines)
+        for line in lines:
+            start += len(line.encode())
+            for row in parse_lines(line):
+                try:
+                    self.insert([row])
+                except self.driver.OperationalError:
+                    self.disconnect()
+                    return(False)
+                except self.driver.Error as ex:
+                    print('MySQL Error. Row dropped %s: %s' %(str(row),str(ex)))
+                    self.disconnect()
+            self.spool.ack(start)
+        return(True)
+
+    def send_pending(self):
+        ''' Send the spool contents. Return False if the server failed. '''
+        while self.running:
+            lines,position = self.spool.get(self.batch)
+            if len(lines)==0:
+                return(True)
+            rows = parse_lines(''.join(lines))
+            if len(rows)==0:
+                self.spool.ack(position)
+                continue
+            try:
+                self.insert(rows)
+            except self.driver.OperationalError as ex:
+                # Server unreachable: keep the rows and retry later
+                if self.online:
+                    print('MySQL server unavailable (%d bytes spooled): %s' \
+                     %(self.spool.pending(),str(ex)))
+                self.online = False
+                self.disconnect()
+                return(False)
+            except self.driver.Error as ex:
+                # Bad data, insert row by row to keep the good ones
+                self.disconnect()
+                if not self.insert_rows(lines,position):
+                    return(False)
+            self.online = True
+            self.spool.ack(position)
+        return(True)
+
+    def run(self):
+        while self.running:
+            if self.send_pending():
+                self.wakeup.wait()
+                self.wakeup.clear()
+            else:
+                # New rows do not shorten the wait
+                self.stopped.wait(self.retry_interval)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.stopped.set()
+        self.thread.join()
+        self.disconnect()
+        self.spool.close()
+
+
+def mysql_sink(config):
+    ''' MySQL sink with the settings in config '''
+    try: spool_filename = config._mysql_spool
+    except AttributeError: spool_filename = None
+    if spool_filename is None:
+        spool_filename = os.path.join(config.monthly_data_directory,'mysql.spool')
+
+    host,port = config._mysql_host,config._mysql_port
+    if host is not None and ':' in str(host):
+        host,port = host.rsplit(':',1)
+    return(MySQLSink(spool_filename,config._mysql_dbtable,\
+     host=host,port=None if port is None else int(port),\
+     user=config._mysql_user,password=config._mysql_pass,\
+     database=config._mysql_database))
+
+
+def benchmark(filename,nrecords=100000,batch=50):
+    '''
+    Rows/s inserted in batches of batch rows (one
+    transaction per batch, as with the data cache).
+    '''
+    line = '%s;%s;12.30;1.000;150.123;20.123\n'
+    lines = []
+    for k in range(nrecords):
+        utc = time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(k*20))+'.000'
+        lines.append(line %(utc,utc))
+
+    sink = SQLiteSink(filename)
+    start = time.perf_counter()
+    for first in range(0,nrecords,batch):
+        sink.insert('benchmark','19700101',''.join(lines[first:first+batch]))
+    elapsed = time.perf_counter()-start
+    sink.close()
+    return(nrecords/elapsed)
+
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        for batch in [1,10,50,500]:
+            rate = benchmark(os.path.join(directory,'bench%d.sqlite' %batch),\
+             nrecords=20000,batch=batch)
+            print('batch %4d: %10.0f rows/s' %(batch,rate))
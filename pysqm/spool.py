@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+'''
+PySQM disk spool
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Durable FIFO of text lines, used to hold the measures that still
+have to be sent somewhere (database, data center).
+
+ <spool>         the lines, only appended
+ <spool>.offset  position of the first line not yet delivered
+
+Delivered lines are acknowledged in bulk by moving the offset, which
+is replaced atomically. When everything has been delivered the spool
+is emptied. The queue survives restarts: undelivered lines are sent
+again (at least once delivery).
+____________________________
+'''
+
+import os
+import threading
+
+
+class DiskQueue(object):
+    def __init__(self,filename,fsync=False):
+        self.filename = filename
+        self.offset_filename = filename+'.offset'
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.handle = open(filename,'ab')
+        self.offset = self.read_offset()
+
+    def read_offset(self):
+        try:
+            with open(self.offset_filename,'r') as foffset:
+                offset = int(foffset.read().strip() or 0)
+        except (FileNotFoundError,ValueError):
+            offset = 0
+        # The spool may have been emptied after the offset was saved
+        return(min(offset,os.path.getsize(self.filename)))
+
+    def write_offset(self,offset):
+        temporary = self.offset_filename+'.tmp'
+        with open(temporary,'w') as foffset:
+            foffset.write(str(offset))
+            if self.fsync:
+                foffset.flush()
+                os.fsync(foffset.fileno())
+        os.replace(temporary,self.offset_filename)
+
+    def put(self,lines):
+        ''' Append lines (str, each one ending in a line break) '''
+        if len(lines)==0:
+            return
+        data = ''.join(lines).encode()
+        with self.lock:
+            self.handle.write(data)
+            self.handle.flush()
+            if self.fsync:
+                os.fsync(self.handle.fileno())
+
+    def get(self,max_lines=1000,max_bytes=1<<20):
+        '''
+        Oldest pending lines (up to max_lines) without removing them.
+        Return (lines,position): call ack(position) once delivered.
+        '''
+        with self.lock:
+            start = self.offset
+        lines = []
+        with open(self.filename,'rb') as fspool:
+            fspool.seek(start)
+            data = fspool.read(max_bytes)
+        position = start
+        for line in data.splitlines(True):
+            if not line.endswith(b'\n') or len(lines)>=max_lines:
+                break
+            lines.append(line.decode())
+            position += len(line)
+        return(lines,position)
+
+    def ack(self,position):
+        ''' Mark the lines before position as delivered '''
+        with self.lock:
+            if position<=self.offset:
+                return
+            if position>=os.path.getsize(self.filename):
+                # All delivered, empty the spool (if we stop in between,
+                # the lines are sent again rather than lost)
+                self.write_offset(0)
+                self.handle.truncate(0)
+                self.offset = 0
+                return
+            self.offset = position
+            self.write_offset(position)
+
+    def pending(self):
+        ''' Bytes not yet delivered '''
+        with self.lock:
+            return(os.path.getsize(self.filename)-self.offset)
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+'''
+PySQM supervisor
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+Runs a station with several photometers (SQM-LU and/or SQM-LE):
+ - one acquisition worker process per device,
+ - one writer process that saves the measures of all the devices,
+ - crashed workers are restarted (with increasing delays).
+
+The devices are listed in config.py, e.g.:
+_devices = [\
+ {'type':'SQM-LU','addr':'/dev/ttyUSB0','name':'north'},
+ {'type':'SQM-LE','addr':'192.168.1.10','name':'south'}]
+
+Each device writes its own files (the name is added to the filenames).
+The names must be unique; unnamed devices are named by their position
+in the list (a single unnamed device keeps the usual filenames).
+
+The writer process also sends the measures to the data center
+(_send_to_datacenter), with one queue per device. The MySQL sink
+(its table has no device column) and the plots are not available
+in this mode, use pysqm.main for them.
+
+Usage:
+> python -m pysqm.supervisor -c config.py
+____________________________
+'''
+
+import os,sys
+import time
+import datetime
+import multiprocessing
+
+'''
+Read configuration (if not already done by the caller)
+'''
+import pysqm.settings as settings
+if settings.GlobalConfig.config is None:
+    InputArguments = settings.ArgParser()
+    settings.GlobalConfig.read_config_file(InputArguments.config)
+config = settings.GlobalConfig.config
+
+from pysqm.read import *
+from pysqm.writer import exit_on_sigterm
+
+
+class StoredDevice(device):
+    '''
+    Writer side copy of a device: the header comes
+    with the measures, the files are handled as usual.
+    '''
+    def __init__(self,name,header,serial_number):
+        self.name = name
+        self.header = header
+        self.serial_number = serial_number
+
+    def standard_file_header(self):
+        return(self.header)
+
+
+def acquisition_worker(spec,queue):
+    '''
+    Read one photometer forever and send the measures to the writer.
+    '''
+    device_type = spec['type'].replace('_','-')
+    if device_type == 'SQM-LU':
+        mydevice = SQMLU(addr=spec.get('addr'),name=spec.get('name'))
+    elif device_type == 'SQM-LE':
+        mydevice = SQMLE(addr=spec.get('addr'),name=spec.get('name'))
+    else:
+        raise ValueError('Unknown device type '+str(device_type))
+
+    # The header is sent once, the writer keeps it
+    queue.put((mydevice.name,'header',\
+     (mydevice.standard_file_header(),mydevice.serial_number)))
+
+    try: high_cadence = config._high_cadence
+    except AttributeError: high_cadence = False
+    try: pipeline_depth = config._pipeline_depth
+    except AttributeError: pipeline_depth = 2
+
+    while 1<2:
+        StartDateTime = datetime.datetime.now()
+        if high_cadence:
+            measure = mydevice.read_photometer_pipelined(\
+             Nmeasures=config._measures_to_promediate,depth=pipeline_depth)
+        else:
+            measure = mydevice.read_photometer(\
+             Nmeasures=config._measures_to_promediate,PauseMeasures=10)
+        queue.put((mydevice.name,'data',mydevice.format_content(*measure)))
+
+        MainDeltaSeconds = (datetime.datetime.now()-StartDateTime).total_seconds()
+        time.sleep(max(1,config._delay_between_measures-MainDeltaSeconds))
+
+
+def send_to_datacenter(stored,content):
+    ''' Queue the measures (or the new file header) for the data center '''
+    try: enabled = config._send_to_datacenter
+    except AttributeError: enabled = False
+    if not enabled:
+        return
+    try:
+        stored.save_data_datacenter(content)
+    except Exception as ex:
+        print('Error sending data of device %s to the data center: %s' \
+         %(str(stored.name),str(ex)))
+
+
+def writer_process(queue):
+    '''
+    Save the measures of all the devices.
+    '''
+    devices = {}
+    niter = {}
+    # Exit handlers are not run in child processes, flush here.
+    exit_on_sigterm()
+    try:
+        while 1<2:
+            message = queue.get()
+            if message is None:
+                break
+            name,kind,content = message
+            if kind=='header':
+                header,serial_number = content
+                if name in devices:
+                    devices[name].header = header
+                    devices[name].serial_number = serial_number
+                else:
+                    devices[name] = StoredDevice(name,header,serial_number)
+                    niter[name] = 0
+                send_to_datacenter(devices[name],"NEWFILE")
+                continue
+            if name not in devices:
+                print('No header from device %s, measure dropped' %str(name))
+                continue
+            niter[name] += 1
+            devices[name].define_filenames()
+            devices[name].data_cache(content,\
+             number_measures=config._cache_measures,niter=niter[name])
+            send_to_datacenter(devices[name],content)
+    finally:
+        for stored in devices.values():
+            stored.flush_cache(sync=True)
+
+
+class Supervisor(object):
+    '''
+    Start the writer and one worker per device, restart the dead ones.
+    '''
+    def __init__(self,specs,max_restart_delay=300,healthy_time=3600):
+        self.specs = device_names(specs)
+        self.max_restart_delay = max_restart_delay
+        # Running for healthy_time seconds forgets the previous restarts
+        self.healthy_time = healthy_time
+        self.queue = multiprocessing.Queue()
+        self.writer = None
+        self.workers = [None]*len(specs)
+        self.restarts = [0]*len(specs)
+        self.next_start = [0.]*len(specs)
+        self.started = [0.]*len(specs)
+
+    def start_worker(self,k):
+        spec = self.specs[k]
+        worker = multiprocessing.Process(\
+         target=acquisition_worker,args=(spec,self.queue),\
+         name='pysqm-'+str(spec.get('name',k)),daemon=True)
+        worker.start()
+        self.workers[k] = worker
+        self.started[k] = time.time()
+
+    def check_workers(self):
+        now = time.time()
+        for k,worker in enumerate(self.workers):
+            if worker is not None and worker.is_alive():
+                if now-self.started[k]>=self.healthy_time:
+                    self.restarts[k] = 0
+                continue
+            if worker is not None:
+                # Crashed. Wait a bit more after each restart.
+                print('Worker %s died (exit code %s)' \
+                 %(worker.name,str(worker.exitcode)))
+                self.restarts[k] += 1
+                self.next_start[k] = now+min(\
+                 self.max_restart_delay,2**min(self.restarts[k],10))
+                self.workers[k] = None
+            if now>=self.next_start[k]:
+                self.start_worker(k)
+
+    def run(self):
+        self.writer = multiprocessing.Process(\
+         target=writer_process,args=(self.queue,),name='pysqm-writer')
+        self.writer.start()
+        try:
+            while 1<2:
+                self.check_workers()
+                if not self.writer.is_alive():
+                    print('Writer process died, restarting it')
+                    # The queue may be locked by the dead writer, and the
+                    # new one does not know the headers: new queue, and the
+                    # workers are restarted (they send the headers again).
+                    self.queue = multiprocessing.Queue()
+                    self.writer = multiprocessing.Process(\
+                     target=writer_process,args=(self.queue,),name='pysqm-writer')
+                    self.writer.start()
+                    for k,worker in enumerate(self.workers):
+                        if worker is not None and worker.is_alive():
+                            worker.terminate()
+                            worker.join()
+                            self.start_worker(k)
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.queue.put(None)
+        self.writer.join()
+
+
+def device_names(specs):
+    '''
+    Copy of the device specs with unique names (unnamed devices are
+    named by their position, a single one keeps no name).
+    '''
+    specs = [dict(spec) for spec in specs]
+    if len(specs)>1:
+        for k,spec in enumerate(specs):
+            if spec.get('name') is None:
+                spec['name'] = str(k)
+    names = [spec.get('name') for spec in specs]
+    if len(set(names))<len(names):
+        raise ValueError('Device names must be unique: '+str(names))
+    return(specs)
+
+
+def devices_from_config():
+    ''' Device list (config._devices, or the single configured device) '''
+    try: return(list(config._devices))
+    except AttributeError:
+        return([{'type':config._device_type,'addr':config._device_addr}])
+
+
+if __name__ == '__main__':
+    Supervisor(devices_from_config()).run()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+'''
+PySQM data file writer
+____________________________
+
+Copyright (c) Mireia Nievas <mnievas[at]ucm[dot]es>
+
+This file is part of PySQM.
+
+PySQM is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+PySQM is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PySQM.  If not, see <http://www.gnu.org/licenses/>.
+____________________________
+Notes:
+
+The monthly, daily and current data files are kept open and only the
+new records are appended, so the cost of saving a measure does not grow
+during the night.
+
+The current data file (the one that is plotted) mirrors the daily file.
+It is published atomically (a full copy written aside and renamed over
+the old one) when a new daily file starts or when the program starts,
+and then grows by appends. Readers never see a truncated file.
+____________________________
+'''
+
+import os,sys
+import signal
+import threading
+
+from pysqm.nightindex import NightIndex
+
+
+def publish_file(source,destination):
+    '''
+    Atomically replace destination with a copy of source.
+    '''
+    temporary = destination+'.tmp'
+    with open(source,'r') as fsource:
+        with open(temporary,'w') as fdestination:
+            fdestination.write(fsource.read())
+            fdestination.flush()
+            os.fsync(fdestination.fileno())
+    os.replace(temporary,destination)
+
+
+def exit_on_sigterm():
+    '''
+    Turn SIGTERM into a normal exit, so the exit handlers
+    (e.g. writing the cached data) are run.
+    '''
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM)==signal.SIG_DFL:
+        signal.signal(signal.SIGTERM,\
+         lambda signum,frame: sys.exit(128+signum))
+
+
+class AppendFile(object):
+    '''
+    Data file kept open for appending.
+    header is a function returning the file header, only called
+    when the file is created (or empty).
+    '''
+    def __init__(self,path,header=None):
+        self.path = path
+        self.handle = open(path,'a')
+        if self.handle.tell()==0 and header is not None:
+            self.write(header())
+        self.stat = os.fstat(self.handle.fileno())
+
+    def write(self,data):
+        # One write per record, readers see complete lines
+        self.handle.write(data)
+        self.handle.flush()
+
+    def sync(self):
+        os.fsync(self.handle.fileno())
+
+    def replaced(self):
+        ''' True if the file was removed or replaced by someone else '''
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return(True)
+        return((stat.st_ino,stat.st_dev)!=(self.stat.st_ino,self.stat.st_dev))
+
+    def close(self):
+        self.handle.close()
+
+
+class DataWriter(object):
+    '''
+    Append-only writer for the monthly, daily and current data files.
+    '''
+    def __init__(self):
+        self.files = {}
+        self.mirrored = None
+        self.index = None
+        self.indexed = None
+
+    def open_file(self,role,path,header=None):
+        ''' Open (or reuse) the file for role, reopening it if needed '''
+        datafile = self.files.get(role)
+        if datafile is not None:
+            if datafile.path==path and not datafile.replaced():
+                return(datafile)
+            datafile.close()
+        self.files[role] = AppendFile(path,header)
+        return(self.files[role])
+
+    def write(self,monthly,daily,current,header,data,night=None):
+        '''
+        Append data to the monthly and daily files and mirror it
+        to the current file. If night is given, the new bytes of the
+        monthly file are added to its night index.
+        '''
+        monthly_file = self.open_file('monthly',monthly,header)
+        if night is not None and self.indexed is not monthly_file:
+            # New (or reopened) monthly file
+            if self.index is not None:
+                self.index.close()
+            self.index = NightIndex(monthly)
+            self.indexed = monthly_file
+
+        start = monthly_file.handle.tell()
+        monthly_file.write(data)
+        if night is not None:
+            self.index.record(night,start,monthly_file.handle.tell(),data.count('\n'))
+
+        self.open_file('daily',daily,header).write(data)
+
+        mirror = self.files.get('current')
+        if mirror is None or mirror.path!=current \
+         or self.mirrored!=daily or mirror.replaced():
+            # New night (or first record): publish the whole daily file
+            self.close_file('current')
+            publish_file(daily,current)
+            self.open_file('current',current)
+            self.mirrored = daily
+        else:
+            mirror.write(data)
+
+    def sync(self):
+        ''' Make sure the data is on disk (not only in the OS cache) '''
+        for datafile in self.files.values():
+            datafile.sync()
+        if self.index is not None:
+            self.index.sync()
+
+    def close_file(self,role):
+        datafile = self.files.pop(role,None)
+        if datafile is not None:
+            datafile.close()
+        if role=='current':
+            self.mirrored = None
+
+    def close(self):
+        for role in list(self.files):
+            self.close_file(role)
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+            self.indexed = None